@@ -0,0 +1,197 @@
+"""
+Coordinated handling of 429 / quota errors across all workers.
+
+A rate-limit response from any worker pauses dispatch for everyone until the
+server-advised retry time, retries are drawn from a job-wide budget, and a
+circuit breaker fails fast once the quota is clearly exhausted instead of
+letting every chunk hammer the API.
+"""
+import asyncio
+import random
+import threading
+import time
+
+# Used when a 429 carries no structured retry information
+DEFAULT_RETRY_DELAY = 20.0
+
+
+class QuotaExhaustedError(Exception):
+    """Raised while the circuit breaker is open after sustained quota exhaustion"""
+
+
+def is_rate_limit_error(exc):
+    """True for HTTP 429 / RESOURCE_EXHAUSTED errors from the API client"""
+    code = getattr(exc, "code", None)
+    if code == 429:
+        return True
+    grpc_status = getattr(exc, "grpc_status_code", None)
+    return getattr(grpc_status, "name", None) == "RESOURCE_EXHAUSTED"
+
+
+def _duration_seconds(duration):
+    if duration is None:
+        return None
+    if hasattr(duration, "total_seconds"):  # datetime.timedelta (proto-plus)
+        return duration.total_seconds()
+    if hasattr(duration, "seconds"):  # google.protobuf.Duration
+        return duration.seconds + getattr(duration, "nanos", 0) / 1e9
+    return None
+
+
+def retry_delay_from_error(exc, default=None):
+    """
+    Server-advised retry delay in seconds for a rate-limit error.
+
+    Reads the google.rpc.RetryInfo entry from the error's structured details,
+    then a Retry-After header on the HTTP response, then a retry_after
+    attribute (llm_backend.RateLimitError). Returns `default` when none is
+    present.
+    """
+    for detail in getattr(exc, "details", None) or []:
+        seconds = _duration_seconds(getattr(detail, "retry_delay", None))
+        if seconds is not None:
+            return seconds
+
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    retry_after = headers.get("Retry-After") if hasattr(headers, "get") else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    retry_after = getattr(exc, "retry_after", None)
+    if retry_after is not None:
+        return float(retry_after)
+    return default
+
+
+class RetryBudget:
+    """Job-wide cap on retries so a bad minute can't turn into a retry storm"""
+
+    def __init__(self, max_retries):
+        self.max_retries = max_retries
+        self.used = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_chunks(cls, chunk_count, ratio=0.2, minimum=3):
+        """Budget of `ratio` retries per chunk, never fewer than `minimum`"""
+        return cls(max(minimum, int(chunk_count * ratio)))
+
+    def try_acquire(self):
+        """Take one retry from the budget. Returns False once it is spent."""
+        with self._lock:
+            if self.used >= self.max_retries:
+                return False
+            self.used += 1
+            return True
+
+    @property
+    def remaining(self):
+        return max(0, self.max_retries - self.used)
+
+
+class BackoffController:
+    """
+    Shared pause and circuit breaker for every worker using one API quota.
+
+    record_rate_limit() pauses dispatch globally until the advised retry time.
+    wait_if_paused() blocks callers until the pause ends and raises
+    QuotaExhaustedError while the breaker is open. The breaker opens after
+    `failure_threshold` consecutive 429s (ignoring ones that land during a
+    pause, which were already in flight), or when the server asks us to wait
+    longer than `max_pause` (typical of an exhausted daily quota), and stays
+    open for `cooldown` seconds; the first request after that is a trial,
+    and one more 429 re-opens the breaker immediately.
+    """
+
+    def __init__(self, failure_threshold=5, max_pause=300.0, cooldown=60.0, clock=time.time, sleep=time.sleep):
+        self.failure_threshold = failure_threshold
+        self.max_pause = max_pause
+        self.cooldown = cooldown
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._pause_until = 0.0
+        self._open_until = 0.0
+        self._consecutive_failures = 0
+
+    @property
+    def is_open(self):
+        return self.clock() < self._open_until
+
+    def pause_remaining(self):
+        """Seconds left on the global pause. Raises QuotaExhaustedError while the breaker is open."""
+        with self._lock:
+            now = self.clock()
+            if now < self._open_until:
+                raise QuotaExhaustedError(
+                    f"API quota exhausted; circuit breaker open for another {self._open_until - now:.0f}s"
+                )
+            return max(0.0, self._pause_until - now)
+
+    def wait_if_paused(self, cancel_token=None):
+        """
+        Sleep until any global pause has passed. Returns True if it had to wait.
+        With a cancel_token the sleep is cut short (raising JobCancelled) on cancellation.
+        """
+        waited = False
+        while True:
+            delay = self.pause_remaining()
+            if delay <= 0:
+                return waited
+            # Jitter spreads workers out so they don't all fire the moment the pause ends
+            delay += random.uniform(0, 1)
+            if cancel_token is not None:
+                cancel_token.sleep(delay)
+            else:
+                self.sleep(delay)
+            waited = True
+
+    async def wait_if_paused_async(self):
+        """Asyncio counterpart of wait_if_paused()"""
+        waited = False
+        while True:
+            delay = self.pause_remaining()
+            if delay <= 0:
+                return waited
+            await asyncio.sleep(delay + random.uniform(0, 1))
+            waited = True
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+
+    def record_rate_limit(self, exc=None, default_delay=DEFAULT_RETRY_DELAY):
+        """Pause every worker for the advised retry delay and return that delay"""
+        delay = retry_delay_from_error(exc, default=None) if exc is not None else None
+        with self._lock:
+            now = self.clock()
+            # 429s from requests already in flight when a pause began say nothing new;
+            # only failures after the previous pause has run out count toward the breaker
+            if now >= self._pause_until:
+                self._consecutive_failures += 1
+            if delay is None:
+                # No advice from the server: back off exponentially from the default
+                delay = default_delay * (2 ** min(max(self._consecutive_failures - 1, 0), 4))
+            self._pause_until = max(self._pause_until, now + delay)
+
+            if self._consecutive_failures >= self.failure_threshold or delay > self.max_pause:
+                self._open_until = now + max(self.cooldown, delay)
+                print(f"🛑 Quota exhausted: pausing all requests for {self._open_until - now:.0f}s")
+            else:
+                print(f"⏳ Rate limit hit: pausing all workers for {delay:.1f}s")
+        return delay
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_backoff_controller(model_name):
+    """Return the process-wide backoff controller for a model, creating it on first use"""
+    with _controllers_lock:
+        if model_name not in _controllers:
+            _controllers[model_name] = BackoffController()
+        return _controllers[model_name]
@@ -0,0 +1,252 @@
+"""
+Headless batch runs: scrape and parse a list of pages without the UI.
+
+    python batch.py urls.txt "product names and prices" -o products.jsonl
+    cat urls.txt | python batch.py - "contact email" --pages 4 --workers 16
+
+Every URL goes through the same steps and engine as the Streamlit app:
+scrape, extract, clean, chunk and parse_with_gemini with its rate limiter,
+response cache and job store. The steps run as a Pipeline, so the next
+pages load while earlier ones are being parsed, and the bounded queues
+between stages keep memory to a few pages whichever stage is the slowest.
+Each page's result is appended to the JSONL output as one line as soon as
+it is done, and the run ends with each stage's utilization. Running again
+with the same output skips the URLs it already has and retries failed
+ones, so a cron job can simply rerun after a crash. Ctrl-C stops the run
+and keeps what has finished.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from urllib.parse import urlparse
+
+from cancellation import CancelToken, JobCancelled
+from dispatch import LANE_BATCH, Tenant
+from parse import chunk_size_for, parse_with_gemini
+from pipeline import DEFAULT_QUEUE_SIZE, FailedItem, Pipeline, Stage
+from scrape import clean_body_content, extract_body_content, scrape_website, split_dom_content
+
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+STATUS_STOPPED = "stopped"
+
+# Fields of a page record written to the output, in this order
+OUTPUT_FIELDS = ("url", "status", "error", "chunks", "result", "tokens")
+
+
+def read_urls(source):
+    """
+    URLs from a file, or stdin for "-", one per line; blank lines and # comments
+    are skipped. The file is opened right away, so a bad path fails in the caller
+    rather than on the pipeline's feeder thread; the URLs are read as needed.
+    """
+    stream = sys.stdin if source == "-" else open(source, encoding="utf-8")
+    return _stream_urls(stream)
+
+
+def _stream_urls(stream):
+    try:
+        for line in stream:
+            url = line.strip()
+            if url and not url.startswith("#"):
+                yield url
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def finished_urls(path):
+    """URLs an earlier run already wrote to the output with status ok"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line of a run that was killed mid-write
+                continue
+            if record.get("status") == STATUS_OK:
+                done.add(record.get("url"))
+    return done
+
+
+def open_output(path, append):
+    """The output file, opened so the next record starts on a line of its own"""
+    if append and os.path.exists(path) and os.path.getsize(path):
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            complete = f.read(1) == b"\n"
+        out = open(path, "a", encoding="utf-8")
+        if not complete:
+            out.write("\n")
+        return out
+    return open(path, "a" if append else "w", encoding="utf-8")
+
+
+def page_stages(parse_description, cancel_token, tenant, browsers=1, pages=2, **parse_kwargs):
+    """
+    The pipeline stages for one page record ({"url": ...}): scrape, clean,
+    split and parse, each filling in the record and dropping what the next
+    stage no longer needs.
+    """
+    def scrape(record):
+        record["started"] = time.monotonic()
+        record["html"] = scrape_website(record["url"], cancel_token=cancel_token)
+        return record
+
+    def clean(record):
+        record["content"] = clean_body_content(extract_body_content(record.pop("html")))
+        return record
+
+    def split(record):
+        record["domain"] = urlparse(record["url"]).netloc
+        record["chunks"] = split_dom_content(record.pop("content"), max_length=chunk_size_for(record["domain"]))
+        return record
+
+    def parse(record):
+        chunks = record.pop("chunks")
+        stats = {}
+        record["result"] = parse_with_gemini(chunks, parse_description, cancel_token=cancel_token, stats=stats,
+                                             domain=record.pop("domain"), tenant=tenant, source=record["url"],
+                                             **parse_kwargs)
+        record["status"] = STATUS_STOPPED if cancel_token.cancelled else STATUS_OK
+        record["chunks"] = len(chunks)
+        if "tokens" in stats:
+            record["tokens"] = {"prompt": stats["tokens"].prompt_tokens, "output": stats["tokens"].output_tokens}
+        return record
+
+    return [
+        Stage("scrape", scrape, browsers),
+        Stage("clean", clean),
+        Stage("split", split),
+        Stage("parse", parse, pages),
+    ]
+
+
+def output_record(item):
+    """The JSONL record for a page leaving the pipeline"""
+    if isinstance(item, FailedItem):
+        record = item.item
+        if isinstance(item.error, JobCancelled):
+            record["status"] = STATUS_STOPPED
+        else:
+            record["status"] = STATUS_FAILED
+            record["error"] = f"{item.stage}: {item.error}"
+    else:
+        record = item
+    output = {key: record[key] for key in OUTPUT_FIELDS if key in record}
+    output["seconds"] = round(time.monotonic() - record.get("started", time.monotonic()), 2)
+    return output
+
+
+def run_batch(urls, parse_description, output, pages=2, browsers=1, queue_size=DEFAULT_QUEUE_SIZE, resume=True,
+              stats=None, **parse_kwargs):
+    """
+    Process urls (any iterable) through the scrape, clean, split and parse
+    stages, with `browsers` pages loading and `pages` pages parsing at once,
+    appending a JSONL record per page to output. With resume, URLs already in
+    the output with status ok are skipped. Returns the number of pages per
+    status, plus "skipped"; a `stats` list receives each stage's StageStats.
+    """
+    done = finished_urls(output) if resume else set()
+    counts = {STATUS_OK: 0, STATUS_FAILED: 0, STATUS_STOPPED: 0, "skipped": 0}
+    cancel_token = CancelToken()
+    # Batch work takes the shared quota after any interactive sessions in this process
+    tenant = Tenant("batch", lane=LANE_BATCH)
+
+    def new_pages():
+        for url in urls:
+            if url in done:
+                counts["skipped"] += 1
+                continue
+            done.add(url)
+            yield {"url": url}
+
+    pipeline = Pipeline(
+        page_stages(parse_description, cancel_token, tenant, browsers, pages, **parse_kwargs),
+        queue_size=queue_size,
+        cancel_token=cancel_token
+    ).run(new_pages())
+    with open_output(output, resume) as out:
+        results = iter(pipeline)
+        while True:
+            try:
+                item = next(results, None)
+            except KeyboardInterrupt:
+                # The pages in progress finish as stopped, so the next run retries them
+                print("⏹ Interrupted - stopping the pages in progress")
+                cancel_token.cancel("Interrupted")
+                continue
+            if item is None:
+                break
+            record = output_record(item)
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            counts[record["status"]] += 1
+            print(f"{'✅' if record['status'] == STATUS_OK else '❌'} {record['url']}: {record['status']} "
+                  f"in {record['seconds']:.1f}s" + (f" ({record['error']})" if "error" in record else ""))
+
+    print(f" Pipeline stages:\n{pipeline.summary()}")
+    bottleneck = pipeline.bottleneck()
+    if bottleneck is not None and bottleneck.items:
+        print(f" Bottleneck: {bottleneck.name} ({bottleneck.utilization:.0%} busy)")
+    if stats is not None:
+        stats.extend(pipeline.stats)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scrape and parse a list of pages into a JSONL file")
+    parser.add_argument("urls", help='File with one URL per line, or "-" to read them from stdin')
+    parser.add_argument("description", help="What to extract from each page")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSONL file to append page results to")
+    parser.add_argument("--restart", action="store_true",
+                        help="Overwrite the output instead of skipping the URLs it already has")
+    parser.add_argument("--pages", type=int, default=2, help="Pages parsed at once")
+    parser.add_argument("--browsers", type=int, default=1, help="Pages loaded at once, each in its own browser")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="Pages waiting between two stages before the earlier one pauses")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Max requests in flight per page (default: as many as the rate limit allows)")
+    parser.add_argument("--no-adaptive", action="store_true", help="Fixed concurrency instead of AIMD")
+    parser.add_argument("--batch-size", type=int, default=1, help="Chunks per request")
+    parser.add_argument("--schema", default=None,
+                        help='Return records: a field spec like "name*, price:number", or "auto" to infer it')
+    parser.add_argument("--limit", type=int, default=None, help="Stop each page after this many results")
+    parser.add_argument("--deadline", type=float, default=None, help="Time budget per page in seconds")
+    parser.add_argument("--no-cache", action="store_true", help="Don't use the response cache")
+    args = parser.parse_args(argv)
+    try:
+        urls = read_urls(args.urls)
+    except OSError as e:
+        parser.error(f"can't read {args.urls}: {e.strerror or e}")
+
+    started = time.monotonic()
+    counts = run_batch(
+        urls,
+        args.description,
+        args.output,
+        pages=args.pages,
+        browsers=args.browsers,
+        queue_size=args.queue_size,
+        resume=not args.restart,
+        max_workers=args.workers,
+        adaptive=not args.no_adaptive,
+        batch_size=args.batch_size,
+        schema=True if args.schema == "auto" else args.schema,
+        limit=args.limit,
+        deadline=args.deadline,
+        use_cache=not args.no_cache,
+        job_store=True,
+    )
+    print(f"Done in {time.monotonic() - started:.1f}s: {counts[STATUS_OK]} ok, {counts[STATUS_FAILED]} failed, "
+          f"{counts[STATUS_STOPPED]} stopped, {counts['skipped']} already in {args.output}")
+    return 1 if counts[STATUS_FAILED] or counts[STATUS_STOPPED] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
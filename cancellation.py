@@ -0,0 +1,67 @@
+"""
+Cooperative cancellation for scrape and parse jobs.
+
+A CancelToken is created by whoever starts a job (the Streamlit page, a
+script) and handed down to the code doing the work. Cancelling it wakes
+every sleep that waits on it and runs registered callbacks, which is how a
+parse job cancels its in-flight requests and a scrape quits its browser.
+"""
+import threading
+
+
+class JobCancelled(Exception):
+    """Raised when work is stopped through its CancelToken"""
+
+
+class CancelToken:
+    """Thread-safe, one-way cancellation flag with callbacks and interruptible sleeps"""
+
+    def __init__(self):
+        self.reason = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="Job cancelled"):
+        """Cancel the job. Only the first call has any effect."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠ Cancel callback failed: {e}")
+
+    def add_callback(self, callback):
+        """
+        Run callback() when the token is cancelled (immediately if it already is).
+        Returns a function that unregisters it.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove_callback(callback)
+        callback()
+        return lambda: None
+
+    def _remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise JobCancelled(self.reason)
+
+    def sleep(self, seconds):
+        """Sleep for up to `seconds`, raising JobCancelled as soon as the token is cancelled"""
+        if self._event.wait(max(0.0, seconds)):
+            raise JobCancelled(self.reason)
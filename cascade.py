@@ -0,0 +1,195 @@
+"""
+Model routing and the cheap-to-strong model cascade.
+
+A ModelRoute is one model a request can go to: its LLMBackend together with
+the rate limiter and backoff controller that guard that model's quota, and
+its token prices. A ModelCascade tries the routes in order, cheapest first,
+and only escalates a chunk to the next model when the CascadePolicy finds
+the answer suspicious: truncated, failed or malformed, empty although the
+chunk looks relevant, or below a confidence threshold by the model's own
+self-check. Per-tier latency, cost and escalation rates are collected in
+TierStats.
+"""
+import re
+
+from backoff import QuotaExhaustedError, get_backoff_controller
+from dispatch import get_fair_scheduler, percentile
+from rate_limiter import get_rate_limiter
+
+# USD per million tokens: (input, cached input, output)
+MODEL_PRICES = {
+    "gemini-2.5-pro": (1.25, 0.31, 10.00),
+    "gemini-2.5-flash": (0.30, 0.075, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.025, 0.40),
+}
+
+# Cheapest first; the last model answers whatever the others escalate
+DEFAULT_CASCADE = ("gemini-2.5-flash-lite", "gemini-2.5-flash")
+
+
+class ModelRoute:
+    """
+    A backend plus the quota guards and prices that belong to its model.
+
+    limiter and backoff default to the process-wide ones for the backend's
+    model name; prices default to MODEL_PRICES (zero for unknown models).
+    Requests made on behalf of a Tenant take turns for the limiter's slots
+    through its process-wide FairScheduler.
+    """
+
+    def __init__(self, backend, limiter=None, backoff=None, generation_config=None, prices=None):
+        self.backend = backend
+        self.limiter = limiter or get_rate_limiter(backend.model_name)
+        self.scheduler = get_fair_scheduler(self.limiter)
+        self.backoff = backoff or get_backoff_controller(backend.model_name)
+        self.generation_config = generation_config
+        self.prices = prices or MODEL_PRICES.get(backend.model_name.split("/")[-1], (0.0, 0.0, 0.0))
+
+    @property
+    def model_name(self):
+        return self.backend.model_name
+
+    async def wait_for_slot(self, tokens=0, tenant=None):
+        """Wait out any 429 pause, the tenant's turn and the rate limiter, then return the booked Reservation"""
+        await self.backoff.wait_if_paused_async()
+        if tenant is not None:
+            reservation = await self.scheduler.turn(tenant, tokens)
+        else:
+            reservation = await self.limiter.acquire_async(tokens)
+        # A 429 from another worker may have paused dispatch while we waited for our slot
+        await self.backoff.wait_if_paused_async()
+        return reservation
+
+    async def has_headroom(self, tokens):
+        """True when one more request fits under this model's limits right now, without waiting"""
+        try:
+            if self.backoff.pause_remaining() > 0:
+                return False
+        except QuotaExhaustedError:
+            return False
+        headroom = await self.limiter.headroom_async()
+        if headroom["next_slot_in"] > 0:
+            return False
+        return headroom["tokens_per_minute"] is None or headroom["tokens_per_minute"] >= tokens
+
+    def cost(self, prompt_tokens, cached_tokens, output_tokens):
+        input_price, cached_price, output_price = self.prices
+        return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+                + output_tokens * output_price) / 1_000_000
+
+
+# Answers that ignore the "only the requested data" instruction
+DEFAULT_MALFORMED_PATTERNS = (
+    r"^\s*(here is|here are|sure|certainly)\b",
+    r"\b(i'm sorry|i am sorry|i cannot|i can't|as an ai)\b",
+    r"^\s*```",
+)
+
+# Outcome of a chunk request, as reported by parse.generate_chunk_result
+STATUS_OK = "ok"
+STATUS_BLOCKED = "blocked"
+STATUS_TRUNCATED = "truncated"
+STATUS_FAILED = "failed"
+
+
+class CascadePolicy:
+    """
+    When a cheaper model's answer should be escalated to the next model.
+
+    escalate_truncated / escalate_failed: escalate answers cut off at the
+        output limit, and requests that failed outright
+    malformed_patterns: regexes (case-insensitive) marking an answer that
+        ignored the output rules; None disables the check
+    suspicious_relevance: escalate an empty answer when the chunk mentions the
+        description's words at least this many times (by default, at all);
+        None disables the check
+    self_check: ask the cheap model to rate its own non-empty answers and
+        escalate those rated below min_confidence (one extra cheap request each)
+    """
+
+    def __init__(self, escalate_truncated=True, escalate_failed=True,
+                 malformed_patterns=DEFAULT_MALFORMED_PATTERNS, suspicious_relevance=1,
+                 self_check=False, min_confidence=0.7):
+        self.escalate_truncated = escalate_truncated
+        self.escalate_failed = escalate_failed
+        self.malformed_patterns = [re.compile(p, re.IGNORECASE | re.MULTILINE) for p in malformed_patterns or ()]
+        self.suspicious_relevance = suspicious_relevance
+        self.self_check = self_check
+        self.min_confidence = min_confidence
+
+    def escalation_reason(self, result, status, relevance):
+        """Why this answer should go to a stronger model, or None to accept it"""
+        if status == STATUS_TRUNCATED and self.escalate_truncated:
+            return "truncated"
+        if status == STATUS_FAILED and self.escalate_failed:
+            return "failed"
+        if result and any(pattern.search(result) for pattern in self.malformed_patterns):
+            return "malformed"
+        if not result and self.suspicious_relevance is not None and relevance >= self.suspicious_relevance:
+            return "empty but relevant"
+        return None
+
+    def needs_self_check(self, result, status):
+        return self.self_check and bool(result) and status not in (STATUS_TRUNCATED, STATUS_FAILED)
+
+
+self_check_template = (
+    "Description: {parse_description}\n\n"
+    "Extracted answer:\n{answer}\n\n"
+    "How confident are you that the extracted answer is correct and complete for this "
+    "description and content? Reply with only a number between 0 and 1."
+)
+
+
+def parse_confidence(text):
+    """The first number in a self-check reply, clamped to [0, 1]; None if there is none"""
+    match = re.search(r"\d*\.?\d+", text or "")
+    if not match:
+        return None
+    return min(1.0, max(0.0, float(match.group())))
+
+
+class TierStats:
+    """
+    Requests, latency, tokens, cost and escalations for one cascade tier.
+    The token attributes match TokenUsage, so it can be passed as usage_totals.
+    """
+
+    def __init__(self, route):
+        self.route = route
+        self.requests = 0
+        self.escalated = 0
+        self.self_checks = 0
+        self.latencies = []
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+
+    @property
+    def cost(self):
+        return self.route.cost(self.prompt_tokens, self.cached_tokens, self.output_tokens)
+
+    @property
+    def escalation_rate(self):
+        return self.escalated / self.requests if self.requests else 0.0
+
+    def summary(self):
+        if not self.requests:
+            return f"{self.route.model_name}: no requests"
+        return (f"{self.route.model_name}: {self.requests} chunks, "
+                f"p50 {percentile(self.latencies, 50):.1f}s / p99 {percentile(self.latencies, 99):.1f}s, "
+                f"${self.cost:.4f}, escalated {self.escalation_rate:.0%}")
+
+
+class ModelCascade:
+    """Routes in escalation order (cheapest first) with a policy and per-tier stats"""
+
+    def __init__(self, routes, policy=None):
+        if not routes:
+            raise ValueError("A model cascade needs at least one route")
+        self.routes = list(routes)
+        self.policy = policy or CascadePolicy()
+        self.tiers = [TierStats(route) for route in self.routes]
+
+    def summary(self):
+        return "; ".join(tier.summary() for tier in self.tiers)
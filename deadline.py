@@ -0,0 +1,130 @@
+"""
+Deadline-aware scheduling for parse jobs.
+
+Given a time budget, a DeadlineScheduler estimates how many requests can
+finish in time from the live rate-limit headroom, the concurrency ceiling
+and recent latencies, and picks the settings that cover the most content
+within it. Chunks go most relevant first. When requests are the scarce
+resource, chunks are packed into fewer requests. When latency is, the
+faster model tier is used, and with only a few chunks they are split so
+each request returns sooner. The job stops at the deadline and reports
+what it covered in a CoverageReport.
+"""
+import math
+
+# Assumed request latency (seconds) before any requests have been timed
+DEFAULT_LATENCY = 5.0
+# Share of the budget to plan for, leaving room for latency variance and the final answers
+DEFAULT_SAFETY = 0.8
+# Most chunks packed into one request to fit a budget
+MAX_DEADLINE_BATCH = 8
+
+
+class DeadlineSkipped(Exception):
+    """A request was not started because it could not finish before the job's deadline"""
+
+
+class DeadlineScheduler:
+    """
+    Settings for a job that has `budget` seconds.
+
+    latency: expected seconds per request (a high percentile of recent ones)
+    max_in_flight: concurrency ceiling
+    requests_available: requests the rate limiter can grant within the budget
+        (None when requests are not limited)
+    """
+
+    def __init__(self, budget, latency=None, max_in_flight=1, requests_available=None, safety=DEFAULT_SAFETY):
+        self.budget = budget
+        self.latency = latency or DEFAULT_LATENCY
+        self.max_in_flight = max(1, max_in_flight)
+        self.requests_available = requests_available
+        self.usable = budget * safety
+
+    @property
+    def rounds(self):
+        """Back-to-back request rounds that fit in the budget; 0 if not even one does"""
+        return int(self.usable // self.latency)
+
+    def capacity(self):
+        """Requests that can complete within the budget; one round is always attempted"""
+        capacity = self.max_in_flight * max(1, self.rounds)
+        if self.requests_available is not None:
+            capacity = min(capacity, self.requests_available)
+        return capacity
+
+    def latency_bound(self):
+        """True when time, not the rate limit, is what limits coverage"""
+        return self.requests_available is None or self.max_in_flight * max(1, self.rounds) <= self.requests_available
+
+    def batch_size(self, chunk_count):
+        """Chunks per request so every chunk gets a request, when the rate limit is what's short"""
+        capacity = self.capacity()
+        if capacity <= 0 or chunk_count <= capacity or self.latency_bound():
+            return 1
+        return min(MAX_DEADLINE_BATCH, math.ceil(chunk_count / capacity))
+
+    def use_fast_model(self, chunk_count):
+        """True when the job can't be covered at this latency, so a faster model is worth it"""
+        return self.latency_bound() and chunk_count > self.capacity()
+
+    def split_factor(self, chunk_count):
+        """
+        How many pieces to cut each chunk into: more, smaller requests when the
+        window has room to spare and a single round barely fits in the budget.
+        """
+        if chunk_count >= self.max_in_flight or self.rounds >= 2:
+            return 1
+        pieces = self.max_in_flight // max(1, chunk_count)
+        if self.requests_available is not None:
+            pieces = min(pieces, self.requests_available // max(1, chunk_count))
+        return max(1, min(pieces, 4))
+
+    def window(self, request_count):
+        """Concurrency to start at, so no part of the budget goes to slow start"""
+        return max(1, min(self.max_in_flight, request_count))
+
+    def summary(self):
+        available = "unlimited" if self.requests_available is None else self.requests_available
+        return (f"{self.budget:.0f}s budget at ~{self.latency:.1f}s per request: "
+                f"{self.capacity()} requests fit ({self.max_in_flight} in flight, {available} allowed by quota)")
+
+
+class CoverageReport:
+    """How much of a deadline-bound job got done before time ran out"""
+
+    def __init__(self, budget, chunk_count, total_relevance):
+        self.budget = budget
+        self.chunks = chunk_count
+        self.total_relevance = total_relevance
+        self.answered = 0
+        self.with_results = 0
+        self.covered_relevance = 0
+        self.skipped = 0
+        self.cancelled = 0
+        self.elapsed = 0.0
+        self.timed_out = False
+
+    def record(self, relevance, result):
+        self.answered += 1
+        self.covered_relevance += relevance
+        if result:
+            self.with_results += 1
+
+    @property
+    def coverage(self):
+        return self.answered / self.chunks if self.chunks else 1.0
+
+    @property
+    def relevance_coverage(self):
+        """Share of the description-matching content that was answered"""
+        return self.covered_relevance / self.total_relevance if self.total_relevance else self.coverage
+
+    def summary(self):
+        text = (f"answered {self.answered}/{self.chunks} chunks ({self.coverage:.0%}, "
+                f"{self.relevance_coverage:.0%} of the relevant content) in {self.elapsed:.1f}s "
+                f"of a {self.budget:.0f}s budget")
+        if self.skipped or self.cancelled or self.timed_out:
+            reason = "deadline reached with " if self.timed_out else ""
+            text += f"; {reason}{self.skipped} chunks not started and {self.cancelled} cancelled"
+        return text
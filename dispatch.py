@@ -0,0 +1,612 @@
+"""
+Asyncio dispatch engine for LLM requests.
+
+One long-lived event loop runs on a background thread and every job is
+scheduled onto it, so the async Gemini client stays bound to a single loop
+across Streamlit reruns. A request in flight costs a coroutine frame rather
+than an OS thread, which is what lets paid-tier keys keep hundreds of calls
+open at once. Because every job shares that loop, a FairScheduler can hand
+out a model's rate-limit slots across Streamlit sessions and batch jobs
+by weighted fair queuing instead of first come, first served.
+"""
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+
+# In-flight requests per job when the caller doesn't say otherwise
+DEFAULT_MAX_IN_FLIGHT = 64
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """Return the shared dispatch loop, starting its thread on first use"""
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name="llm-dispatch-loop", daemon=True)
+            thread.start()
+        return _loop
+
+
+class CallbackRelay:
+    """
+    Carries callbacks from the dispatch loop back to the thread that started
+    the job. Streamlit only lets the script thread update the page, so
+    progress callbacks are wrapped with wrap() and executed by run_sync().
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def wrap(self, callback):
+        if callback is None:
+            return None
+
+        def relayed(*args, **kwargs):
+            self._queue.put((callback, args, kwargs))
+        return relayed
+
+    def drain(self, timeout=None):
+        """Run queued callbacks in the current thread, waiting up to timeout for the first"""
+        try:
+            callback, args, kwargs = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        callback(*args, **kwargs)
+        while True:
+            try:
+                callback, args, kwargs = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            callback(*args, **kwargs)
+
+
+def run_sync(coro, relay=None, poll_interval=0.1, heartbeat=None):
+    """
+    Run a coroutine on the shared dispatch loop and block for its result.
+
+    Safe to call from any thread that is not the dispatch loop itself,
+    including Streamlit's script thread. Callbacks routed through `relay`
+    run in the calling thread while it waits, and heartbeat() is called
+    every poll_interval. If the caller is interrupted (an exception from a
+    callback or the heartbeat, e.g. Streamlit stopping the script) the
+    coroutine is cancelled rather than left running.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+    polling = relay is not None or heartbeat is not None
+    try:
+        while True:
+            try:
+                result = future.result(timeout=0 if polling else None)
+                break
+            except concurrent.futures.TimeoutError:
+                if relay:
+                    relay.drain(timeout=poll_interval)
+                else:
+                    time.sleep(poll_interval)
+                if heartbeat:
+                    heartbeat()
+        if relay:
+            relay.drain(timeout=0)
+        return result
+    except BaseException:
+        future.cancel()
+        raise
+
+
+class ConcurrencyWindow:
+    """
+    Asyncio semaphore whose limit can change while requests are waiting.
+
+    The adaptive concurrency controller in parse.py resizes it; shrinking
+    never interrupts requests already in flight, it just holds back new ones
+    until enough have finished.
+    """
+
+    def __init__(self, limit):
+        self._limit = max(1, int(limit))
+        self.in_flight = 0
+        self._waiters = deque()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    def set_limit(self, limit):
+        """Resize the window. Must be called on the dispatch loop."""
+        self._limit = max(1, int(limit))
+        self._wake()
+
+    async def acquire(self):
+        while self.in_flight >= self._limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # We were handed a free slot we can no longer use; pass it on
+                    self._wake()
+                raise
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        free = self._limit - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+class DispatchEngine:
+    """
+    Runs one coroutine per item with at most `max_in_flight` running at once,
+    or as many as a shared ConcurrencyWindow currently allows.
+
+    map() returns results by item index as they complete. cancel() stops the
+    job: queued items are never started (counted in skipped_count, their
+    indices in skipped_items) and running ones are cancelled (cancelled_count,
+    cancelled_items), and map() returns whatever finished before that. Items
+    are started in the order they are given.
+    """
+
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT, window=None):
+        self.window = window or ConcurrencyWindow(max_in_flight)
+        self.cancelled = False
+        self.cancelled_count = 0
+        self.skipped_count = 0
+        self.cancelled_items = []
+        self.skipped_items = []
+        self._tasks = set()
+
+    @property
+    def max_in_flight(self):
+        return self.window.limit
+
+    def cancel(self):
+        """Cancel every queued and running request of this job"""
+        self.cancelled = True
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def map(self, func, items, on_result=None):
+        """
+        Await func(item) for every item under the in-flight bound.
+
+        Args:
+            func: Coroutine function called once per item
+            items: Sequence of items to process
+            on_result: Optional callback (index, result, error) run on the loop
+                as each item finishes; error is None on success
+
+        Returns:
+            dict of index -> result for items that completed without error
+        """
+        results = {}
+        started = set()
+
+        async def run(index, item):
+            await self.window.acquire()
+            started.add(index)
+            try:
+                return await func(item)
+            finally:
+                self.window.release()
+
+        task_index = {}
+        for index, item in enumerate(items):
+            task = asyncio.ensure_future(run(index, item))
+            task_index[task] = index
+            self._tasks.add(task)
+        if self.cancelled:
+            self.cancel()
+
+        pending = set(task_index)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    self._tasks.discard(task)
+                    index = task_index[task]
+                    if task.cancelled():
+                        if index in started:
+                            self.cancelled_count += 1
+                            self.cancelled_items.append(index)
+                        else:
+                            self.skipped_count += 1
+                            self.skipped_items.append(index)
+                        continue
+                    error = task.exception()
+                    if error is None:
+                        results[index] = task.result()
+                    if on_result:
+                        on_result(index, task.result() if error is None else None, error)
+        except asyncio.CancelledError:
+            # The whole job was cancelled from outside: take the requests down with it
+            self.cancel()
+            raise
+        finally:
+            # Left over only if the loop ended early, e.g. on_result raised: don't leave them running
+            for task in pending:
+                task.cancel()
+                self._tasks.discard(task)
+            await asyncio.gather(*pending, return_exceptions=True)
+        return results
+
+
+class ReorderBuffer:
+    """
+    Releases out-of-order results in index order as soon as they are contiguous.
+
+    add() returns the (index, result) pairs that became releasable, so a
+    caller can show chunk 1 the moment it is done even while chunk 7 is
+    still in flight, without ever showing chunk 3 before chunk 2.
+    """
+
+    def __init__(self, start=0):
+        self.next_index = start
+        self._pending = {}
+
+    def add(self, index, result):
+        self._pending[index] = result
+        released = []
+        while self.next_index in self._pending:
+            released.append((self.next_index, self._pending.pop(self.next_index)))
+            self.next_index += 1
+        return released
+
+
+class LatencyTracker:
+    """Rolling window of recent request latencies, in seconds"""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def observe(self, seconds):
+        self._samples.append(seconds)
+
+    def percentile(self, p):
+        """The p-th percentile (0-100) of the window, or None while it is empty"""
+        return percentile(self._samples, p)
+
+
+def percentile(samples, p):
+    """Nearest-rank p-th percentile (0-100) of a collection, or None when it is empty"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class HedgePolicy:
+    """
+    Decides when a slow request gets a duplicate, and keeps the job's report.
+
+    A request becomes eligible for a hedge once it has run longer than the
+    `percentile`-th latency of recent requests (after `min_samples` have been
+    seen). Hedges are capped at `budget_ratio` of the job's requests, plus one,
+    so a uniformly slow API can't double the load.
+    """
+
+    def __init__(self, percentile=95, budget_ratio=0.05, min_samples=20, min_delay=0.5, latencies=None):
+        self.percentile = percentile
+        self.budget_ratio = budget_ratio
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        # Pass a shared tracker to carry the latency picture across jobs
+        self.latencies = latencies if latencies is not None else LatencyTracker()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        # Per-request latency as observed, and an estimate of what it would have
+        # been without hedging. A losing primary is cancelled, so its latency is
+        # estimated from primaries that did finish and ran at least that long.
+        self.observed = []
+        self.unhedged = []
+        self._primary_latencies = []
+
+    def hedge_delay(self):
+        """Seconds after which a request still running gets hedged; None until there is enough history"""
+        if len(self.latencies) < self.min_samples:
+            return None
+        return max(self.min_delay, self.latencies.percentile(self.percentile))
+
+    def try_acquire(self):
+        """Take one hedge from the budget. Returns False once it is spent."""
+        if self.hedges >= self.budget_ratio * self.requests + 1:
+            return False
+        self.hedges += 1
+        return True
+
+    def record(self, latency, hedge_won):
+        self.latencies.observe(latency)
+        self.observed.append(latency)
+        if hedge_won:
+            self.hedge_wins += 1
+            slower = [primary for primary in self._primary_latencies if primary > latency]
+            self.unhedged.append(percentile(slower, 50) if slower else latency)
+        else:
+            self._primary_latencies.append(latency)
+            self.unhedged.append(latency)
+
+    def summary(self):
+        p99 = percentile(self.observed, 99)
+        if p99 is None:
+            return "no requests"
+        text = f"hedged {self.hedges}/{self.requests} requests ({self.hedge_wins} won), p99 latency {p99:.1f}s"
+        if self.hedge_wins:
+            text += f" vs ~{percentile(self.unhedged, 99):.1f}s estimated without hedging"
+        return text
+
+
+async def hedged(call, policy, may_hedge=None):
+    """
+    Await call(False); if it is still running after policy.hedge_delay(), also
+    start a duplicate call(True), provided await may_hedge() agrees (e.g. there is
+    rate-limit headroom) and the hedge budget allows. The first successful
+    result wins and the other request is cancelled. If both fail, the
+    primary's error is raised.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    policy.requests += 1
+    primary = asyncio.ensure_future(call(False))
+    hedge = None
+    tasks = {primary}
+    try:
+        delay = policy.hedge_delay()
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and (may_hedge is None or await may_hedge()) and policy.try_acquire():
+                hedge = asyncio.ensure_future(call(True))
+                tasks.add(hedge)
+
+        first_error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            # Prefer the primary if both land in the same step
+            for task in sorted(done, key=lambda t: t is not primary):
+                error = task.exception()
+                if error is None:
+                    policy.record(loop.time() - started, task is hedge)
+                    return task.result()
+                if first_error is None or task is primary:
+                    first_error = error
+        raise first_error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+# Priority lanes, highest first
+LANE_INTERACTIVE = "interactive"
+LANE_BATCH = "batch"
+LANES = (LANE_INTERACTIVE, LANE_BATCH)
+
+
+class Tenant:
+    """
+    One party sharing the process's API quota: a Streamlit session, a batch run.
+
+    weight: share of the quota relative to other tenants in the same lane
+    lane: LANE_INTERACTIVE requests are served ahead of LANE_BATCH ones
+    limiter: optional RateLimiter of the tenant's own, capping its share (its quota)
+
+    The queue statistics are updated on the dispatch loop and can be read
+    from any thread to show the tenant where it stands.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, name=None, weight=1.0, lane=LANE_INTERACTIVE, limiter=None):
+        if lane not in LANES:
+            raise ValueError(f"Unknown lane '{lane}'. Choose from: {', '.join(LANES)}")
+        if weight <= 0:
+            raise ValueError("Tenant weight must be positive")
+        self.name = name or f"job-{next(Tenant._ids)}"
+        self.weight = weight
+        self.lane = lane
+        self.limiter = limiter
+        self.queued = 0
+        self.granted = 0
+        # Requests of other tenants queued ahead of this tenant's next one; None when it has none queued
+        self.position = None
+        self.last_wait = 0.0
+        self.total_wait = 0.0
+        self._last_finish = 0.0
+
+    @property
+    def average_wait(self):
+        return self.total_wait / self.granted if self.granted else 0.0
+
+    def summary(self):
+        text = f"{self.granted} requests sent, {self.average_wait:.1f}s average queue wait"
+        if self.queued:
+            text = f"{self.queued} queued (position {self.position}), " + text
+        return text
+
+    def __repr__(self):
+        return f"Tenant({self.name!r}, weight={self.weight}, lane={self.lane!r})"
+
+
+class FairScheduler:
+    """
+    Hands out one rate limiter's request slots across tenants.
+
+    Requests wait in turn() and are granted one at a time, only when the
+    limiter has a slot free now, so no job can book the quota minutes ahead
+    of everyone else. Interactive requests go first, but every
+    1/batch_share-th grant goes to the batch lane when it has requests
+    waiting, so batch work is slowed rather than starved. Within a lane
+    tenants are served by weighted fair queuing: each request is tagged with
+    a virtual finish time that advances by 1/weight per request of its
+    tenant, and the smallest tag goes next. A tenant whose own quota has no
+    slot free is passed over until it does.
+
+    Must be used from the dispatch loop.
+    """
+
+    def __init__(self, limiter, batch_share=0.1):
+        self.limiter = limiter
+        self.batch_share = batch_share
+        # Per lane, entries [finish, sequence, start, tenant, tokens, future, enqueued_at]
+        self._queues = {lane: [] for lane in LANES}
+        self._sequence = itertools.count()
+        self._virtual_time = 0.0
+        self._max_finish = 0.0
+        self._grants = 0
+        self._arrival = None
+        self._pump_task = None
+
+    @property
+    def waiting(self):
+        return sum(len(entries) for entries in self._queues.values())
+
+    async def turn(self, tenant, tokens=0):
+        """Wait for this tenant's turn, then for the booked slot; returns the limiter's Reservation"""
+        loop = asyncio.get_running_loop()
+        start = max(self._virtual_time, tenant._last_finish)
+        finish = start + 1.0 / tenant.weight
+        tenant._last_finish = finish
+        self._max_finish = max(self._max_finish, finish)
+        future = loop.create_future()
+        heapq.heappush(self._queues[tenant.lane], [finish, next(self._sequence), start, tenant, tokens, future, loop.time()])
+        tenant.queued += 1
+        self._refresh_positions()
+        if self._pump_task is None or self._pump_task.done():
+            self._arrival = asyncio.Event()
+            self._pump_task = loop.create_task(self._pump())
+        else:
+            self._arrival.set()
+        reservation = await future
+        delay = reservation.delay(self.limiter.clock())
+        if delay > 0:
+            if delay > 1:
+                print(f"⏳ Rate limit protection: waiting {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+        return reservation
+
+    def _drop_cancelled(self):
+        for lane, entries in self._queues.items():
+            live = [entry for entry in entries if not entry[5].done()]
+            if len(live) != len(entries):
+                for entry in entries:
+                    if entry[5].done():
+                        entry[3].queued -= 1
+                heapq.heapify(live)
+                self._queues[lane] = live
+
+    async def _eligible(self, lane):
+        """The lane's queued entry with the smallest tag whose tenant quota has a slot now"""
+        for entry in sorted(self._queues[lane]):
+            limiter = entry[3].limiter
+            if limiter is None or (await limiter.headroom_async())["next_slot_in"] <= 0:
+                return entry
+        return None
+
+    async def _next_entry(self):
+        lanes = list(LANES)
+        if self.batch_share and self._grants % max(1, round(1 / self.batch_share)) == 0:
+            lanes.reverse()
+        for lane in lanes:
+            entry = await self._eligible(lane)
+            if entry is not None:
+                return entry
+        return None
+
+    async def _tenant_wait(self):
+        """Seconds until some queued tenant's own quota frees up"""
+        limiters = {entry[3].limiter for entries in self._queues.values() for entry in entries
+                    if entry[3].limiter is not None}
+        waits = [(await limiter.headroom_async())["next_slot_in"] for limiter in limiters]
+        return min(waits) if waits else 0.1
+
+    def _refresh_positions(self):
+        position = 0
+        seen = set()
+        for lane in LANES:
+            for entry in sorted(self._queues[lane]):
+                tenant = entry[3]
+                if tenant not in seen:
+                    seen.add(tenant)
+                    tenant.position = position
+                position += 1
+        for lane in LANES:
+            for entry in self._queues[lane]:
+                if entry[3] not in seen:
+                    entry[3].position = None
+
+    async def _grant(self, entry):
+        finish, _, start, tenant, tokens, future, enqueued_at = entry
+        self._queues[tenant.lane].remove(entry)
+        heapq.heapify(self._queues[tenant.lane])
+        reservation = await self.limiter.reserve_async(tokens)
+        if tenant.limiter is not None:
+            await tenant.limiter.reserve_async(tokens)
+        self._virtual_time = max(self._virtual_time, start)
+        self._grants += 1
+        wait = asyncio.get_running_loop().time() - enqueued_at
+        tenant.queued -= 1
+        tenant.granted += 1
+        tenant.last_wait = wait
+        tenant.total_wait += wait
+        if not tenant.queued:
+            tenant.position = None
+        if not future.done():
+            # A request cancelled while its slot was being booked leaves the slot unused
+            future.set_result(reservation)
+        self._refresh_positions()
+        return reservation
+
+    async def _pump(self):
+        while True:
+            self._drop_cancelled()
+            if not self.waiting:
+                # Idle: past usage no longer counts against anyone
+                self._virtual_time = self._max_finish
+                return
+            wait = (await self.limiter.headroom_async())["next_slot_in"]
+            entry = await self._next_entry() if wait <= 0 else None
+            if entry is None:
+                self._arrival.clear()
+                try:
+                    await asyncio.wait_for(self._arrival.wait(),
+                                           timeout=max(0.01, wait or await self._tenant_wait()))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            reservation = await self._grant(entry)
+            # A token quota can push the slot later; later grants would only queue behind it
+            delay = reservation.delay(self.limiter.clock())
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_fair_scheduler(limiter):
+    """The process-wide FairScheduler for a rate limiter, created on first use"""
+    with _schedulers_lock:
+        if limiter not in _schedulers:
+            _schedulers[limiter] = FairScheduler(limiter)
+        return _schedulers[limiter]
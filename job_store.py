@@ -0,0 +1,254 @@
+"""
+Durable, resumable parse jobs.
+
+A JobStore records each parse job in a local SQLite file: its definition
+(description, settings and where the content came from), every chunk with
+its content hash, and each chunk's status and result, written as soon as
+the chunk's request completes. A job's id is a hash of its description,
+settings and content, so running the same parse again after a crash, a
+Streamlit restart or a reloaded tab reopens the interrupted job and only
+the chunks without a result are dispatched. Finished results are matched
+by content hash, so a chunk that was cut differently is simply parsed again.
+Each job also records its owner (e.g. a browser session's token), so a
+page only offers its own unfinished jobs.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", os.path.join(".cache", "jobs.sqlite3"))
+DEFAULT_JOB_TTL = float(os.getenv("JOB_STORE_TTL", str(7 * 86_400)))
+
+JOB_RUNNING = "running"
+JOB_INTERRUPTED = "interrupted"
+JOB_COMPLETE = "complete"
+
+CHUNK_PENDING = "pending"
+CHUNK_DONE = "done"
+CHUNK_FAILED = "failed"
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def make_job_id(parse_description, chunks, settings):
+    """Stable id for a job: the same description, settings and content always give the same id"""
+    payload = json.dumps(
+        {
+            "description": parse_description,
+            "content": content_hash("".join(chunks)),
+            "settings": settings,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class StoredJob:
+    """A job's definition and progress as recorded in the store"""
+
+    def __init__(self, job_id, description, settings, source, owner, status, chunk_count, done, failed,
+                 created_at, updated_at):
+        self.job_id = job_id
+        self.description = description
+        self.settings = settings
+        self.source = source
+        self.owner = owner
+        self.status = status
+        self.chunk_count = chunk_count
+        self.done = done
+        self.failed = failed
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+    @property
+    def remaining(self):
+        return self.chunk_count - self.done
+
+    def summary(self):
+        text = f"{self.done}/{self.chunk_count} chunks done"
+        if self.failed:
+            text += f", {self.failed} failed"
+        return f"{text} ({self.status})"
+
+
+class JobStore:
+    """Parse jobs and their per-chunk checkpoints in a SQLite file"""
+
+    def __init__(self, path=DEFAULT_JOB_STORE_PATH, ttl=DEFAULT_JOB_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # A checkpoint per finished chunk: durable against a crashed process, cheap enough per write
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                description TEXT NOT NULL,
+                settings TEXT NOT NULL,
+                source TEXT,
+                owner TEXT,
+                status TEXT NOT NULL,
+                chunk_count INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        if "owner" not in [column[1] for column in self._conn.execute("PRAGMA table_info(jobs)")]:
+            # Stores created before jobs had owners
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS job_chunks (
+                job_id TEXT NOT NULL,
+                chunk_index INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                content TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (job_id, chunk_index)
+            )
+            """
+        )
+        with self._lock:
+            self._prune(time.time())
+
+    def start(self, job_id, parse_description, chunks, settings, source=None, owner=None):
+        """
+        Record the job, or reopen it if it was recorded before, with its current
+        chunk list and owner (whoever runs it last owns it). Returns
+        {chunk_index: result} for the chunks whose content already has a result;
+        every other chunk is pending.
+        """
+        now = time.time()
+        hashes = [content_hash(chunk) for chunk in chunks]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                finished = {
+                    chunk_hash: json.loads(result)
+                    for chunk_hash, result in self._conn.execute(
+                        "SELECT content_hash, result FROM job_chunks WHERE job_id = ? AND status = ?",
+                        (job_id, CHUNK_DONE)
+                    )
+                }
+                self._conn.execute(
+                    "INSERT INTO jobs (id, description, settings, source, owner, status, chunk_count, created_at, "
+                    "updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (id) DO UPDATE SET status = excluded.status, chunk_count = excluded.chunk_count, "
+                    "source = COALESCE(excluded.source, source), owner = excluded.owner, "
+                    "updated_at = excluded.updated_at",
+                    (job_id, json.dumps(parse_description), json.dumps(settings, sort_keys=True, default=str),
+                     source, owner, JOB_RUNNING, len(chunks), now, now)
+                )
+                self._conn.execute("DELETE FROM job_chunks WHERE job_id = ?", (job_id,))
+                self._conn.executemany(
+                    "INSERT INTO job_chunks (job_id, chunk_index, content_hash, content, status, result, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (job_id, index, chunk_hash, chunk,
+                         CHUNK_DONE if chunk_hash in finished else CHUNK_PENDING,
+                         json.dumps(finished[chunk_hash]) if chunk_hash in finished else None, now)
+                        for index, (chunk, chunk_hash) in enumerate(zip(chunks, hashes))
+                    ]
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return {index: finished[chunk_hash] for index, chunk_hash in enumerate(hashes) if chunk_hash in finished}
+
+    def record_chunk(self, job_id, chunk_index, result, failed=False):
+        """Checkpoint one chunk: its result, or that it failed (failed chunks are retried on resume)"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE job_chunks SET status = ?, result = ?, updated_at = ? WHERE job_id = ? AND chunk_index = ?",
+                (CHUNK_FAILED if failed else CHUNK_DONE, None if failed else json.dumps(result), now,
+                 job_id, chunk_index)
+            )
+            self._conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (now, job_id))
+
+    def finish(self, job_id, status=JOB_COMPLETE):
+        """Mark the job complete, or interrupted when it ended with chunks still to do"""
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?", (status, time.time(), job_id))
+
+    def _jobs(self, where, params, limit=None):
+        query = (
+            "SELECT id, description, settings, source, owner, status, chunk_count, "
+            "(SELECT COUNT(*) FROM job_chunks WHERE job_id = id AND status = ?), "
+            "(SELECT COUNT(*) FROM job_chunks WHERE job_id = id AND status = ?), "
+            f"created_at, updated_at FROM jobs WHERE {where} ORDER BY updated_at DESC"
+        )
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        with self._lock:
+            rows = self._conn.execute(query, (CHUNK_DONE, CHUNK_FAILED) + tuple(params)).fetchall()
+        return [
+            StoredJob(job_id, json.loads(description), json.loads(settings), source, owner, status, chunk_count,
+                      done, failed, created_at, updated_at)
+            for job_id, description, settings, source, owner, status, chunk_count, done, failed, created_at,
+            updated_at in rows
+        ]
+
+    def get(self, job_id):
+        """The StoredJob with this id, or None"""
+        jobs = self._jobs("id = ?", (job_id,))
+        return jobs[0] if jobs else None
+
+    def unfinished(self, limit=10, owner=None):
+        """Jobs that were interrupted or never finished (their process died), newest first; only owner's if given"""
+        if owner is not None:
+            return self._jobs("status != ? AND owner = ?", (JOB_COMPLETE, owner), limit)
+        return self._jobs("status != ?", (JOB_COMPLETE,), limit)
+
+    def chunks(self, job_id):
+        """The job's chunk texts in order, to run it again without the original content"""
+        with self._lock:
+            return [
+                content for (content,) in self._conn.execute(
+                    "SELECT content FROM job_chunks WHERE job_id = ? ORDER BY chunk_index", (job_id,)
+                )
+            ]
+
+    def delete(self, job_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM job_chunks WHERE job_id = ?", (job_id,))
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def _prune(self, now):
+        expired = now - self.ttl
+        self._conn.execute(
+            "DELETE FROM job_chunks WHERE job_id IN (SELECT id FROM jobs WHERE updated_at <= ?)", (expired,)
+        )
+        self._conn.execute("DELETE FROM jobs WHERE updated_at <= ?", (expired,))
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_job_store():
+    """Process-wide store at JOB_STORE_PATH, or None when job checkpoints are disabled (JOB_STORE_PATH="")"""
+    global _default_store
+    if not DEFAULT_JOB_STORE_PATH:
+        return None
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = JobStore()
+        return _default_store
@@ -0,0 +1,651 @@
+"""
+LLM backends used by parse.py.
+
+A backend turns a prompt into a Gemini-shaped response (candidates with a
+finish_reason and text parts, plus usage_metadata) and raises the typed
+errors below for rate limits and blocked prompts. GeminiBackend talks to the
+real API and OpenAICompatibleBackend to any server speaking the OpenAI chat
+completions protocol (vLLM, llama.cpp, Ollama, ...). LocalBackend is a
+deterministic offline stand-in that bills tokens the way the provider does
+and can simulate latency, quotas, 429s and truncation, so prompt layout,
+caching and the whole dispatch and rate-limit stack can be exercised
+without a key.
+"""
+import asyncio
+import datetime
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from types import SimpleNamespace
+
+from backoff import is_rate_limit_error, retry_delay_from_error
+
+# Finish reasons, matching the Gemini API's enum values
+FINISH_STOP = 1
+FINISH_MAX_TOKENS = 2
+FINISH_SAFETY = 3
+FINISH_RECITATION = 4
+
+
+class BackendError(Exception):
+    """Base class for errors a backend reports about a request"""
+
+
+class RateLimitError(BackendError):
+    """
+    The provider rejected the request for quota reasons (HTTP 429).
+    code and retry_after are what backoff.is_rate_limit_error and
+    backoff.retry_delay_from_error look for.
+    """
+
+    code = 429
+
+    def __init__(self, message="Rate limit exceeded", retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class SafetyBlockedError(BackendError):
+    """The prompt or the answer was blocked by the provider's safety or recitation filters"""
+
+
+class TruncatedResponseError(BackendError):
+    """The answer hit the output token limit; text holds what was generated"""
+
+    def __init__(self, message="Response truncated", text=""):
+        super().__init__(message)
+        self.text = text
+
+
+class EmptyResponseError(BackendError):
+    """The response carried no usable candidate or content"""
+
+
+def check_response(response):
+    """
+    Text of a response's first candidate, or the typed error describing why
+    there isn't a complete answer.
+    """
+    if not response.candidates:
+        raise EmptyResponseError("No candidates in response")
+    candidate = response.candidates[0]
+    has_content = bool(candidate.content and candidate.content.parts)
+    if candidate.finish_reason == FINISH_STOP:
+        if not has_content:
+            raise EmptyResponseError("No content in response")
+        return response_text(response)
+    if candidate.finish_reason == FINISH_MAX_TOKENS:
+        raise TruncatedResponseError(text=response_text(response) if has_content else "")
+    if candidate.finish_reason == FINISH_SAFETY:
+        raise SafetyBlockedError("Blocked by safety filters")
+    if candidate.finish_reason == FINISH_RECITATION:
+        raise SafetyBlockedError("Blocked due to recitation")
+    raise EmptyResponseError(f"Unknown finish reason: {candidate.finish_reason}")
+
+
+class LLMBackend:
+    """
+    Interface every backend implements.
+
+    generate() returns a response with .candidates[0].finish_reason,
+    .candidates[0].content.parts[0].text and .usage_metadata. When
+    `cached_context` is given the prompt is only the part that follows the
+    cached prefix. `timeout` is the request's deadline in seconds, passed on
+    to the provider where it supports one. Quota rejections raise
+    RateLimitError and blocked prompts SafetyBlockedError.
+    """
+
+    model_name = None
+    supports_context_cache = False
+
+    async def generate(self, prompt, generation_config=None, safety_settings=None, cached_context=None,
+                       timeout=None):
+        raise NotImplementedError
+
+    async def stream(self, prompt, generation_config=None, safety_settings=None, cached_context=None,
+                     on_text=None, timeout=None):
+        """
+        Like generate(), but calls on_text(text_so_far) as fragments arrive and
+        returns the complete response at the end. Backends without streaming
+        report the whole text once.
+        """
+        response = await self.generate(prompt, generation_config, safety_settings, cached_context, timeout)
+        if on_text:
+            on_text(response_text(response))
+        return response
+
+    async def count_tokens(self, text):
+        """Prompt tokens `text` would cost; backends without a tokenizer estimate ~4 characters per token"""
+        return estimate_tokens(text)
+
+    async def create_context_cache(self, content, ttl_seconds):
+        """Register `content` as a reusable prompt prefix; returns a handle or None if unsupported"""
+        return None
+
+    async def delete_context_cache(self, handle):
+        pass
+
+
+class GeminiBackend(LLMBackend):
+    """
+    google-generativeai model, with explicit context caching via genai.caching.
+    The client's ResourceExhausted (429) errors are raised as RateLimitError.
+    """
+
+    supports_context_cache = True
+
+    def __init__(self, model, generation_config=None, safety_settings=None):
+        self.model = model
+        self.model_name = model.model_name
+        self.generation_config = generation_config
+        self.safety_settings = safety_settings
+        self._cached_models = {}
+
+    @staticmethod
+    def _check_prompt(response):
+        # A blocked prompt comes back with no candidates and a block reason in the feedback
+        feedback = getattr(response, "prompt_feedback", None)
+        if feedback is not None and getattr(feedback, "block_reason", 0):
+            raise SafetyBlockedError(f"Prompt blocked: {feedback.block_reason}")
+        return response
+
+    def _model_for(self, cached_context):
+        if cached_context is None:
+            return self.model
+        model = self._cached_models.get(cached_context.name)
+        if model is None:
+            import google.generativeai as genai
+            model = genai.GenerativeModel.from_cached_content(cached_content=cached_context)
+            self._cached_models[cached_context.name] = model
+        return model
+
+    @staticmethod
+    def _rate_limit_error(error):
+        """The client's quota error as a RateLimitError, keeping the server's advised retry delay"""
+        return RateLimitError(str(error) or "Resource exhausted", retry_after=retry_delay_from_error(error))
+
+    async def generate(self, prompt, generation_config=None, safety_settings=None, cached_context=None,
+                       timeout=None):
+        try:
+            response = await self._model_for(cached_context).generate_content_async(
+                prompt,
+                generation_config=generation_config or self.generation_config,
+                safety_settings=safety_settings or self.safety_settings,
+                request_options={"timeout": timeout} if timeout else None
+            )
+        except Exception as e:
+            if is_rate_limit_error(e):
+                raise self._rate_limit_error(e) from e
+            raise
+        return self._check_prompt(response)
+
+    async def stream(self, prompt, generation_config=None, safety_settings=None, cached_context=None,
+                     on_text=None, timeout=None):
+        try:
+            response = await self._model_for(cached_context).generate_content_async(
+                prompt,
+                generation_config=generation_config or self.generation_config,
+                safety_settings=safety_settings or self.safety_settings,
+                stream=True,
+                request_options={"timeout": timeout} if timeout else None
+            )
+            text = ""
+            async for fragment in response:
+                # .text raises on fragments without parts (e.g. the final safety-ratings chunk)
+                try:
+                    piece = fragment.text
+                except ValueError:
+                    piece = ""
+                if piece:
+                    text += piece
+                    if on_text:
+                        on_text(text)
+        except Exception as e:
+            if is_rate_limit_error(e):
+                raise self._rate_limit_error(e) from e
+            raise
+        # After iteration the response holds the merged candidate and usage metadata
+        return self._check_prompt(response)
+
+    async def count_tokens(self, text):
+        result = await self.model.count_tokens_async(text)
+        return result.total_tokens
+
+    async def create_context_cache(self, content, ttl_seconds):
+        from google.generativeai import caching
+
+        def create():
+            return caching.CachedContent.create(
+                model=self.model_name if self.model_name.startswith("models/") else f"models/{self.model_name}",
+                contents=[content],
+                ttl=datetime.timedelta(seconds=ttl_seconds),
+            )
+        try:
+            return await asyncio.to_thread(create)
+        except Exception as e:
+            # Content below the provider's minimum cacheable size, or caching unavailable for the model
+            print(f"⚠ Context cache not created: {e}")
+            return None
+
+    async def delete_context_cache(self, handle):
+        self._cached_models.pop(handle.name, None)
+        try:
+            await asyncio.to_thread(handle.delete)
+        except Exception:
+            pass
+
+
+def response_text(response):
+    """All text parts of a response's first candidate, joined (empty if there are none)"""
+    if not response.candidates:
+        return ""
+    content = response.candidates[0].content
+    if not content or not content.parts:
+        return ""
+    return "".join(getattr(part, "text", "") for part in content.parts)
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4) if text else 0
+
+
+def _response(text, finish_reason, prompt_tokens, cached_tokens, output_tokens):
+    return SimpleNamespace(
+        candidates=[SimpleNamespace(
+            finish_reason=finish_reason,
+            content=SimpleNamespace(parts=[SimpleNamespace(text=text)]),
+        )],
+        usage_metadata=SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            cached_content_token_count=cached_tokens,
+            candidates_token_count=output_tokens,
+            total_token_count=prompt_tokens + output_tokens,
+        ),
+    )
+
+
+class TokenBill:
+    """Running token and cost totals for a LocalBackend"""
+
+    def __init__(self, input_price, cached_price, output_price):
+        self.input_price = input_price
+        self.cached_price = cached_price
+        self.output_price = output_price
+        self.requests = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+        self.rate_limited = 0
+        self.truncated = 0
+
+    @property
+    def cost(self):
+        """Dollar cost at the configured per-million-token prices"""
+        uncached = self.input_tokens - self.cached_tokens
+        return (uncached * self.input_price + self.cached_tokens * self.cached_price
+                + self.output_tokens * self.output_price) / 1_000_000
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "input_tokens": self.input_tokens,
+            "cached_tokens": self.cached_tokens,
+            "output_tokens": self.output_tokens,
+            "rate_limited": self.rate_limited,
+            "truncated": self.truncated,
+            "cost": self.cost,
+        }
+
+
+def fixed_latency(seconds):
+    """LocalBackend latency: always `seconds`"""
+    return lambda rng: seconds
+
+
+def lognormal_latency(median, sigma=0.5, tail_rate=0.0, tail_factor=10.0):
+    """
+    LocalBackend latency: log-normal around `median`, with a `tail_rate`
+    fraction of stragglers taking `tail_factor` times longer.
+    """
+    def sample(rng):
+        seconds = median * math.exp(rng.gauss(0.0, sigma))
+        if tail_rate and rng.random() < tail_rate:
+            seconds *= tail_factor
+        return seconds
+    return sample
+
+
+class LocalBackend(LLMBackend):
+    """
+    Deterministic offline stand-in for the Gemini API.
+
+    Answers come from `responder(prompt, generation_config)`; the default
+    returns an empty answer (or a JSON object of empty strings when a
+    response schema is requested). Token billing follows the provider:
+    prompt tokens are estimated at ~4 characters each, an explicitly cached
+    context is billed at `cached_price`, and when `implicit_caching` is on a
+    prompt sharing at least `min_cache_tokens` of prefix with an earlier
+    prompt has that prefix billed as cached too.
+
+    For load tests it can also behave like a busy provider:
+    latency: seconds per request, or a function of a random.Random (see
+        fixed_latency and lognormal_latency)
+    quota_rpm / quota_tpm: server-side per-minute quotas; requests over them
+        raise RateLimitError with a Retry-After hint
+    rate_limit_rate / truncate_rate: fraction of requests answered with an
+        injected 429, or cut off with finish reason MAX_TOKENS
+    Answers longer than the request's max_output_tokens are truncated too.
+    Random choices come from a generator seeded with `seed`.
+    """
+
+    supports_context_cache = True
+
+    def __init__(self, responder=None, model_name="local-stand-in", min_cache_tokens=1024,
+                 implicit_caching=True, input_price=0.30, cached_price=0.075, output_price=2.50,
+                 latency=None, quota_rpm=None, quota_tpm=None, rate_limit_rate=0.0, truncate_rate=0.0,
+                 seed=0, clock=time.monotonic):
+        self.model_name = model_name
+        self.responder = responder or self.default_responder
+        self.min_cache_tokens = min_cache_tokens
+        self.implicit_caching = implicit_caching
+        self.bill = TokenBill(input_price, cached_price, output_price)
+        self.latency = latency if callable(latency) or latency is None else fixed_latency(latency)
+        self.quota_rpm = quota_rpm
+        self.quota_tpm = quota_tpm
+        self.rate_limit_rate = rate_limit_rate
+        self.truncate_rate = truncate_rate
+        self.clock = clock
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._seen_prefixes = set()
+        self._contexts = {}
+        # Server-side quota window of (arrival time, prompt tokens)
+        self._quota_window = deque()
+
+    @staticmethod
+    def default_responder(prompt, generation_config):
+        schema = (generation_config or {}).get("response_schema")
+        if schema:
+            return json.dumps({key: "" for key in schema.get("properties", {})})
+        return ""
+
+    def _prefix_hashes(self, text):
+        # Prefixes are compared at a fixed granularity, like provider cache blocks
+        step = self.min_cache_tokens * 4
+        return [
+            (length, hashlib.sha256(text[:length].encode("utf-8")).hexdigest())
+            for length in range(step, len(text) + 1, step)
+        ]
+
+    def _admit(self, prompt_tokens):
+        """Apply the simulated server quota and 429 injection to an arriving request"""
+        with self._lock:
+            now = self.clock()
+            while self._quota_window and self._quota_window[0][0] <= now - 60:
+                self._quota_window.popleft()
+            used = sum(tokens for _, tokens in self._quota_window)
+            over_rpm = self.quota_rpm is not None and len(self._quota_window) >= self.quota_rpm
+            over_tpm = self.quota_tpm is not None and used + prompt_tokens > self.quota_tpm
+            if over_rpm or over_tpm:
+                self.bill.rate_limited += 1
+                retry_after = self._quota_window[0][0] + 60 - now if self._quota_window else 1.0
+                raise RateLimitError("Simulated quota exceeded", retry_after=max(0.1, retry_after))
+            if self.rate_limit_rate and self._rng.random() < self.rate_limit_rate:
+                self.bill.rate_limited += 1
+                raise RateLimitError("Simulated 429", retry_after=1.0)
+            self._quota_window.append((now, prompt_tokens))
+            return self._rng.random() < self.truncate_rate, self.latency(self._rng) if self.latency else 0.0
+
+    async def generate(self, prompt, generation_config=None, safety_settings=None, cached_context=None,
+                       timeout=None):
+        context = ""
+        if cached_context is not None:
+            context = self._contexts[cached_context.name]
+        full_prompt = context + prompt
+        prompt_tokens = estimate_tokens(full_prompt)
+        truncate, latency = self._admit(prompt_tokens)
+        if latency:
+            await asyncio.sleep(latency)
+
+        text = self.responder(full_prompt, generation_config)
+        finish_reason = FINISH_STOP
+        max_output_tokens = (generation_config or {}).get("max_output_tokens")
+        if max_output_tokens and estimate_tokens(text) > max_output_tokens:
+            text, finish_reason = text[:max_output_tokens * 4], FINISH_MAX_TOKENS
+        elif truncate and text:
+            text, finish_reason = text[:len(text) // 2], FINISH_MAX_TOKENS
+        output_tokens = estimate_tokens(text)
+
+        with self._lock:
+            cached_tokens = estimate_tokens(context)
+            if self.implicit_caching and cached_context is None:
+                hashes = self._prefix_hashes(full_prompt)
+                for length, digest in hashes:
+                    if digest in self._seen_prefixes:
+                        cached_tokens = estimate_tokens(full_prompt[:length])
+                self._seen_prefixes.update(digest for _, digest in hashes)
+            self.bill.requests += 1
+            self.bill.input_tokens += prompt_tokens
+            self.bill.cached_tokens += cached_tokens
+            self.bill.output_tokens += output_tokens
+            if finish_reason == FINISH_MAX_TOKENS:
+                self.bill.truncated += 1
+        return _response(text, finish_reason, prompt_tokens, cached_tokens, output_tokens)
+
+    async def stream(self, prompt, generation_config=None, safety_settings=None, cached_context=None,
+                     on_text=None, timeout=None):
+        response = await self.generate(prompt, generation_config, safety_settings, cached_context, timeout)
+        text = response_text(response)
+        for end in range(0, len(text), 32):
+            await asyncio.sleep(0)
+            if on_text:
+                on_text(text[:end + 32])
+        return response
+
+    async def create_context_cache(self, content, ttl_seconds):
+        if estimate_tokens(content) < self.min_cache_tokens:
+            return None
+        name = "cachedContents/" + hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+        self._contexts[name] = content
+        return SimpleNamespace(name=name, expire_time=time.time() + ttl_seconds)
+
+    async def delete_context_cache(self, handle):
+        self._contexts.pop(handle.name, None)
+
+
+# OpenAI finish reasons mapped onto the Gemini ones used everywhere else
+OPENAI_FINISH_REASONS = {
+    "stop": FINISH_STOP,
+    "length": FINISH_MAX_TOKENS,
+    "content_filter": FINISH_SAFETY,
+}
+
+
+def json_schema_from_gemini(schema):
+    """A Gemini response_schema (OBJECT, STRING, ... type names) as standard JSON Schema"""
+    converted = {}
+    for key, value in schema.items():
+        if key == "type":
+            converted[key] = [value.lower(), "null"] if schema.get("nullable") else value.lower()
+        elif key == "nullable":
+            continue
+        elif key == "properties":
+            converted[key] = {name: json_schema_from_gemini(sub) for name, sub in value.items()}
+        elif key == "items":
+            converted[key] = json_schema_from_gemini(value)
+        else:
+            converted[key] = value
+    return converted
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """
+    Any server implementing the OpenAI chat completions API: a local vLLM,
+    llama.cpp or Ollama server, or a hosted one. Requests are plain HTTP via
+    urllib on a worker thread, so no extra client library is needed.
+    """
+
+    def __init__(self, base_url=None, model_name=None, api_key=None, generation_config=None):
+        self.base_url = (base_url or os.getenv("OPENAI_BASE_URL", "http://localhost:8000/v1")).rstrip("/")
+        self.model_name = model_name or os.getenv("OPENAI_MODEL", "local-model")
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.generation_config = generation_config or {}
+
+    def _payload(self, prompt, generation_config, stream):
+        config = generation_config or self.generation_config
+        payload = {"model": self.model_name, "messages": [{"role": "user", "content": prompt}]}
+        if "temperature" in config:
+            payload["temperature"] = config["temperature"]
+        if "top_p" in config:
+            payload["top_p"] = config["top_p"]
+        if "max_output_tokens" in config:
+            payload["max_tokens"] = config["max_output_tokens"]
+        if config.get("response_schema"):
+            payload["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "answer", "schema": json_schema_from_gemini(config["response_schema"])},
+            }
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    def _open(self, payload, timeout):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        request = urllib.request.Request(
+            f"{self.base_url}/chat/completions", data=json.dumps(payload).encode("utf-8"), headers=headers
+        )
+        try:
+            return urllib.request.urlopen(request, timeout=timeout)
+        except urllib.error.HTTPError as e:
+            body = e.read().decode("utf-8", "replace")[:500]
+            if e.code == 429:
+                retry_after = e.headers.get("Retry-After")
+                try:
+                    retry_after = float(retry_after) if retry_after else None
+                except ValueError:
+                    retry_after = None
+                raise RateLimitError(f"HTTP 429: {body}", retry_after=retry_after) from e
+            raise BackendError(f"HTTP {e.code}: {body}") from e
+
+    @staticmethod
+    def _to_response(text, finish_reason, usage):
+        usage = usage or {}
+        details = usage.get("prompt_tokens_details") or {}
+        return _response(
+            text,
+            OPENAI_FINISH_REASONS.get(finish_reason, FINISH_STOP),
+            usage.get("prompt_tokens", 0),
+            details.get("cached_tokens", 0) or 0,
+            usage.get("completion_tokens", 0),
+        )
+
+    async def generate(self, prompt, generation_config=None, safety_settings=None, cached_context=None,
+                       timeout=None):
+        def post():
+            with self._open(self._payload(prompt, generation_config, stream=False), timeout) as response:
+                return json.loads(response.read().decode("utf-8"))
+        data = await asyncio.to_thread(post)
+        choice = data["choices"][0]
+        return self._to_response(choice["message"].get("content") or "", choice.get("finish_reason"), data.get("usage"))
+
+    async def stream(self, prompt, generation_config=None, safety_settings=None, cached_context=None,
+                     on_text=None, timeout=None):
+        loop = asyncio.get_running_loop()
+
+        def read_events():
+            text, finish_reason, usage = "", None, None
+            with self._open(self._payload(prompt, generation_config, stream=True), timeout) as response:
+                # Server-sent events: one "data: {json}" line per fragment, then "data: [DONE]"
+                for raw in response:
+                    line = raw.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    event = json.loads(data)
+                    usage = event.get("usage") or usage
+                    for choice in event.get("choices") or []:
+                        piece = (choice.get("delta") or {}).get("content")
+                        if piece:
+                            text += piece
+                            if on_text:
+                                loop.call_soon_threadsafe(on_text, text)
+                        finish_reason = choice.get("finish_reason") or finish_reason
+            return text, finish_reason, usage
+
+        text, finish_reason, usage = await asyncio.to_thread(read_events)
+        return self._to_response(text, finish_reason, usage)
+
+    async def count_tokens(self, text):
+        # The chat completions API has no token counting endpoint
+        return estimate_tokens(text)
+
+
+class ContextCacheRegistry:
+    """
+    Provider-side context caches for prompt prefixes (instructions + page
+    content), shared across jobs so repeated questions about one page reuse
+    the same cached context until it expires. Expired entries are dropped on
+    the next lookup and their remote caches deleted, as are entries replaced
+    because they were about to expire.
+    """
+
+    # Leave a minute of slack so a request never references an expiring cache
+    EXPIRY_SLACK = 60
+
+    def __init__(self, ttl_seconds=3600):
+        self.ttl_seconds = ttl_seconds
+        # key -> (handle, expires_at, backend)
+        self._entries = {}
+        self._locks = {}
+
+    def _lock_for(self, key):
+        if key not in self._locks:
+            self._locks[key] = asyncio.Lock()
+        return self._locks[key]
+
+    async def _evict_expired(self, now):
+        """Forget expired entries and delete their remote caches"""
+        # Only once expired: a request sent just before the slack window may still be using the cache
+        expired = [key for key, (_, expires_at, _) in self._entries.items() if expires_at <= now]
+        deletes = []
+        for key in expired:
+            lock = self._locks.get(key)
+            if lock is not None and lock.locked():
+                # Being recreated right now
+                continue
+            handle, _, backend = self._entries.pop(key)
+            self._locks.pop(key, None)
+            if handle is not None:
+                deletes.append(backend.delete_context_cache(handle))
+        # Deleted before anything is recreated, so a recreated cache can't be caught by its old handle's delete
+        await asyncio.gather(*deletes)
+
+    async def get_or_create(self, backend, prefix):
+        """Handle for a cached prefix on `backend`, creating it if needed; None when caching isn't possible"""
+        if not backend.supports_context_cache:
+            return None
+        await self._evict_expired(time.time())
+        key = (backend.model_name, hashlib.sha256(prefix.encode("utf-8")).hexdigest())
+        async with self._lock_for(key):
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.time() + self.EXPIRY_SLACK:
+                return entry[0]
+            if entry is not None and entry[0] is not None:
+                # Superseded inside the slack window; deleted first, as for expired entries
+                await entry[2].delete_context_cache(entry[0])
+            handle = await backend.create_context_cache(prefix, self.ttl_seconds)
+            # Remember failures too, so content too small to cache isn't retried on every request
+            self._entries[key] = (handle, time.time() + self.ttl_seconds, backend)
+            return handle
@@ -0,0 +1,174 @@
+"""
+Persistent cache of LLM responses.
+
+Entries are keyed by a hash of everything that determines the answer: model
+name, generation config, safety settings and the rendered prompt. They live
+in a local SQLite file so Streamlit reruns, other sessions and re-run batches
+all share them. Negative results (confirmed empty or safety-blocked) are
+cached too, with a shorter TTL, and the file is kept under a size bound by
+evicting the least recently used entries.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(".cache", "llm_responses.sqlite3"))
+DEFAULT_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 86_400)))
+DEFAULT_NEGATIVE_TTL = float(os.getenv("LLM_CACHE_NEGATIVE_TTL", str(86_400)))
+DEFAULT_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+
+def make_cache_key(model_name, generation_config, safety_settings, prompt):
+    """Stable hash of every input that affects the model's answer"""
+    payload = json.dumps(
+        {
+            "model": model_name,
+            "generation_config": generation_config,
+            "safety_settings": safety_settings,
+            "prompt": prompt,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CachedResponse:
+    def __init__(self, text, negative):
+        self.text = text
+        self.negative = negative
+
+
+class ResponseCache:
+    """
+    SQLite-backed response store with TTLs and size-bounded LRU eviction.
+
+    One connection is shared behind a lock; calls are short, so callers on
+    the dispatch loop run them via asyncio.to_thread.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                negative INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                size INTEGER NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+
+    def get(self, key):
+        """Return a CachedResponse, or None if the key is missing or expired"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text, negative, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            text, negative, expires_at = row
+            if expires_at <= now:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        return CachedResponse(text, bool(negative))
+
+    def contains(self, key):
+        """True if the key has an unexpired entry; unlike get() it doesn't count as an access"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM responses WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return row is not None
+
+    def put(self, key, text, negative=False):
+        """Store a response; negative entries (empty or blocked) expire after negative_ttl"""
+        now = time.time()
+        ttl = self.negative_ttl if negative else self.ttl
+        size = len(key) + len(text.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, text, negative, expires_at, last_access, size) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, text, int(negative), now + ttl, now, size),
+            )
+            self._evict(now)
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop least recently used entries until we're back under the bound
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC"
+        ).fetchall():
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+
+class CacheStats:
+    """Per-job cache hit/miss counters"""
+
+    def __init__(self):
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def record_hit(self, negative=False):
+        self.hits += 1
+        if negative:
+            self.negative_hits += 1
+
+    def record_miss(self):
+        self.misses += 1
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def summary(self):
+        return (f"cache hits {self.hits} ({self.negative_hits} negative), misses {self.misses}, "
+                f"hit ratio {self.hit_ratio:.0%}")
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Process-wide cache at LLM_CACHE_PATH, or None when caching is disabled (LLM_CACHE_PATH="")"""
+    global _default_cache
+    if not DEFAULT_CACHE_PATH:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache()
+        return _default_cache
@@ -0,0 +1,91 @@
+"""
+Offline load test for the dispatch and rate-limit stack.
+
+Runs a parse job against llm_backend.LocalBackend set up like a busy
+provider (latency distribution, server-side quota, injected 429s and
+truncation) and prints throughput, latency and error counts. No API key
+is needed:
+
+    python loadtest.py --chunks 500 --server-rpm 300 --latency 0.8 --tail-rate 0.02 --hedge
+"""
+import argparse
+import os
+import time
+
+# Before importing parse: no Gemini client, and no persistent cache skewing the numbers
+os.environ.setdefault("LLM_BACKEND", "local")
+os.environ["LLM_CACHE_PATH"] = ""
+
+import parse
+from dispatch import percentile
+from llm_backend import LocalBackend, lognormal_latency
+from rate_limiter import RateLimits
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test parse_with_gemini against a simulated provider")
+    parser.add_argument("--chunks", type=int, default=200, help="Number of synthetic chunks")
+    parser.add_argument("--chunk-chars", type=int, default=4000, help="Characters per chunk")
+    parser.add_argument("--workers", type=int, default=64, help="Max requests in flight")
+    parser.add_argument("--no-adaptive", action="store_true", help="Fixed concurrency instead of AIMD")
+    parser.add_argument("--batch-size", type=int, default=1, help="Chunks per request")
+    parser.add_argument("--hedge", action="store_true", help="Hedge straggling requests")
+    parser.add_argument("--latency", type=float, default=0.5, help="Median request latency in seconds")
+    parser.add_argument("--sigma", type=float, default=0.5, help="Log-normal spread of the latency")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="Fraction of straggler requests")
+    parser.add_argument("--tail-factor", type=float, default=10.0, help="How much slower stragglers are")
+    parser.add_argument("--server-rpm", type=int, default=None, help="Simulated provider requests/minute quota")
+    parser.add_argument("--server-tpm", type=int, default=None, help="Simulated provider tokens/minute quota")
+    parser.add_argument("--client-rpm", type=int, default=None, help="Client-side limiter RPM (default: server RPM)")
+    parser.add_argument("--client-tpm", type=int, default=None, help="Client-side limiter TPM (default: server TPM)")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with a 429")
+    parser.add_argument("--truncate-rate", type=float, default=0.0, help="Fraction of answers cut off at MAX_TOKENS")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the simulated provider")
+    args = parser.parse_args(argv)
+
+    backend = LocalBackend(
+        responder=lambda prompt, config: "record",
+        latency=lognormal_latency(args.latency, args.sigma, args.tail_rate, args.tail_factor),
+        quota_rpm=args.server_rpm,
+        quota_tpm=args.server_tpm,
+        rate_limit_rate=args.rate_limit_rate,
+        truncate_rate=args.truncate_rate,
+        seed=args.seed,
+    )
+    parse.set_backend(backend, RateLimits(rpm=args.client_rpm or args.server_rpm,
+                                          tpm=args.client_tpm or args.server_tpm))
+
+    filler = "lorem ipsum dolor sit amet " * (args.chunk_chars // 27 + 1)
+    chunks = [f"Synthetic chunk {i}\n{filler[:args.chunk_chars]}" for i in range(args.chunks)]
+    completion_times = []
+    stats = {}
+
+    started = time.monotonic()
+    parse.parse_with_gemini(
+        chunks,
+        "records",
+        max_workers=args.workers,
+        adaptive=not args.no_adaptive,
+        use_cache=False,
+        stats=stats,
+        batch_size=args.batch_size,
+        hedge=args.hedge,
+        progress_callback=lambda completed, total: completion_times.append(time.monotonic() - started),
+    )
+    elapsed = time.monotonic() - started
+
+    bill = backend.bill
+    print()
+    print(f"Chunks:          {args.chunks} in {elapsed:.1f}s ({args.chunks / elapsed:.1f} chunks/s)")
+    if completion_times:
+        print(f"Completion time: first {completion_times[0]:.2f}s, p50 {percentile(completion_times, 50):.2f}s, "
+              f"p99 {percentile(completion_times, 99):.2f}s")
+    print(f"Requests:        {bill.requests} answered, {bill.rate_limited} rate limited, {bill.truncated} truncated")
+    print(f"Tokens:          {stats['tokens'].summary()}")
+    print(f"Simulated cost:  ${bill.cost:.4f}")
+    if "hedging" in stats:
+        print(f"Hedging:         {stats['hedging'].summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,230 @@
 import streamlit as st
 import time
-from scrape import (
-    scrape_website,
-    extract_body_content,
-    clean_body_content,
-    split_dom_content,
-)
-from parse import parse_with_gemini, parse_with_gemini_progress
+import os
+import secrets
+import uuid
+from urllib.parse import urlparse
+from scrape import split_dom_content
+from parse import rate_limiter, AdaptiveConcurrency, cascade_available, chunk_size_for
+from records import RecordMerger, RecordSchema, infer_schema, records_to_csv
+from planner import plan_parse
+from rate_limiter import DEFAULT_TIER, RateLimiter, RateLimits
+from dispatch import Tenant
+from job_store import JOB_RUNNING, get_job_store
+from worker import JOB_CANCELLED, JOB_FAILED, get_job_runner
+
+# Seconds between refreshes of a running job's progress
+POLL_INTERVAL = 0.5
+
+runner = get_job_runner()
+
+
+def session_owner():
+    """
+    This tab's unguessable owner token, kept in the URL so a reloaded tab still
+    finds its jobs; only jobs submitted with it are listed or resumed.
+    """
+    owner = st.query_params.get("owner")
+    if not owner:
+        owner = secrets.token_urlsafe(16)
+        st.query_params["owner"] = owner
+    return owner
+
+
+def session_job(key):
+    """This session's scrape_job / parse_job, if the runner still has it"""
+    job = runner.get(st.session_state.get(key))
+    if job is None:
+        st.session_state.pop(key, None)
+    return job
+
+
+def attach_job(job):
+    """Show button callback: follow a job this tab started before it was reloaded"""
+    st.session_state[f"{job.kind}_job"] = job.id
+
+
+@st.fragment(run_every=POLL_INTERVAL)
+def watch_job(job_id, render):
+    """Re-render a running job every POLL_INTERVAL; a full rerun shows the outcome once it's over"""
+    job = runner.get(job_id)
+    if job is None or job.finished:
+        st.rerun()
+    render(job)
+    st.button("⏹ Stop", key=f"stop-{job.id}", on_click=job.cancel,
+              help="Stop the running job and keep what has finished")
+
+
+def session_tenant():
+    """This session's Tenant: its parse jobs take fair turns with other sessions for the API quota"""
+    if "tenant" not in st.session_state:
+        session_rpm = os.getenv("SESSION_RPM")
+        limiter = RateLimiter(RateLimits(rpm=int(session_rpm))) if session_rpm else None
+        st.session_state.tenant = Tenant(f"session-{uuid.uuid4().hex[:8]}", limiter=limiter)
+    return st.session_state.tenant
+
+
+def resume_job(job_id):
+    """Resume button callback: reload an unfinished job's content and settings for Parse Content"""
+    store = get_job_store()
+    job = store.get(job_id)
+    if job is None or job.owner != session_owner():
+        return
+    st.session_state.dom_content = "".join(store.chunks(job_id))
+    st.session_state.scraped_url = job.source or "an interrupted job"
+    st.session_state.current_url = job.source or ""
+    st.session_state.scrape_timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job.created_at))
+    questions = not isinstance(job.description, str)
+    st.session_state.multiple_questions = questions
+    st.session_state.parse_description = "\n".join(job.description) if questions else job.description
+    st.session_state.structured = bool(job.settings.get("schema"))
+    st.session_state.fields_spec = job.settings.get("schema") or ""
+
+
+# Rough progress through a scrape by the stage it has reached
+SCRAPE_PROGRESS = {"Scraping the website": 0.3, "Extracting content": 0.6, "Cleaning content": 0.8}
+
+
+def show_scrape_progress(job):
+    st.progress(SCRAPE_PROGRESS.get(job.stage, 0.1))
+    st.text(f"🔍 {job.stage}... {job.elapsed:.0f}s")
+
+
+def finish_scrape(job):
+    """Move a finished scrape's content into the session and report how it went"""
+    del st.session_state.scrape_job
+    if job.status == JOB_CANCELLED:
+        st.warning("⏹ Scraping stopped")
+    elif job.status == JOB_FAILED:
+        st.error(f"Error scraping website: {job.error}")
+    else:
+        st.session_state.dom_content = job.result
+        st.session_state.scraped_url = job.label
+        st.session_state.current_url = job.label
+        st.session_state.scrape_timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job.finished_at))
+        st.success(f" Successfully scraped: {job.label}")
+        
+        # Display the DOM content in an expandable text box
+        with st.expander("View DOM Content"):
+            st.text_area("DOM Content", job.result, height=300)
+
+
+def show_released(job):
+    """Results released so far, in chunk order: a table in structured mode"""
+    if job.meta.get("questions"):
+        return
+    schema = job.meta.get("schema")
+    if schema is not None:
+        merger = RecordMerger(schema)
+        for _, records in job.released():
+            merger.add(records)
+        st.dataframe(merger.records, use_container_width=True)
+    else:
+        texts = [result for _, result in job.released() if result]
+        if texts:
+            st.markdown("\n\n".join(texts))
+
+
+def show_parse_progress(job):
+    progress_col1, progress_col2 = st.columns([3, 1])
+    with progress_col1:
+        # 0.1 to 0.9 while chunks complete
+        st.progress(min(0.9, 0.1 + job.fraction * 0.8))
+        if job.completed:
+            st.text(f" Processing chunks... ({job.completed}/{job.total})")
+        else:
+            st.text("🤖 Starting AI processing...")
+    with progress_col2:
+        st.write(f"**📊 {job.total} chunks**")
+        concurrency = job.meta.get("concurrency")
+        if concurrency:
+            st.write(f"**👥 {concurrency.limit} in flight**")
+        else:
+            st.write(f"**👥 {job.meta.get('max_workers')} workers**")
+        st.write(f"**⏱ {job.elapsed:.1f}s**")
+        if 0 < job.completed < job.total:
+            st.write(f"**🎯 ETA: {job.elapsed / job.completed * (job.total - job.completed):.1f}s**")
+    tenant = job.meta.get("tenant")
+    if tenant is not None and tenant.position:
+        # Other sessions are using the shared quota too
+        st.caption(f"{tenant.position} requests ahead in the shared queue")
+    show_released(job)
+    if job.partial:
+        chunk_index, text = job.partial
+        st.caption(f"Chunk {chunk_index + 1} (streaming): {text}")
+
+
+def show_parse_report(job):
+    """Outcome of a finished parse job: what it did and its results"""
+    if job.status == JOB_FAILED:
+        st.error(f"Error during parsing: {job.error}")
+        return
+    questions = job.meta.get("questions")
+    schema = job.meta.get("schema")
+    tenant = job.meta.get("tenant")
+    job_stats = job.stats
+    st.session_state.parsed_results = job.result
+    
+    if "cancelled" in job_stats:
+        cancelled = job_stats["cancelled"]
+        st.warning(f"⏹ Stopped after {cancelled['completed']} of {job.total} chunks; showing partial results")
+    elif job.status == JOB_CANCELLED:
+        st.warning("⏹ Parsing stopped before it started")
+        return
+    else:
+        st.success(f"✅ Parsing completed in {job.elapsed:.1f}s!")
+        if st.session_state.get("celebrated") != job.id:
+            # Celebrate once, not on every rerun that shows the results again
+            st.session_state.celebrated = job.id
+            st.balloons()
+    if job_stats.get("job", {}).get("resumed"):
+        st.caption(f"Resumed an interrupted job: {job_stats['job']['resumed']} of {job.total} "
+                   f"chunks were already done")
+    if "cache" in job_stats:
+        st.caption(f"Response {job_stats['cache'].summary()}")
+    if "tokens" in job_stats:
+        st.caption(f"Token usage: {job_stats['tokens'].summary()}")
+    if "cascade" in job_stats:
+        for tier in job_stats["cascade"].tiers:
+            st.caption(f"Model tier {tier.summary()}")
+    if tenant is not None and tenant.total_wait:
+        st.caption(f"Shared queue: {tenant.summary()}")
+    if "coverage" in job_stats:
+        coverage = job_stats["coverage"]
+        if coverage.timed_out:
+            st.warning(f"⏱ Time budget reached: {coverage.summary()}")
+        else:
+            st.caption(f"Coverage: {coverage.summary()}")
+    if "records" in job_stats:
+        st.caption(f"Table: {job_stats['records'].summary()}")
+    if "splits" in job_stats:
+        splits = job_stats["splits"]
+        st.caption(f"Split {splits['count']} truncated chunks and retried the halves; "
+                   f"chunks for this site are now {splits['chunk_size']} characters")
+    if "hedging" in job_stats:
+        st.caption(f"Hedging: {job_stats['hedging'].summary()}")
+    if "early_stop" in job_stats:
+        early_stop = job_stats["early_stop"]
+        st.caption(f"Stopped early: {early_stop['skipped']} chunks not started, "
+                   f"{early_stop['cancelled']} cancelled in flight")
+    
+    st.write("**Results:**")
+    if questions:
+        # One result set per question, in the order they were asked
+        for question, answer in zip(questions, job.result):
+            st.write(f"**{question}**")
+            st.write(answer)
+    elif schema:
+        st.dataframe(job.result, use_container_width=True)
+        st.download_button(
+            "Download CSV",
+            records_to_csv(job.result, schema),
+            file_name="records.csv",
+            mime="text/csv"
+        )
+    else:
+        st.write(job.result)
+
 
 # Streamlit UI
 st.title("AI Web Scraper")
@@ -19,56 +237,51 @@ if url and 'current_url' in st.session_state and st.session_state.current_url !=
         del st.session_state.dom_content
     if 'parsed_results' in st.session_state:
         del st.session_state.parsed_results
+    st.session_state.pop("parse_job", None)
     st.info("🔄 New URL detected - previous content cleared")
 
 # Store current URL
 if url:
     st.session_state.current_url = url
 
+job_store = get_job_store()
+owner = session_owner()
+if "dom_content" not in st.session_state and job_store is not None:
+    # Parses cut short by a restart, a reloaded tab or Stop: their finished chunks are checkpointed
+    running = {job.label for job in runner.jobs(kind="parse", active=True, owner=owner)}
+    for job in job_store.unfinished(limit=3, owner=owner):
+        if job.status == JOB_RUNNING and job.source in running:
+            # Still going on a background worker; it's offered below
+            continue
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            st.caption(f"Unfinished parse of {job.source or 'unknown source'}: {job.summary()}")
+        with col2:
+            st.button("↻ Resume", key=f"resume-{job.job_id}", on_click=resume_job, args=(job.job_id,),
+                      help="Reload this job's content and description; Parse Content then only sends the "
+                           "chunks that have no result yet")
+
+# Jobs outlive reruns and reloaded tabs: offer to follow the ones still running
+if "scrape_job" not in st.session_state and "parse_job" not in st.session_state:
+    for job in runner.jobs(active=True, owner=owner):
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            st.caption(f"Running in the background: {job.summary()}")
+        with col2:
+            st.button("Show", key=f"attach-{job.id}", on_click=attach_job, args=(job,))
+
 # Step 1: Scrape the Website
 if st.button("Scrape Website"):
     if url:
-        # Create progress bar and status
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-        
-        try:
-            status_text.text("🌐 Initializing web scraper...")
-            progress_bar.progress(0.10)  # 10%
-            
-            status_text.text("🔍 Scraping the website...")
-            progress_bar.progress(0.30)  # 30%
-            
-            # Scrape the website
-            dom_content = scrape_website(url)
-            progress_bar.progress(0.60)  # 60%
-            
-            status_text.text("📄 Extracting content...")
-            body_content = extract_body_content(dom_content)
-            progress_bar.progress(0.80)  # 80%
-            
-            status_text.text("🧹 Cleaning content...")
-            cleaned_content = clean_body_content(body_content)
-            progress_bar.progress(0.90)  # 90%
-
-            # Store the DOM content and URL in Streamlit session state
-            st.session_state.dom_content = cleaned_content
-            st.session_state.scraped_url = url
-            st.session_state.scrape_timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-
-            progress_bar.progress(1.0)  # 100%
-            status_text.text(" Scraping completed successfully!")
-            
-            st.success(f" Successfully scraped: {url}")
-            
-            # Display the DOM content in an expandable text box
-            with st.expander("View DOM Content"):
-                st.text_area("DOM Content", cleaned_content, height=300)
-                
-        except Exception as e:
-            progress_bar.progress(0.0)  # 0%
-            status_text.text(" Scraping failed!")
-            st.error(f"Error scraping website: {str(e)}")
+        # Runs on a background worker, so reruns and the Stop button don't block on it
+        st.session_state.scrape_job = runner.submit_scrape(url, meta={"owner": owner}).id
+
+scrape_job = session_job("scrape_job")
+if scrape_job is not None:
+    if scrape_job.finished:
+        finish_scrape(scrape_job)
+    else:
+        watch_job(scrape_job.id, show_scrape_progress)
 
 
 # Step 2: Ask Questions About the DOM Content
@@ -80,109 +293,174 @@ if "dom_content" in st.session_state:
         st.caption(f"Scraped at: {st.session_state.get('scrape_timestamp', 'Unknown time')}")
     with col2:
         if st.button(" Clear", help="Clear scraped content and start fresh"):
-            for key in ['dom_content', 'scraped_url', 'scrape_timestamp', 'parsed_results', 'current_url']:
+            for key in ['dom_content', 'scraped_url', 'scrape_timestamp', 'parsed_results', 'current_url', 'parse_job']:
                 if key in st.session_state:
                     del st.session_state[key]
             st.rerun()
     
-    parse_description = st.text_area("Describe what you want to parse")
+    # Sites whose chunks were truncated before get smaller chunks up front
+    domain = urlparse(st.session_state.get("current_url", "")).netloc
+    
+    multiple_questions = st.checkbox(
+        "Ask several questions (one per line)",
+        key="multiple_questions",
+        help="All questions are answered in the same pass over the content, one request per chunk."
+    )
+    parse_description = st.text_area("Describe what you want to parse", key="parse_description")
+    if multiple_questions:
+        questions = [line.strip() for line in parse_description.splitlines() if line.strip()]
+    else:
+        questions = None
+    
+    structured = st.checkbox(
+        "Return a table",
+        key="structured",
+        disabled=bool(questions),
+        help="Extract records with fixed fields as JSON, then validate and deduplicate them locally."
+    ) and not questions
+    schema = None
+    if structured:
+        fields_spec = st.text_input(
+            "Fields (leave empty to infer from the description)",
+            key="fields_spec",
+            placeholder="name*, price:number, url",
+            help="Comma-separated field names with an optional :string, :number, :integer or :boolean type. "
+                 "Fields marked * identify a record when removing duplicates."
+        )
+        try:
+            schema = RecordSchema.parse(fields_spec) if fields_spec.strip() else infer_schema(parse_description)
+            st.caption(f"Columns: {schema.describe()}; duplicates matched on {', '.join(schema.key_fields)}")
+        except ValueError as e:
+            st.error(str(e))
     
     # Add a slider for controlling parallel processing
     col1, col2 = st.columns(2)
     with col1:
+        adaptive = st.checkbox(
+            "Adaptive concurrency",
+            value=True,
+            help="Grow the number of requests in flight while the API keeps up and back off on rate limits or slowdowns."
+        )
+        # The rate limiter paces requests, so paid tiers can keep hundreds in flight
+        worker_ceiling = 5 if DEFAULT_TIER == "free" else 256
         max_workers = st.slider(
-            "Parallel Workers", 
+            "Max Parallel Workers" if adaptive else "Parallel Workers", 
             min_value=1, 
-            max_value=5, 
-            value=2, 
-            help="Number of parallel threads. Free tier: max 3 workers recommended to avoid rate limits."
+            max_value=worker_ceiling, 
+            value=worker_ceiling if adaptive else 2, 
+            help="Upper bound on requests in flight (a fixed count when adaptive concurrency is off). "
+                 "Requests are paced by the rate limiter for your API tier (GEMINI_TIER)."
+        )
+        batch_size = st.number_input(
+            "Chunks per request",
+            min_value=1,
+            max_value=16,
+            value=1,
+            help="Pack several chunks into one request. Saves request quota when it is the bottleneck."
+        )
+        context_cache = st.checkbox(
+            "Cache page content with the provider",
+            help="Keeps the page content in Gemini's context cache, so follow-up questions about the same page "
+                 "are billed mostly at the cached-token rate."
+        )
+        result_limit = st.number_input(
+            "Stop after this many results (0 = no limit)",
+            min_value=0,
+            value=0,
+            disabled=bool(questions),
+            help="For bounded questions like \"the phone number\" or \"first 20 products\": remaining chunks "
+                 "are skipped once enough results have been found."
+        )
+        relevant_first = st.checkbox(
+            "Most relevant chunks first",
+            help="Process the chunks that best match the description first instead of in page order."
+        )
+        cascade = st.checkbox(
+            "Cheap model first",
+            disabled=bool(questions) or structured or not cascade_available(),
+            help="Send chunks to gemini-2.5-flash-lite first and escalate only truncated, malformed or "
+                 "suspiciously empty answers to gemini-2.5-flash. Only available with the Gemini backend."
+        ) and cascade_available()
+        time_budget = st.number_input(
+            "Time budget in seconds (0 = no deadline)",
+            min_value=0,
+            value=0,
+            help="Return what has been found when time runs out. The most relevant chunks go first and "
+                 "chunk packing, model and concurrency are chosen to cover as much as possible in time."
+        )
+        hedge = st.checkbox(
+            "Hedge slow requests",
+            help="Send a duplicate of any request that is much slower than usual when the rate limit has room, "
+                 "and keep whichever answer arrives first."
         )
     with col2:
-        if max_workers > 3:
-            st.warning(f" {max_workers} workers may hit rate limits on free tier")
+        if adaptive:
+            st.info(f" Adaptive concurrency up to {max_workers} requests on the {DEFAULT_TIER} tier")
         else:
-            st.info(f" {max_workers} workers - good for free tier")
+            st.info(f" {max_workers} concurrent requests on the {DEFAULT_TIER} tier")
+        headroom = rate_limiter.headroom()
+        if headroom["requests_per_minute"] is not None:
+            st.caption(f"Rate limit headroom: {headroom['requests_per_minute']} requests this minute")
+        if headroom["tokens_per_minute"] is not None:
+            st.caption(f"Token headroom: {headroom['tokens_per_minute']:,} tokens this minute")
         
-        estimated_time = len(st.session_state.get('dom_content', '')) // 4000 * 7  # Rough estimate
-        st.caption(f"Estimated time: ~{estimated_time}s")
+        if parse_description and not (structured and schema is None):
+            # Dry run of the job with the current settings: nothing is sent
+            plan = plan_parse(
+                split_dom_content(st.session_state.dom_content, max_length=chunk_size_for(domain)),
+                questions if questions else parse_description,
+                max_workers=max_workers,
+                adaptive=adaptive,
+                batch_size=batch_size,
+                schema=schema,
+                limit=None if questions else (result_limit or None)
+            )
+            st.caption(f"Plan: {plan.summary()}")
+            with st.expander("Plan details"):
+                st.write(f"**{plan.requests}** requests, up to **{plan.max_in_flight}** in flight, "
+                         f"{plan.cached_chunks} of {plan.chunks} chunks already cached")
+                for name, saving in plan.savings.items():
+                    status = "" if saving.applied else " (not enabled)"
+                    st.write(f"Saved by {name}{status}: {saving.summary()}")
+                for warning in plan.warnings:
+                    st.warning(warning)
 
     if st.button("Parse Content"):
-        if parse_description:
-            # Create progress tracking elements
-            progress_col1, progress_col2 = st.columns([3, 1])
-            
-            with progress_col1:
-                progress_bar = st.progress(0)
-                status_text = st.empty()
-            
-            with progress_col2:
-                progress_details = st.empty()
-                time_elapsed = st.empty()
-            
-            # Start timing
-            start_time = time.time()
-            
-            try:
-                status_text.text(" Initializing parsing...")
-                progress_bar.progress(0.05)  # 5%
-                
-                status_text.text(" Splitting content into chunks...")
-                dom_chunks = split_dom_content(st.session_state.dom_content)
-                progress_bar.progress(0.10)  # 10%
-                
-                progress_details.write(f"**📊 {len(dom_chunks)} chunks**")
-                progress_details.write(f"**👥 {max_workers} workers**")
-                
-                # Create a custom progress callback
-                def update_progress(completed, total):
-                    elapsed = time.time() - start_time
-                    # Convert to 0-1 scale for Streamlit progress bar
-                    progress_percentage = min(0.9, 0.1 + (completed / total) * 0.8)  # 0.1 to 0.9
-                    progress_bar.progress(progress_percentage)
-                    
-                    # Calculate ETA
-                    if completed > 0:
-                        eta = (elapsed / completed) * (total - completed)
-                        status_text.text(f" Processing chunks... ({completed}/{total})")
-                        time_elapsed.write(f"**⏱ {elapsed:.1f}s**")
-                        if eta > 0:
-                            time_elapsed.write(f"**🎯 ETA: {eta:.1f}s**")
-                    else:
-                        status_text.text("🤖 Starting AI processing...")
-                        time_elapsed.write(f"**⏱️ {elapsed:.1f}s**")
-                
-                status_text.text(" Starting AI processing...")
-                
-                # Show a spinner while processing
-                with st.spinner(" AI is thinking..."):
-                    # Parse the content with Gemini using parallel processing
-                    parsed_result = parse_with_gemini_progress(
-                        dom_chunks, 
-                        parse_description, 
-                        max_workers=max_workers,
-                        progress_callback=update_progress
-                    )
-                
-                progress_bar.progress(0.95)  # 95%
-                status_text.text("💾 Saving results...")
-                
-                # Store the parsed result
-                st.session_state.parsed_results = parsed_result
-                
-                final_time = time.time() - start_time
-                progress_bar.progress(1.0)  # 100%
-                status_text.text("✅ Parsing completed successfully!")
-                time_elapsed.write(f"**✅ Done in {final_time:.1f}s**")
-                
-                # Celebrate with balloons if it was successful
-                st.balloons()
-                
-                st.success("✅ Parsing completed!")
-                st.write("**Results:**")
-                st.write(parsed_result)
-                
-            except Exception as e:
-                progress_bar.progress(0.0)  # 0%
-                status_text.text("❌ Parsing failed!")
-                time_elapsed.write("**❌ Failed**")
-                st.error(f"Error during parsing: {str(e)}")
\ No newline at end of file
+        if parse_description and not (structured and schema is None):
+            dom_chunks = split_dom_content(st.session_state.dom_content, max_length=chunk_size_for(domain))
+            concurrency = AdaptiveConcurrency(ceiling=max_workers) if adaptive else None
+            tenant = session_tenant()
+            # Runs on a background worker: widget changes and reruns no longer abandon the job
+            job = runner.submit_parse(
+                dom_chunks,
+                questions if questions else parse_description,
+                label=st.session_state.get("scraped_url"),
+                meta={"questions": questions, "schema": schema, "concurrency": concurrency,
+                      "tenant": tenant, "max_workers": max_workers, "owner": owner},
+                stream_partial=not (questions or schema),
+                max_workers=max_workers,
+                adaptive=adaptive,
+                concurrency=concurrency,
+                batch_size=batch_size,
+                context_cache=context_cache,
+                limit=None if questions else (result_limit or None),
+                order="relevance" if relevant_first else "document",
+                hedge=hedge,
+                cascade=cascade and not questions and not schema,
+                schema=schema,
+                domain=domain,
+                deadline=time_budget or None,
+                tenant=tenant,
+                job_store=job_store,
+                source=st.session_state.get("scraped_url"),
+                owner=owner
+            )
+            st.session_state.parse_job = job.id
+
+# Step 3: Follow the parse job until it finishes, then keep showing its results
+parse_job = session_job("parse_job")
+if parse_job is not None:
+    if parse_job.finished:
+        show_parse_report(parse_job)
+    else:
+        watch_job(parse_job.id, show_parse_progress)
@@ -1,15 +1,36 @@
 import google.generativeai as genai
 import os
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
-import time
+import asyncio
+import json
+import math
 import random
+import re
+import time
+from rate_limiter import MINUTE, RateLimits, apply_env_overrides, get_rate_limiter, make_rate_limiter, TokenEstimator
+from backoff import BackoffController, QuotaExhaustedError, RetryBudget, get_backoff_controller, is_rate_limit_error
+from dispatch import (DEFAULT_MAX_IN_FLIGHT, CallbackRelay, ConcurrencyWindow, DispatchEngine, HedgePolicy, Tenant,
+                      LatencyTracker, ReorderBuffer, hedged, run_sync)
+from llm_cache import CacheStats, get_response_cache, make_cache_key
+from llm_backend import (ContextCacheRegistry, EmptyResponseError, GeminiBackend, LocalBackend,
+                         OpenAICompatibleBackend, SafetyBlockedError, TruncatedResponseError, check_response)
+from cascade import (DEFAULT_CASCADE, STATUS_BLOCKED, STATUS_FAILED, STATUS_OK, STATUS_TRUNCATED, ModelCascade,
+                     ModelRoute, parse_confidence, self_check_template)
+from records import RecordMerger, RecordSchema, infer_schema
+from deadline import CoverageReport, DeadlineScheduler, DeadlineSkipped
+from job_store import JOB_COMPLETE, JOB_INTERRUPTED, get_job_store, make_job_id
 
 load_dotenv()
 
+# Which LLMBackend serves requests: "gemini" (default), "openai" for an OpenAI-compatible
+# server at OPENAI_BASE_URL, or "local" for the offline stand-in
+BACKEND_KIND = os.getenv("LLM_BACKEND", "gemini")
+if BACKEND_KIND not in ("gemini", "openai", "local"):
+    raise ValueError(f"Unknown LLM_BACKEND '{BACKEND_KIND}'. Choose from: gemini, openai, local")
+
 # Configure Gemini API
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+if BACKEND_KIND == "gemini":
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
 # Configure safety settings to be more permissive for web scraping content
 safety_settings = [
@@ -31,44 +52,19 @@ safety_settings = [
     }
 ]
 
-# Rate limiting globals
-_last_request_time = 0
-_request_lock = threading.Lock()
-_request_count = 0
-_request_window_start = 0
+MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
 
-def wait_for_rate_limit():
-    """Implement rate limiting to respect API quotas"""
-    global _last_request_time, _request_count, _request_window_start
-    
-    with _request_lock:
-        current_time = time.time()
-        
-        # Reset counter if window has passed (60 seconds)
-        if current_time - _request_window_start > 60:
-            _request_count = 0
-            _request_window_start = current_time
-        
-        # If we're approaching the limit (8 out of 10), add delay
-        if _request_count >= 8:
-            wait_time = 60 - (current_time - _request_window_start) + 1
-            if wait_time > 0:
-                print(f"⏳ Rate limit protection: waiting {wait_time:.1f} seconds...")
-                time.sleep(wait_time)
-                _request_count = 0
-                _request_window_start = time.time()
-        
-        # Ensure minimum delay between requests
-        time_since_last = current_time - _last_request_time
-        min_delay = 6.5  # Slightly more than 60/10 to be safe
-        if time_since_last < min_delay:
-            delay = min_delay - time_since_last + random.uniform(0.5, 1.5)  # Add jitter
-            time.sleep(delay)
-        
-        _last_request_time = time.time()
-        _request_count += 1
+# Shared limiter for every worker in this process (tier set via GEMINI_TIER). Other
+# backends have no published quota: they are only limited by GEMINI_RPM etc. if set.
+if BACKEND_KIND == "gemini":
+    rate_limiter = get_rate_limiter(MODEL_NAME)
+else:
+    rate_limiter = make_rate_limiter(apply_env_overrides(RateLimits()), BACKEND_KIND)
+token_estimator = TokenEstimator()
+# Shared 429 pause and circuit breaker for the same quota
+backoff = get_backoff_controller(MODEL_NAME)
 
-model = genai.GenerativeModel('gemini-2.5-flash', safety_settings=safety_settings)
+model = genai.GenerativeModel(MODEL_NAME, safety_settings=safety_settings) if BACKEND_KIND == "gemini" else None
 
 # Generation configuration
 generation_config = {
@@ -78,179 +74,1434 @@ generation_config = {
     "max_output_tokens": 4096,  # Increased to handle larger responses
 }
 
-template = (
-    "Extract only the information that matches this description: {parse_description}\n\n"
-    "From this content: {dom_content}\n\n"
+# Every request goes through the backend; swap in llm_backend.LocalBackend to run offline
+if BACKEND_KIND == "openai":
+    backend = OpenAICompatibleBackend(generation_config=generation_config)
+elif BACKEND_KIND == "local":
+    backend = LocalBackend(model_name=MODEL_NAME)
+else:
+    backend = GeminiBackend(model, generation_config, safety_settings)
+
+# Provider-side caches of page content, shared by every job in the process
+context_caches = ContextCacheRegistry()
+
+
+def set_backend(new_backend, limits=None):
+    """
+    Route all parse requests through another LLMBackend (e.g. a LocalBackend for offline runs).
+    With limits (a RateLimits) the shared rate limiter and backoff controller are replaced
+    too, so the client-side quota matches the new backend.
+    """
+    global backend, rate_limiter, backoff
+    backend = new_backend
+    if limits is not None:
+        rate_limiter = make_rate_limiter(limits, new_backend.model_name)
+        backoff = BackoffController()
+
+
+def default_route():
+    """ModelRoute for the configured backend, guarded by MODEL_NAME's limiter and backoff"""
+    return ModelRoute(backend, rate_limiter, backoff, generation_config)
+
+
+def cascade_available():
+    """True when requests go to Gemini, whose model tiers gemini_cascade() routes between"""
+    return isinstance(backend, GeminiBackend)
+
+
+def gemini_cascade(model_names=DEFAULT_CASCADE, policy=None):
+    """ModelCascade over Gemini models, cheapest first, each with its own rate limiter"""
+    routes = []
+    for name in model_names:
+        config = dict(generation_config)
+        gemini_model = genai.GenerativeModel(name, safety_settings=safety_settings)
+        routes.append(ModelRoute(GeminiBackend(gemini_model, config, safety_settings), generation_config=config))
+    return ModelCascade(routes, policy)
+
+# Latencies of recent requests across jobs, which set the hedging threshold and deadline plans
+request_latencies = LatencyTracker()
+
+# Seconds before a single generate call is abandoned and retried
+REQUEST_TIMEOUT = float(os.getenv("GEMINI_REQUEST_TIMEOUT", "120"))
+
+# Batched prompts: prompt size cap and the larger output budget shared by their sections
+MAX_BATCH_TOKENS = 24_000
+BATCH_MAX_OUTPUT_TOKENS = 8192
+
+# Truncated chunks are split in two and retried, at most this many times over,
+# and never into pieces smaller than MIN_SPLIT_CHARS
+MAX_SPLIT_DEPTH = 3
+MIN_SPLIT_CHARS = 500
+# Upper bound for per-chunk output budgets sized from observed output density
+MAX_OUTPUT_TOKENS_CEILING = 16_384
+
+# Chunk size learned per site: lowered whenever a chunk from that domain is truncated
+chunk_sizes = {}
+
+
+def chunk_size_for(domain, default=4000):
+    """Chunk size (characters) to split content from `domain` into"""
+    return chunk_sizes.get(domain, default) if domain else default
+
+# Prompts are laid out static instructions -> page content -> question, so every
+# question about the same content shares one long prefix that the provider can cache.
+prompt_instructions = (
+    "You extract information from web page content.\n\n"
     "Rules:\n"
     "- Return only the requested data\n"
     "- No explanations or extra text\n"
     "- If no match found, return empty string\n"
     "- Be concise and direct\n\n"
+)
+
+content_template = "Content:\n{dom_content}\n\n"
+
+question_template = (
+    "Extract only the information that matches this description: {parse_description}\n\n"
     "Response:"
 )
 
+template = prompt_instructions + content_template + question_template
 
-def process_single_chunk(chunk_data):
-    """Process a single chunk with rate limiting and retry logic"""
-    chunk_index, chunk, parse_description = chunk_data
-    
-    prompt = template.format(dom_content=chunk, parse_description=parse_description)
+
+def prompt_prefix(dom_content):
+    """Static instructions followed by the page content: the cacheable part of a prompt"""
+    return prompt_instructions + content_template.format(dom_content=dom_content)
+
+
+def build_prompt(dom_content, parse_description):
+    """Full single-question prompt; identical to template.format(...)"""
+    return prompt_prefix(dom_content) + question_template.format(parse_description=parse_description)
+
+
+def split_chunk(text):
+    """Split text in two at the paragraph, line, sentence or word boundary nearest its middle"""
+    middle = len(text) // 2
+    for separator in ("\n\n", "\n", ". ", " "):
+        cuts = [
+            position + len(separator)
+            for position in (text.rfind(separator, 0, middle), text.find(separator, middle))
+            if position != -1
+        ]
+        # Only boundaries in the middle half give usefully balanced pieces
+        cuts = [cut for cut in cuts if len(text) // 4 <= cut <= len(text) * 3 // 4]
+        if cuts:
+            cut = min(cuts, key=lambda c: abs(c - middle))
+            return [text[:cut], text[cut:]]
+    return [text[:middle], text[middle:]]
+
+
+def split_to_size(text, max_chars):
+    """Split text at boundaries until every piece is at most max_chars (or MIN_SPLIT_CHARS)"""
+    if len(text) <= max(max_chars, MIN_SPLIT_CHARS):
+        return [text]
+    return [piece for half in split_chunk(text) for piece in split_to_size(half, max_chars)]
+
+
+class TokenUsage:
+    """Per-job token totals from response usage metadata"""
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+
+    def summary(self):
+        return (f"{self.prompt_tokens:,} prompt tokens ({self.cached_tokens:,} from cache), "
+                f"{self.output_tokens:,} output tokens")
+
+
+def record_token_usage(reservation, prompt, response, usage_totals=None, limiter=None):
+    """
+    Reconcile a reservation's estimated tokens with the response's usage metadata.
+    usage_totals may be a TokenUsage or a list of them; limiter defaults to rate_limiter.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if not usage:
+        return
+    total_tokens = getattr(usage, "total_token_count", 0)
+    if total_tokens:
+        (limiter or rate_limiter).reconcile(reservation, total_tokens)
+    token_estimator.observe(prompt, getattr(usage, "prompt_token_count", 0))
+    if usage_totals is None:
+        return
+    for totals in usage_totals if isinstance(usage_totals, list) else [usage_totals]:
+        totals.prompt_tokens += getattr(usage, "prompt_token_count", 0) or 0
+        totals.cached_tokens += getattr(usage, "cached_content_token_count", 0) or 0
+        totals.output_tokens += getattr(usage, "candidates_token_count", 0) or 0
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD controller for the number of requests in flight.
+
+    Starts small and doubles the window while requests succeed (slow start),
+    then grows it by about one request per window's worth of successes.
+    A 429, a latency spike (well above the observed baseline) or a rising
+    error rate cuts the window multiplicatively. The result tracks the best
+    throughput the current tier, model and time of day allow; `ceiling` is
+    an optional hard upper bound.
+    """
+
+    def __init__(self, ceiling=DEFAULT_MAX_IN_FLIGHT, initial=2, floor=1, decrease_factor=0.5,
+                 latency_tolerance=2.5, error_rate_threshold=0.25):
+        self.ceiling = max(1, int(ceiling))
+        self.floor = max(1, int(floor))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.error_rate_threshold = error_rate_threshold
+        
+        self._limit = float(min(self.ceiling, max(self.floor, initial)))
+        self.window = ConcurrencyWindow(self._limit)
+        self.slow_start = True
+        self.baseline_latency = None
+        self.error_rate = 0.0
+        self._samples = 0
+        self._last_decrease = 0.0
+
+    @property
+    def limit(self):
+        return self.window.limit
+
+    def _apply(self):
+        self._limit = min(float(self.ceiling), max(float(self.floor), self._limit))
+        self.window.set_limit(self._limit)
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        # One cut per round trip: the requests already in flight saw the same conditions
+        if now - self._last_decrease < (self.baseline_latency or 1.0):
+            return
+        self._last_decrease = now
+        self.slow_start = False
+        self._limit *= self.decrease_factor
+        self._apply()
+        print(f"↘ Concurrency reduced to {self.limit} ({reason})")
+
+    def on_success(self, latency):
+        self._samples += 1
+        self.error_rate *= 0.9
+        if self.baseline_latency is None:
+            self.baseline_latency = latency
+        elif self._samples >= 5 and latency > self.latency_tolerance * self.baseline_latency:
+            self._decrease(f"latency {latency:.1f}s vs baseline {self.baseline_latency:.1f}s")
+            return
+        else:
+            # Slow-moving average so one slow chunk doesn't redefine "normal"
+            self.baseline_latency += 0.1 * (latency - self.baseline_latency)
+        
+        if self.slow_start:
+            self._limit += 1
+        else:
+            self._limit += 1 / max(self._limit, 1)
+        self._apply()
+
+    def on_rate_limit(self):
+        self._decrease("rate limited")
+
+    def start_at(self, limit):
+        """Open the window straight to `limit` (within the ceiling), e.g. when a deadline leaves no time to ramp up"""
+        if limit > self._limit:
+            self._limit = float(limit)
+            self._apply()
+
+    def on_error(self):
+        self.error_rate = 0.9 * self.error_rate + 0.1
+        if self.error_rate > self.error_rate_threshold:
+            self._decrease(f"error rate {self.error_rate:.0%}")
+
+
+class OutputDensity:
+    """
+    Output tokens per input character seen so far in a job. Each chunk's
+    max_output_tokens is sized from it, so dense content (tables, long
+    product lists) gets room for its answer instead of being cut off.
+    """
+
+    def __init__(self, headroom=2.0):
+        self.headroom = headroom
+        self.chars = 0
+        self.tokens = 0
+
+    def observe(self, chars, output_tokens):
+        if chars and output_tokens:
+            self.chars += chars
+            self.tokens += output_tokens
+
+    def max_output_tokens(self, chars, default):
+        """Output budget for a chunk of `chars` characters: the default, raised for dense content"""
+        if not self.chars:
+            return default
+        predicted = self.tokens / self.chars * chars * self.headroom
+        return int(min(MAX_OUTPUT_TOKENS_CEILING, max(default, predicted)))
+
+
+class ParseJob:
+    """
+    Per-job state shared by every chunk request of one parse call: the
+    retry budget, request timeout, optional adaptive concurrency, the
+    response cache, whether page content goes into provider-side context
+    caches, where streamed partial text goes, request hedging, the model
+    cascade, the chunk size and output budgets adapted after truncation,
+    the record schema in structured mode, the Tenant its requests queue as,
+    and the cache and token counters reported at the end.
+    """
+
+    def __init__(self, chunk_count=1, request_timeout=REQUEST_TIMEOUT, concurrency=None, cache=None,
+                 context_cache=False, partial_callback=None, hedge=None, cascade=None, domain=None,
+                 schema=None, tenant=None):
+        self.retry_budget = RetryBudget.for_chunks(chunk_count)
+        self.request_timeout = request_timeout
+        self.concurrency = concurrency
+        self.cache = cache
+        self.context_cache = context_cache
+        # Called with (chunk_index, text_so_far) while single-question responses stream in
+        self.partial_callback = partial_callback
+        # Optional HedgePolicy: duplicate requests that run past the latency percentile
+        self.hedge = hedge
+        # Optional ModelCascade: cheap model first, escalating suspicious answers
+        self.cascade = cascade
+        # Lowered when a chunk is truncated; chunks still to come are split to fit up front
+        self.domain = domain
+        self.chunk_size = None
+        self.splits = 0
+        self.output_density = OutputDensity()
+        # Optional RecordSchema: chunks are answered as JSON records instead of text
+        self.schema = schema
+        # Who the requests are made for; jobs take fair turns for the shared rate limits
+        self.tenant = tenant or Tenant()
+        self.cache_stats = CacheStats()
+        self.token_usage = TokenUsage()
+
+
+async def context_for(job, prefix, route=None):
+    """Provider-side cached context for a prompt prefix, if the job uses context caching"""
+    if not job.context_cache:
+        return None
+    return await context_caches.get_or_create((route or default_route()).backend, prefix)
+
+
+def combined_status(statuses):
+    """The status of an answer put together from several requests: the worst of theirs"""
+    statuses = set(statuses)
+    return next((s for s in (STATUS_FAILED, STATUS_TRUNCATED, STATUS_BLOCKED) if s in statuses), STATUS_OK)
+
+
+async def generate_chunk_result(label, prompt, job, config=None, prefix="", cached_context=None, on_text=None,
+                                route=None, usage_totals=None):
+    """
+    Call Gemini for one rendered prompt with rate limiting and retries; returns (text, status).
+    label names the chunk(s) in log output, e.g. "Chunk 3" or "Chunks 3-6".
+    The request is prefix + prompt; with a cached_context holding the prefix only
+    prompt is sent. With on_text the response is streamed and on_text(text_so_far)
+    is called as it arrives. route picks the model (default_route() if omitted), and
+    token usage is added to usage_totals as well as the job's totals.
+    """
+    full_prompt = prefix + prompt
+    reservation = None
+    concurrency = job.concurrency
+    route = route or default_route()
+    config = config or route.generation_config or generation_config
+    usage = [job.token_usage] + ([usage_totals] if usage_totals is not None else [])
     
-    # Try up to 3 times for each chunk with exponential backoff
+    # Try up to 3 times for each chunk, drawing retries from the job-wide budget
     for attempt in range(3):
+        if attempt > 0 and not job.retry_budget.try_acquire():
+            print(f"⚠ {label}: Job retry budget exhausted, giving up")
+            return "", STATUS_FAILED
         try:
-            # Apply rate limiting before making request
-            wait_for_rate_limit()
+            # Apply rate limiting before making request, booking the estimated
+            # prompt tokens so large chunks wait for TPM headroom instead of a 429
+            tokens = token_estimator.estimate(full_prompt)
+            reservation = await route.wait_for_slot(tokens, job.tenant)
             
-            response = model.generate_content(
-                prompt,
-                generation_config=generation_config,
-                safety_settings=safety_settings
-            )
+            def send(stream_to):
+                if stream_to:
+                    return route.backend.stream(
+                        prompt if cached_context is not None else full_prompt,
+                        generation_config=config,
+                        safety_settings=safety_settings,
+                        cached_context=cached_context,
+                        on_text=stream_to,
+                        timeout=job.request_timeout
+                    )
+                return route.backend.generate(
+                    prompt if cached_context is not None else full_prompt,
+                    generation_config=config,
+                    safety_settings=safety_settings,
+                    cached_context=cached_context,
+                    timeout=job.request_timeout
+                )
             
-            # Check if response has valid content
-            if response.candidates and len(response.candidates) > 0:
-                candidate = response.candidates[0]
-                
-                # Check finish reason
-                if candidate.finish_reason == 1:  # STOP - normal completion
-                    if candidate.content and candidate.content.parts:
-                        result = candidate.content.parts[0].text.strip()
-                        print(f"✓ Processed chunk {chunk_index + 1}")
-                        return chunk_index, result
-                    else:
-                        print(f"⚠ Chunk {chunk_index + 1}: No content in response")
-                        if attempt == 2:  # Last attempt
-                            return chunk_index, ""
-                        continue
-                        
-                elif candidate.finish_reason == 2:  # MAX_TOKENS
-                    print(f"⚠ Chunk {chunk_index + 1}: Response truncated (taking partial result)")
-                    if candidate.content and candidate.content.parts:
-                        result = candidate.content.parts[0].text.strip()
-                        return chunk_index, result
-                    else:
-                        if attempt == 2:
-                            return chunk_index, ""
-                        continue
-                        
-                elif candidate.finish_reason == 3:  # SAFETY
-                    print(f"⚠ Chunk {chunk_index + 1}: Blocked by safety filters")
-                    return chunk_index, ""
-                    
-                elif candidate.finish_reason == 4:  # RECITATION
-                    print(f"⚠ Chunk {chunk_index + 1}: Blocked due to recitation")
-                    return chunk_index, ""
-                    
-                else:
-                    print(f"⚠ Chunk {chunk_index + 1}: Unknown finish reason: {candidate.finish_reason}")
-                    if attempt == 2:
-                        return chunk_index, ""
-                    continue
+            # The primary's reservation, then the hedge's once it has one
+            reservations = [reservation]
+            
+            async def call(is_hedge):
+                if not is_hedge:
+                    return 0, await send(on_text)
+                # The duplicate is a real request, so it takes its own turn for a rate limiter slot
+                reservations.append(await route.wait_for_slot(tokens, job.tenant))
+                print(f"🔀 {label}: Slow response, sending a hedged request")
+                try:
+                    return 1, await send(None)
+                except Exception as e:
+                    if is_rate_limit_error(e):
+                        route.limiter.reconcile(reservations[1], 0)
+                    raise
+            
+            started = time.monotonic()
+            if job.hedge:
+                request = hedged(call, job.hedge, may_hedge=lambda: route.has_headroom(tokens))
             else:
-                print(f"⚠ Chunk {chunk_index + 1}: No candidates in response")
-                if attempt == 2:  # Last attempt
-                    return chunk_index, ""
-                continue
+                request = call(False)
+            winner, response = await asyncio.wait_for(request, timeout=job.request_timeout)
+            record_token_usage(reservations[winner], full_prompt, response, usage, route.limiter)
+            for index, loser in enumerate(reservations):
+                if index != winner:
+                    # The losing request was sent and then cancelled, so its prompt still counts
+                    route.limiter.reconcile(loser, tokens)
+            route.backoff.record_success()
+            latency = time.monotonic() - started
+            if not job.hedge:
+                # Hedged requests are timed by the HedgePolicy, which shares the tracker by default
+                request_latencies.observe(latency)
+            if concurrency:
+                concurrency.on_success(latency)
+            
+            # The backend's typed errors say why there is no complete answer
+            result = check_response(response).strip()
+            print(f"✓ Processed {label.lower()}")
+            return result, STATUS_OK
+        
+        except TruncatedResponseError as e:
+            print(f"⚠ {label}: Response truncated (taking partial result)")
+            if e.text:
+                return e.text.strip(), STATUS_TRUNCATED
+            if attempt == 2:
+                return "", STATUS_FAILED
+            continue
+        
+        except SafetyBlockedError as e:
+            print(f"⚠ {label}: {e}")
+            return "", STATUS_BLOCKED
+        
+        except EmptyResponseError as e:
+            print(f"⚠ {label}: {e}")
+            if attempt == 2:  # Last attempt
+                return "", STATUS_FAILED
+            continue
                 
+        except (QuotaExhaustedError, asyncio.CancelledError):
+            raise
+            
         except Exception as e:
-            error_msg = str(e)
+            error_msg = str(e) or type(e).__name__
             
-            # Handle rate limit errors specifically
-            if "429" in error_msg or "quota" in error_msg.lower():
-                # Extract retry delay if available
-                retry_delay = 20  # Default retry delay
-                if "retry in" in error_msg:
-                    try:
-                        # Extract the retry delay from the error message
-                        import re
-                        match = re.search(r'retry in (\d+\.?\d*)s', error_msg)
-                        if match:
-                            retry_delay = float(match.group(1)) + 1  # Add 1 second buffer
-                    except:
-                        pass
-                
-                print(f"⏳ Chunk {chunk_index + 1}: Rate limit hit, waiting {retry_delay:.1f}s before retry {attempt + 1}/3")
-                time.sleep(retry_delay)
+            # Handle rate limit errors specifically: pause every worker, not just this one.
+            # The next attempt waits out the pause in route.wait_for_slot.
+            if is_rate_limit_error(e):
+                # A rejected request consumes no tokens
+                route.limiter.reconcile(reservation, 0)
+                if concurrency:
+                    concurrency.on_rate_limit()
+                retry_delay = route.backoff.record_rate_limit(e)
+                print(f"⏳ {label}: Rate limit hit, retrying after {retry_delay:.1f}s ({attempt + 1}/3)")
                 continue
             
             # Handle other errors with exponential backoff
             else:
+                if concurrency:
+                    concurrency.on_error()
                 wait_time = (2 ** attempt) + random.uniform(0.5, 1.5)  # Exponential backoff with jitter
-                print(f" Error processing chunk {chunk_index + 1} (attempt {attempt + 1}/3): {error_msg}")
+                print(f" Error processing {label.lower()} (attempt {attempt + 1}/3): {error_msg}")
                 if attempt < 2:  # Not the last attempt
                     print(f"⏳ Retrying in {wait_time:.1f} seconds...")
-                    time.sleep(wait_time)
+                    await asyncio.sleep(wait_time)
                     continue
                 else:
-                    return chunk_index, ""
+                    return "", STATUS_FAILED
     
-    return chunk_index, ""
+    return "", STATUS_FAILED
 
 
-def parse_with_gemini(dom_chunks, parse_description, max_workers=2, progress_callback=None):
+def response_cache_key(prompt, route=None):
+    route = route or default_route()
+    return make_cache_key(route.model_name, route.generation_config or generation_config, safety_settings, prompt)
+
+
+async def cached_result(job, prompt, route=None):
+    """Look up a rendered single-chunk prompt in the job's cache; returns the cached text or None"""
+    if job.cache is None:
+        return None
+    cached = await asyncio.to_thread(job.cache.get, response_cache_key(prompt, route))
+    if cached is None:
+        job.cache_stats.record_miss()
+        return None
+    job.cache_stats.record_hit(cached.negative)
+    return cached.text
+
+
+async def store_result(job, prompt, result, status, route=None):
+    """Cache confirmed answers, including confirmed-empty and blocked ones (on a shorter TTL)"""
+    if job.cache is None or status not in (STATUS_OK, STATUS_BLOCKED):
+        return
+    negative = status == STATUS_BLOCKED or not result
+    key = response_cache_key(prompt, route)
+    await asyncio.to_thread(job.cache.put, key, result, negative)
+
+
+async def process_single_chunk_async(chunk_data, job=None):
+    """Process a single chunk, serving it from the response cache when possible; returns (chunk_index, result, status)"""
+    chunk_index, chunk, parse_description = chunk_data
+    job = job or ParseJob()
+    if job.cascade:
+        return await process_with_cascade(chunk_data, job)
+    
+    if job.chunk_size and len(chunk) > job.chunk_size:
+        # An earlier chunk was truncated: split this one to the job's new size up front
+        pieces = split_to_size(chunk, job.chunk_size)
+        answers = await asyncio.gather(*(
+            answer_chunk_text(chunk_index, piece, parse_description, job) for piece in pieces
+        ))
+        return (chunk_index, "\n".join(answer for answer, _ in answers if answer),
+                combined_status(status for _, status in answers))
+    
+    result, status = await answer_chunk_text(chunk_index, chunk, parse_description, job, stream=True)
+    return chunk_index, result, status
+
+
+def lower_chunk_size(job, size):
+    """Use chunks of at most `size` characters for the rest of the job and for the job's domain"""
+    job.chunk_size = min(job.chunk_size or size, size)
+    if job.domain:
+        chunk_sizes[job.domain] = min(chunk_sizes.get(job.domain, job.chunk_size), job.chunk_size)
+
+
+async def answer_chunk_text(chunk_index, chunk, parse_description, job, depth=0, stream=False):
+    """
+    Answer one piece of content; returns (text, status).
+    
+    A truncated answer is not kept: the piece is split at a boundary and both halves
+    are answered straight away (ahead of chunks still queued), down to MAX_SPLIT_DEPTH,
+    and the job's chunk size is lowered so later chunks don't hit the limit too.
     """
-    Process multiple chunks in parallel using ThreadPoolExecutor with rate limiting
+    prompt = build_prompt(chunk, parse_description)
+    cached = await cached_result(job, prompt)
+    if cached is not None:
+        print(f"✓ Chunk {chunk_index + 1} served from cache")
+        return cached, STATUS_OK
+    
+    def stream_text(text):
+        job.partial_callback(chunk_index, text)
+    
+    on_text = stream_text if stream and job.partial_callback else None
+    
+    config = None
+    max_output_tokens = job.output_density.max_output_tokens(len(chunk), generation_config["max_output_tokens"])
+    if max_output_tokens != generation_config["max_output_tokens"]:
+        config = dict(generation_config, max_output_tokens=max_output_tokens)
+    
+    prefix = prompt_prefix(chunk)
+    usage = TokenUsage()
+    result, status = await generate_chunk_result(
+        f"Chunk {chunk_index + 1}",
+        question_template.format(parse_description=parse_description),
+        job,
+        config=config,
+        prefix=prefix,
+        cached_context=await context_for(job, prefix),
+        on_text=on_text,
+        usage_totals=usage
+    )
+    job.output_density.observe(len(chunk), usage.output_tokens)
+    
+    if status == STATUS_TRUNCATED and depth < MAX_SPLIT_DEPTH and len(chunk) >= 2 * MIN_SPLIT_CHARS:
+        halves = split_chunk(chunk)
+        job.splits += 1
+        lower_chunk_size(job, max(len(half) for half in halves))
+        print(f"✂ Chunk {chunk_index + 1}: truncated, retrying as {len(halves)} pieces of ~{len(halves[0])} chars")
+        answers = await asyncio.gather(*(
+            answer_chunk_text(chunk_index, half, parse_description, job, depth + 1) for half in halves
+        ))
+        result = "\n".join(answer for answer, _ in answers if answer)
+        status = combined_status(half_status for _, half_status in answers)
+    
+    await store_result(job, prompt, result, status)
+    return result, status
+
+
+async def self_check_confidence(chunk_data, answer, job, route, tier):
+    """Ask a route's model how confident it is in its own answer; None if it doesn't say"""
+    chunk_index, chunk, parse_description = chunk_data
+    prefix = prompt_prefix(chunk)
+    tier.self_checks += 1
+    reply, _ = await generate_chunk_result(
+        f"Chunk {chunk_index + 1} self-check",
+        self_check_template.format(parse_description=parse_description, answer=answer),
+        job,
+        prefix=prefix,
+        cached_context=await context_for(job, prefix, route),
+        route=route,
+        usage_totals=tier
+    )
+    return parse_confidence(reply)
+
+
+async def process_with_cascade(chunk_data, job):
+    """
+    Answer a chunk with the job's ModelCascade: each model in turn, cheapest first,
+    until the policy accepts an answer or the last model has answered.
+    Returns (chunk_index, result, status).
+    """
+    chunk_index, chunk, parse_description = chunk_data
+    cascade = job.cascade
+    prompt = build_prompt(chunk, parse_description)
+    prefix = prompt_prefix(chunk)
+    relevance = relevance_score(chunk, parse_description)
+    
+    def stream_text(text):
+        job.partial_callback(chunk_index, text)
+    
+    on_text = stream_text if job.partial_callback else None
+    
+    for level, (route, tier) in enumerate(zip(cascade.routes, cascade.tiers)):
+        last = level == len(cascade.routes) - 1
+        started = time.monotonic()
+        cached = await cached_result(job, prompt, route)
+        if cached is not None:
+            result, status = cached, STATUS_OK
+        else:
+            result, status = await generate_chunk_result(
+                f"Chunk {chunk_index + 1}",
+                question_template.format(parse_description=parse_description),
+                job,
+                prefix=prefix,
+                cached_context=await context_for(job, prefix, route),
+                on_text=on_text,
+                route=route,
+                usage_totals=tier
+            )
+        
+        reason = None
+        if not last:
+            reason = cascade.policy.escalation_reason(result, status, relevance)
+            if reason is None and cached is None and cascade.policy.needs_self_check(result, status):
+                confidence = await self_check_confidence(chunk_data, result, job, route, tier)
+                if confidence is None or confidence < cascade.policy.min_confidence:
+                    reason = "low confidence" if confidence is not None else "no self-check rating"
+        tier.requests += 1
+        tier.latencies.append(time.monotonic() - started)
+        
+        if reason is None:
+            if cached is None:
+                await store_result(job, prompt, result, status, route)
+            return chunk_index, result, status
+        tier.escalated += 1
+        print(f"⤴ Chunk {chunk_index + 1}: escalating from {route.model_name} ({reason})")
+    return chunk_index, result, status
+
+
+# Follows prompt_prefix(content), so it shares the cacheable prefix with single questions
+multi_question_template = (
+    "Answer each of these extraction requests using only the content above:\n"
+    "{questions}\n\n"
+    "Return a JSON object with one key per request: {question_keys}. "
+    "Each value is only the data matching that request, or an empty string if there is no match."
+)
+
+
+def question_key(number):
+    return f"question_{number}"
+
+
+def multi_question_generation_config(keys):
+    """Generation config asking for a JSON object with one string field per question"""
+    return {
+        **generation_config,
+        "response_mime_type": "application/json",
+        "response_schema": {
+            "type": "OBJECT",
+            "properties": {key: {"type": "STRING"} for key in keys},
+            "required": keys,
+        },
+    }
+
+
+async def process_questions_async(chunk_data, job=None):
+    """
+    Answer several parse descriptions about one chunk with a single request.
+    
+    chunk_data is (chunk_index, chunk, questions). Returns (chunk_index, answers, status)
+    with one answer per question, in order. Questions already in the cache are
+    not asked again; any the model leaves unanswered fall back to single requests.
+    """
+    chunk_index, chunk, questions = chunk_data
+    job = job or ParseJob()
+    
+    answers = [None] * len(questions)
+    for number, question in enumerate(questions):
+        answers[number] = await cached_result(job, build_prompt(chunk, question))
+    missing = [number for number, answer in enumerate(answers) if answer is None]
+    if not missing:
+        print(f"✓ Chunk {chunk_index + 1} served from cache")
+        return chunk_index, answers, STATUS_OK
+    
+    prefix = prompt_prefix(chunk)
+    cached_context = await context_for(job, prefix)
+    
+    if len(missing) > 1:
+        keys = [question_key(n) for n in range(1, len(missing) + 1)]
+        prompt = multi_question_template.format(
+            questions="\n".join(f"{key}: {questions[number]}" for key, number in zip(keys, missing)),
+            question_keys=", ".join(keys)
+        )
+        text, status = await generate_chunk_result(
+            f"Chunk {chunk_index + 1}", prompt, job, config=multi_question_generation_config(keys),
+            prefix=prefix, cached_context=cached_context
+        )
+        if status == STATUS_FAILED:
+            return chunk_index, [answer or "" for answer in answers], STATUS_FAILED
+        parsed = parse_json_answer(text) if status == STATUS_OK else None
+        for key, number in zip(keys, missing):
+            answer = parsed.get(key) if parsed else None
+            if isinstance(answer, str):
+                answers[number] = answer.strip()
+                await store_result(job, build_prompt(chunk, questions[number]), answers[number], STATUS_OK)
+    
+    # Anything still unanswered (malformed output or a lone question) gets its own request
+    statuses = []
+    for number, answer in enumerate(answers):
+        if answer is None:
+            answers[number], status = await generate_chunk_result(
+                f"Chunk {chunk_index + 1}",
+                question_template.format(parse_description=questions[number]),
+                job,
+                prefix=prefix,
+                cached_context=cached_context
+            )
+            statuses.append(status)
+            await store_result(job, build_prompt(chunk, questions[number]), answers[number], status)
+    return chunk_index, answers, combined_status(statuses)
+
+
+# Follows prompt_prefix(content), like question_template, for structured mode
+records_template = (
+    "Extract every record matching this description from the content above: {parse_description}\n"
+    "Fields: {fields}\n\n"
+    "Return a JSON object with a \"records\" list holding one object per record, with exactly "
+    "these fields. Use null for a field the content does not give. Return an empty list if "
+    "nothing matches."
+)
+
+
+def build_records_question(parse_description, schema):
+    """The structured-mode question that follows prompt_prefix(chunk)"""
+    return records_template.format(parse_description=parse_description, fields=schema.describe())
+
+
+def records_generation_config(schema):
+    """Generation config asking for {"records": [...]} shaped by a RecordSchema"""
+    return {
+        **generation_config,
+        "response_mime_type": "application/json",
+        "response_schema": schema.response_schema(),
+    }
+
+
+def parse_records_answer(text):
+    """The record list from a structured answer; None if the JSON is malformed"""
+    answer = parse_json_answer(text)
+    if answer is None or not isinstance(answer.get("records"), list):
+        return None
+    return [record for record in answer["records"] if isinstance(record, dict)]
+
+
+async def process_records_async(chunk_data, job):
+    """
+    Extract records from one chunk in structured mode. Returns (chunk_index, records, status),
+    the records as the model gave them; validation and deduplication happen when the
+    job merges all chunks.
+    """
+    chunk_index, chunk, parse_description = chunk_data
+    pieces = split_to_size(chunk, job.chunk_size) if job.chunk_size else [chunk]
+    answers = await asyncio.gather(*(
+        answer_chunk_records(chunk_index, piece, parse_description, job) for piece in pieces
+    ))
+    return (chunk_index, [record for records, _ in answers for record in records],
+            combined_status(status for _, status in answers))
+
+
+async def answer_chunk_records(chunk_index, chunk, parse_description, job, depth=0):
+    """
+    Records from one piece of content, as (records, status). Truncated JSON can't be
+    salvaged, so like answer_chunk_text a truncated piece is split and both halves
+    asked again; malformed JSON counts as failed.
+    """
+    question = build_records_question(parse_description, job.schema)
+    prefix = prompt_prefix(chunk)
+    prompt = prefix + question
+    cached = await cached_result(job, prompt)
+    if cached is not None:
+        print(f"✓ Chunk {chunk_index + 1} served from cache")
+        return parse_records_answer(cached) or [], STATUS_OK
+    
+    text, status = await generate_chunk_result(
+        f"Chunk {chunk_index + 1}", question, job, config=records_generation_config(job.schema),
+        prefix=prefix, cached_context=await context_for(job, prefix)
+    )
+    if status == STATUS_TRUNCATED and depth < MAX_SPLIT_DEPTH and len(chunk) >= 2 * MIN_SPLIT_CHARS:
+        halves = split_chunk(chunk)
+        job.splits += 1
+        lower_chunk_size(job, max(len(half) for half in halves))
+        print(f"✂ Chunk {chunk_index + 1}: truncated JSON, retrying as {len(halves)} pieces of ~{len(halves[0])} chars")
+        answers = await asyncio.gather(*(
+            answer_chunk_records(chunk_index, half, parse_description, job, depth + 1) for half in halves
+        ))
+        return ([record for records, _ in answers for record in records],
+                combined_status(half_status for _, half_status in answers))
+    
+    records = parse_records_answer(text) if status == STATUS_OK else None
+    if records is None:
+        if status == STATUS_OK:
+            print(f"⚠ Chunk {chunk_index + 1}: malformed JSON records, skipping")
+            status = STATUS_FAILED
+        return [], status
+    await store_result(job, prompt, text if records else "", status)
+    return records, status
+
+
+# Follows prompt_instructions; the question comes last so batches keep the static prefix
+batch_template = (
+    "Content, split into {section_count} numbered sections:\n\n"
+    "{sections}\n\n"
+    "Extract only the information that matches this description: {parse_description}\n"
+    "Answer each section separately, using only that section's content.\n"
+    "Return a JSON object with one key per section: {section_keys}. "
+    "Each value is only the requested data found in that section, or an empty string if it has no match."
+)
+
+
+def section_key(number):
+    return f"section_{number}"
+
+
+def build_batch_prompt(batch):
+    """Render several (chunk_index, chunk, parse_description) items as one delimited prompt"""
+    parse_description = batch[0][2]
+    sections = "\n\n".join(
+        f"=== SECTION {number} ===\n{chunk}\n=== END SECTION {number} ==="
+        for number, (_, chunk, _) in enumerate(batch, 1)
+    )
+    keys = [section_key(number) for number in range(1, len(batch) + 1)]
+    prompt = prompt_instructions + batch_template.format(
+        parse_description=parse_description,
+        section_count=len(batch),
+        sections=sections,
+        section_keys=", ".join(keys)
+    )
+    return prompt, keys
+
+
+def batch_generation_config(keys):
+    """Generation config asking for a JSON object with one string field per section"""
+    return {
+        **generation_config,
+        "max_output_tokens": BATCH_MAX_OUTPUT_TOKENS,
+        "response_mime_type": "application/json",
+        "response_schema": {
+            "type": "OBJECT",
+            "properties": {key: {"type": "STRING"} for key in keys},
+            "required": keys,
+        },
+    }
+
+
+def parse_json_answer(text):
+    """Parse a JSON object from model output, tolerating a ```json fence; None if malformed"""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        if text.lower().startswith("json"):
+            text = text[4:]
+    try:
+        answer = json.loads(text)
+    except ValueError:
+        return None
+    return answer if isinstance(answer, dict) else None
+
+
+def pack_batches(chunk_data_list, batch_size, max_batch_tokens=MAX_BATCH_TOKENS):
+    """Group consecutive chunks into batches of up to batch_size sections and max_batch_tokens prompt tokens"""
+    batches = []
+    current = []
+    current_tokens = 0
+    for chunk_data in chunk_data_list:
+        tokens = token_estimator.estimate(chunk_data[1])
+        if current and (len(current) >= batch_size or current_tokens + tokens > max_batch_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(chunk_data)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def process_batch_async(batch, job=None):
+    """
+    Answer several chunks with one request and map the answers back to chunk indices.
+    
+    Sections whose answer is missing, malformed, truncated or blocked are re-split
+    into two smaller batches and retried, down to single-chunk requests.
+    Returns a list of (chunk_index, result, status).
+    """
+    job = job or ParseJob(len(batch))
+    if len(batch) == 1:
+        return [await process_single_chunk_async(batch[0], job)]
+    
+    results = []
+    pending = []
+    for chunk_data in batch:
+        chunk_index, chunk, parse_description = chunk_data
+        cached = await cached_result(job, build_prompt(chunk, parse_description))
+        if cached is not None:
+            print(f"✓ Chunk {chunk_index + 1} served from cache")
+            results.append((chunk_index, cached, STATUS_OK))
+        else:
+            pending.append(chunk_data)
+    if not pending:
+        return results
+    if len(pending) == 1:
+        return results + [await process_single_chunk_async(pending[0], job)]
+    
+    prompt, keys = build_batch_prompt(pending)
+    label = f"Chunks {pending[0][0] + 1}-{pending[-1][0] + 1}"
+    text, status = await generate_chunk_result(label, prompt, job, config=batch_generation_config(keys))
+    if status == STATUS_FAILED:
+        return results + [(chunk_data[0], "", STATUS_FAILED) for chunk_data in pending]
+    
+    answers = parse_json_answer(text) if status == STATUS_OK else None
+    resplit = []
+    for key, chunk_data in zip(keys, pending):
+        chunk_index, chunk, parse_description = chunk_data
+        answer = answers.get(key) if answers else None
+        if isinstance(answer, str):
+            results.append((chunk_index, answer.strip(), STATUS_OK))
+            await store_result(job, build_prompt(chunk, parse_description), answer.strip(), STATUS_OK)
+        else:
+            resplit.append(chunk_data)
+    
+    if resplit:
+        print(f"⚠ {label}: {len(resplit)} section(s) {status if status != STATUS_OK else 'malformed'}, re-splitting")
+        middle = len(resplit) // 2
+        halves = [half for half in (resplit[:middle], resplit[middle:]) if half]
+        for half_results in await asyncio.gather(*(process_batch_async(half, job) for half in halves)):
+            results.extend(half_results)
+    return results
+
+
+# Dispatch orders for parse_with_gemini_async
+ORDER_DOCUMENT = "document"
+ORDER_RELEVANCE = "relevance"
+
+
+def count_records(text):
+    """Records in a parse result: one per non-empty line"""
+    return sum(1 for line in text.splitlines() if line.strip())
+
+
+def first_records(text, limit):
+    """The first `limit` records of a parse result"""
+    return "\n".join([line for line in text.splitlines() if line.strip()][:limit])
+
+
+def relevance_score(chunk, parse_description):
+    """Cheap lexical relevance: how often the description's words appear in the chunk"""
+    terms = {word for word in re.findall(r"\w+", parse_description.lower()) if len(word) > 2}
+    text = chunk.lower()
+    return sum(text.count(term) for term in terms)
+
+
+async def parse_with_gemini_async(dom_chunks, parse_description, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                                  progress_callback=None, request_timeout=REQUEST_TIMEOUT, engine=None,
+                                  concurrency=None, use_cache=True, stats=None, batch_size=1,
+                                  context_cache=False, result_callback=None, partial_callback=None,
+                                  limit=None, stop_when=None, order=ORDER_DOCUMENT, hedge=False,
+                                  cancel_token=None, cascade=None, domain=None, schema=None,
+                                  deadline=None, tenant=None, job_store=None, job_id=None, source=None,
+                                  owner=None):
+    """
+    Process multiple chunks concurrently on the asyncio dispatch engine with rate limiting
     
     Args:
         dom_chunks: List of text chunks to process
-        parse_description: Description of what to extract
-        max_workers: Maximum number of concurrent threads (default: 2 for free tier)
+        parse_description: Description of what to extract, or a list of descriptions
+            to answer in one pass over the content (one request per chunk for all of them)
+        max_in_flight: Maximum number of requests in flight at once
         progress_callback: Function to call with (completed, total) for progress updates
+        request_timeout: Seconds before a single generate call is abandoned and retried
+        engine: Optional DispatchEngine, so the caller can cancel() the job
+        concurrency: Optional AdaptiveConcurrency that sizes the in-flight window
+            instead of the fixed max_in_flight
+        use_cache: Serve repeated prompts from the persistent response cache
+        stats: Optional dict filled with the job's report ("cache": CacheStats, "tokens": TokenUsage)
+        batch_size: Chunks packed into one request (1 disables batching). Ignored when
+            several descriptions are given, since those already share each request.
+        context_cache: Register each chunk's content as provider-side cached context, so
+            repeated questions about the same page only pay full price for the question
+        result_callback: Function called with (chunk_index, result) in document order, as
+            soon as every earlier chunk has finished
+        partial_callback: Function called with (chunk_index, text_so_far) while the next
+            chunk due for release streams in (single-question jobs)
+        limit: Stop once this many records (non-empty result lines) have been found
+            and return only the first `limit` of them
+        stop_when: Predicate called with the results gathered so far; the job stops
+            as soon as it returns True
+        order: ORDER_DOCUMENT dispatches chunks in page order and checks limit/stop_when
+            against the contiguous prefix of results, so "first N" means the first N on
+            the page; ORDER_RELEVANCE dispatches the chunks that best match the
+            description first and checks everything gathered so far
+        hedge: True (or a HedgePolicy) to send a duplicate of any request that runs past
+            the 95th percentile of recent latencies, when rate-limit headroom allows;
+            the first response wins. stats["hedging"] reports the effect on p99 latency.
+        cancel_token: Optional CancelToken. Cancelling it (from any thread) skips queued
+            chunks, cancels in-flight requests and their rate-limit or retry sleeps, and
+            returns the results finished so far; stats["cancelled"] reports what was dropped.
+        cascade: True (gemini_cascade() over DEFAULT_CASCADE) or a ModelCascade: each chunk
+            goes to the cheapest model first and only suspicious answers are escalated.
+            Single description only, one chunk per request. stats["cascade"] holds the
+            per-tier latency, cost and escalation report. cascade=True needs the Gemini
+            backend (cascade_available()).
+        domain: Site the content came from. A truncated answer is retried as two
+            halves and lowers the chunk size for the rest of the job and, through
+            chunk_size_for(domain), for the next scrape of the same site.
+        schema: Structured mode. A RecordSchema, a spec string for RecordSchema.parse
+            ("name*, price:number, url"), or True to infer one from the description.
+            Each chunk is answered as schema-constrained JSON records, which are
+            validated, normalized and deduplicated locally; the result is a list of
+            record dicts (one per table row) and stats["records"] reports the merge.
+            Single description only; limit counts records and stop_when receives the
+            record list, and result_callback receives each chunk's raw records.
+        deadline: Time budget in seconds. A DeadlineScheduler picks the settings that
+            cover the most content within it from the rate-limit headroom and recent
+            latencies: most relevant chunks first, packing or splitting chunks, the
+            faster model tier and an open concurrency window. Requests that can't
+            finish in time are not started, the job stops at the deadline with what
+            it has, and stats["coverage"] holds the CoverageReport.
+        tenant: The Tenant (session or batch run) this job's requests are made for.
+            Rate-limit slots are shared between tenants by weighted fair queuing with
+            interactive work ahead of batch work; tenant.position and average_wait
+            show where the job stands. Defaults to a new interactive tenant per job.
+        job_store: A JobStore, or True for get_job_store(), that checkpoints the job:
+            its definition, chunk hashes and each chunk's result as it completes.
+            Running the same job again (same description, settings and content, or
+            the same job_id) dispatches only the chunks without a result.
+            stats["job"] reports the job id and how many chunks were resumed.
+        job_id: Id to record the job under; defaults to a hash of the description,
+            settings and content
+        source: Where the content came from (e.g. the URL), shown for unfinished jobs
+        owner: Who runs the job (e.g. a browser session's token), recorded so only
+            they are offered it as unfinished
+    
+    When the job stops early, queued requests are skipped and in-flight ones
+    cancelled; stats["early_stop"] reports how many of each.
+    
+    Returns the joined results, a list of them (one per description) when
+    parse_description is a list, or a list of records in structured mode.
     """
-    # For free tier, limit workers to avoid rate limits
-    if max_workers > 3:
-        print(f"⚠ Limiting workers to 3 to respect API rate limits (requested: {max_workers})")
-        max_workers = 3
+    if engine is None:
+        engine = DispatchEngine(max_in_flight, window=concurrency.window if concurrency else None)
+    if schema is True and isinstance(parse_description, str):
+        schema = infer_schema(parse_description)
+    elif isinstance(schema, str):
+        schema = RecordSchema.parse(schema)
+    job = ParseJob(
+        len(dom_chunks),
+        request_timeout=request_timeout,
+        concurrency=concurrency,
+        cache=get_response_cache() if use_cache else None,
+        context_cache=context_cache,
+        hedge=hedge if isinstance(hedge, HedgePolicy) else (HedgePolicy(latencies=request_latencies) if hedge else None),
+        cascade=cascade or None,
+        domain=domain,
+        schema=schema or None,
+        tenant=tenant
+    )
+    reorder = ReorderBuffer()
+    
+    if partial_callback:
+        # Only the chunk holding up the release order is worth showing in progress
+        def stream_partial(chunk_index, text):
+            if chunk_index == reorder.next_index:
+                partial_callback(chunk_index, text)
+        job.partial_callback = stream_partial
+    
+    print(f" Starting rate-limited processing of {len(dom_chunks)} chunks with up to {engine.max_in_flight} requests in flight...")
+    print(f" Rate limits for {MODEL_NAME}: {rate_limiter.limits}")
+    
+    multi_question = not isinstance(parse_description, str)
+    if multi_question and (limit or stop_when):
+        raise ValueError("limit and stop_when apply to a single parse description")
+    if multi_question and cascade:
+        raise ValueError("The model cascade applies to a single parse description")
+    if job.schema and (multi_question or cascade):
+        raise ValueError("Structured output applies to a single parse description without the model cascade")
+    if job.schema:
+        print(f" Structured output: {job.schema.describe()} (key: {', '.join(job.schema.key_fields)})")
+        batch_size = 1
+    if cascade is True:
+        if not cascade_available():
+            raise ValueError(f"The default model cascade routes between Gemini models, but requests go to "
+                             f"a {type(backend).__name__}; pass a ModelCascade built on it instead")
+        cascade = job.cascade = gemini_cascade()
+    if cascade and batch_size > 1:
+        print(" Model cascade routes chunks one by one; batching disabled")
+        batch_size = 1
+    if order not in (ORDER_DOCUMENT, ORDER_RELEVANCE):
+        raise ValueError(f"Unknown dispatch order '{order}'")
+    if multi_question:
+        parse_description = tuple(parse_description)
+        batch_size = 1
+        print(f" Answering {len(parse_description)} questions per request")
     
-    print(f" Starting rate-limited parallel processing of {len(dom_chunks)} chunks with {max_workers} workers...")
-    print(f" Free tier limit: 10 requests/minute - estimated time: {len(dom_chunks) * 7}s")
+    if job_store is True:
+        job_store = get_job_store()
+    settings = {"model": backend.model_name, "schema": job.schema.spec() if job.schema else None}
+    if job_store is not None and job_id is None:
+        job_id = make_job_id(parse_description, dom_chunks, settings)
     
-    # Prepare chunk data for parallel processing
-    chunk_data_list = [(i, chunk, parse_description) for i, chunk in enumerate(dom_chunks)]
+    scheduler = None
+    if deadline:
+        scheduler = await deadline_scheduler(dom_chunks, deadline, concurrency.ceiling if concurrency else engine.max_in_flight)
+        print(f"⏱ Deadline: {scheduler.summary()}")
+        job.request_timeout = min(job.request_timeout, deadline)
+        if not multi_question:
+            order = ORDER_RELEVANCE
+        split = scheduler.split_factor(len(dom_chunks))
+        if split > 1:
+            dom_chunks = [piece for chunk in dom_chunks for piece in split_to_size(chunk, math.ceil(len(chunk) / split))]
+            print(f"⏱ Split content into {len(dom_chunks)} smaller chunks to use the spare concurrency")
+        single_text = not (multi_question or job.schema or cascade)
+        if single_text and batch_size == 1:
+            batch_size = scheduler.batch_size(len(dom_chunks))
+        if (single_text and batch_size == 1 and cascade_available() and MODEL_NAME != DEFAULT_CASCADE[0]
+                and scheduler.use_fast_model(len(dom_chunks))):
+            print(f"⏱ Using {DEFAULT_CASCADE[0]} to cover more chunks in time")
+            cascade = job.cascade = gemini_cascade(DEFAULT_CASCADE[:1])
+    
+    finished = {}
+    if job_store is not None:
+        finished = job_store.start(job_id, parse_description, dom_chunks, settings, source, owner)
+        if finished:
+            print(f"↻ Resuming job {job_id}: {len(finished)}/{len(dom_chunks)} chunks already done")
+    
+    chunk_data_list = [(i, chunk, parse_description) for i, chunk in enumerate(dom_chunks) if i not in finished]
+    batches = pack_batches(chunk_data_list, batch_size) if batch_size > 1 else [[c] for c in chunk_data_list]
+    if batch_size > 1:
+        print(f" Packed {len(chunk_data_list)} chunks into {len(batches)} batched requests")
+    if scheduler and concurrency:
+        concurrency.start_at(scheduler.window(len(batches)))
+    if order == ORDER_RELEVANCE and not multi_question:
+        # Stable sort, so equally relevant chunks keep their page order
+        batches.sort(key=lambda batch: -max(relevance_score(chunk, parse_description) for _, chunk, _ in batch))
     
     # Store results with their original index
     results = {}
+    coverage = None
+    if scheduler:
+        described = parse_description if isinstance(parse_description, str) else " ".join(parse_description)
+        relevances = [relevance_score(chunk, described) for chunk in dom_chunks]
+        coverage = CoverageReport(deadline, len(dom_chunks), sum(relevances))
+    structured = job.schema is not None
+    empty_result = [""] * len(parse_description) if multi_question else ([] if structured else "")
+    completed = 0
+    quota_error = None
+    released = []
+    # Structured mode: records of the released chunks, merged as they arrive
+    released_records = RecordMerger(job.schema) if structured else None
+    stopped = False
+    
+    def merged_records():
+        merger = RecordMerger(job.schema)
+        for index in sorted(results):
+            merger.add(results[index])
+        return merger
+    
+    def check_stop(found):
+        nonlocal stopped
+        if stopped or not (limit or stop_when):
+            return
+        count = len(found) if structured else count_records(found)
+        if (limit and count >= limit) or (stop_when and stop_when(found)):
+            stopped = True
+            print(" Stopping condition met - cancelling remaining chunks")
+            engine.cancel()
     
-    # Use ThreadPoolExecutor for parallel processing
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all tasks
-        future_to_chunk = {
-            executor.submit(process_single_chunk, chunk_data): chunk_data[0] 
-            for chunk_data in chunk_data_list
-        }
+    def check_found():
+        """check_stop() against what counts as found in this order"""
+        if structured:
+            check_stop(released_records.records if order == ORDER_DOCUMENT else merged_records().records)
+        elif order == ORDER_DOCUMENT:
+            check_stop("\n".join(released))
+        else:
+            check_stop(join_results(results))
+    
+    def release(chunk_index):
+        for index, result in reorder.add(chunk_index, results[chunk_index]):
+            if structured:
+                released_records.add(result)
+            elif not multi_question and result.strip():
+                released.append(result)
+            if result_callback:
+                result_callback(index, result)
+    
+    def on_result(batch_number, outcome, error):
+        nonlocal completed, quota_error
+        batch = batches[batch_number]
+        completed += len(batch)
+        if error is None:
+            for chunk_index, result, status in outcome:
+                results[chunk_index] = result
+                if coverage:
+                    coverage.record(relevances[chunk_index], bool(result))
+                if job_store is not None:
+                    # Only confirmed answers are checkpointed; the rest are asked again on resume
+                    job_store.record_chunk(job_id, chunk_index, result,
+                                           failed=status not in (STATUS_OK, STATUS_BLOCKED))
+            print(f" Progress: {completed}/{len(dom_chunks)} chunks completed")
+        elif isinstance(error, DeadlineSkipped):
+            coverage.skipped += len(batch)
+            for chunk_index, _, _ in batch:
+                results[chunk_index] = empty_result
+        elif isinstance(error, QuotaExhaustedError):
+            # Circuit breaker is open: the remaining chunks would fail the same way
+            if quota_error is None:
+                print(f"🛑 {error} - cancelling remaining chunks")
+                engine.cancel()
+            quota_error = error
+            for chunk_index, _, _ in batch:
+                results[chunk_index] = empty_result
+        else:
+            for chunk_index, _, _ in batch:
+                print(f"❌ Chunk {chunk_index + 1} generated an exception: {error}")
+                results[chunk_index] = empty_result
+                if job_store is not None:
+                    job_store.record_chunk(job_id, chunk_index, None, failed=True)
         
-        # Collect results as they complete
-        completed = 0
-        for future in as_completed(future_to_chunk):
-            chunk_index = future_to_chunk[future]
-            completed += 1
-            try:
-                index, result = future.result()
-                results[index] = result
-                print(f" Progress: {completed}/{len(dom_chunks)} chunks completed")
-                
-                # Call progress callback if provided
-                if progress_callback:
-                    progress_callback(completed, len(dom_chunks))
-                    
-            except Exception as exc:
-                print(f"❌ Chunk {chunk_index + 1} generated an exception: {exc}")
-                results[chunk_index] = ""
-                
-                # Still update progress even for failed chunks
-                if progress_callback:
-                    progress_callback(completed, len(dom_chunks))
+        for chunk_index, _, _ in batch:
+            release(chunk_index)
+        check_found()
+        
+        # Update progress for failed chunks too
+        if progress_callback:
+            progress_callback(completed, len(dom_chunks))
+    
+    async def process(batch):
+        # Not worth starting a request that typically can't finish before the deadline
+        typical = request_latencies.percentile(50) if scheduler else None
+        if typical is not None and loop.time() + typical > deadline_at:
+            raise DeadlineSkipped()
+        if multi_question:
+            return [await process_questions_async(batch[0], job)]
+        if structured:
+            return [await process_records_async(batch[0], job)]
+        return await process_batch_async(batch, job)
     
-    # Sort results by original index and filter out empty ones
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    if finished:
+        # Checkpointed chunks count as done and are released like fresh results
+        completed += len(finished)
+        for chunk_index, result in sorted(finished.items()):
+            results[chunk_index] = result
+            if coverage:
+                coverage.record(relevances[chunk_index], bool(result))
+            release(chunk_index)
+        check_found()
+        if progress_callback:
+            progress_callback(completed, len(dom_chunks))
+    stop_listening = None
+    if cancel_token is not None:
+        stop_listening = cancel_token.add_callback(lambda: loop.call_soon_threadsafe(engine.cancel))
+    timer = None
+    if scheduler:
+        deadline_at = started + deadline
+        
+        def on_deadline():
+            coverage.timed_out = True
+            print("⏱ Deadline reached - returning the results so far")
+            engine.cancel()
+        timer = loop.call_at(deadline_at, on_deadline)
+    try:
+        await engine.map(process, batches, on_result=on_result)
+    finally:
+        if stop_listening:
+            stop_listening()
+        if timer:
+            timer.cancel()
+    
+    # The engine counts requests; a batched request carries several chunks
+    skipped_chunks = sum(len(batches[number]) for number in engine.skipped_items)
+    cancelled_chunks = sum(len(batches[number]) for number in engine.cancelled_items)
+    if coverage:
+        coverage.elapsed = loop.time() - started
+        coverage.skipped += skipped_chunks
+        coverage.cancelled = cancelled_chunks
+        print(f"⏱ Coverage: {coverage.summary()}")
+        if stats is not None:
+            stats["coverage"] = coverage
+    
+    if job_store is not None:
+        stored = job_store.get(job_id)
+        job_store.finish(job_id, JOB_COMPLETE if stopped or stored.remaining == 0 else JOB_INTERRUPTED)
+        print(f" Job {job_id}: {stored.done}/{len(dom_chunks)} chunks checkpointed")
+        if stats is not None:
+            stats["job"] = {"id": job_id, "resumed": len(finished), "done": stored.done}
+    
+    if job.cache is not None:
+        print(f" Response {job.cache_stats.summary()}")
+    if stats is not None:
+        stats["cache"] = job.cache_stats
+        stats["tokens"] = job.token_usage
+    print(f" Token usage: {job.token_usage.summary()}")
+    if job.cascade:
+        print(f" Model cascade: {job.cascade.summary()}")
+        if stats is not None:
+            stats["cascade"] = job.cascade
+    if job.splits:
+        print(f"✂ Split {job.splits} truncated chunks; chunk size now {job.chunk_size} chars")
+        if stats is not None:
+            stats["splits"] = {"count": job.splits, "chunk_size": job.chunk_size}
+    if job.hedge:
+        print(f" Hedging: {job.hedge.summary()}")
+        if stats is not None:
+            stats["hedging"] = job.hedge
+    if cancel_token is not None and cancel_token.cancelled:
+        print(f"⏹ {cancel_token.reason}: {completed}/{len(dom_chunks)} chunks finished, "
+              f"{skipped_chunks} not started, {cancelled_chunks} cancelled in flight")
+        if stats is not None:
+            stats["cancelled"] = {"completed": completed, "skipped": skipped_chunks, "cancelled": cancelled_chunks}
+    elif stopped:
+        print(f" Stopped early: {skipped_chunks} chunks not started, {cancelled_chunks} cancelled in flight")
+        if stats is not None:
+            stats["early_stop"] = {"skipped": skipped_chunks, "cancelled": cancelled_chunks}
+    
+    if multi_question:
+        # Demultiplex per-chunk answer lists into one result set per question
+        result_sets = [
+            join_results({index: answers[number] for index, answers in results.items()})
+            for number in range(len(parse_description))
+        ]
+        if quota_error is not None and not any(result_sets):
+            raise quota_error
+        print(f"✅ Completed! Answered {len(parse_description)} questions over {len(dom_chunks)} chunks")
+        return result_sets
+    
+    if structured:
+        merger = merged_records()
+        records = merger.records[:limit] if limit else merger.records
+        if quota_error is not None and not records:
+            raise quota_error
+        print(f"✅ Completed! {merger.summary()} from {len(dom_chunks)} chunks")
+        if stats is not None:
+            stats["records"] = merger
+        return records
+    
+    joined = join_results(results)
+    if limit:
+        joined = first_records(joined, limit)
+    if quota_error is not None and not joined:
+        raise quota_error
+    print(f"✅ Completed! Processed {sum(1 for r in results.values() if r.strip())} chunks with content out of {len(dom_chunks)} total")
+    return joined
+
+
+async def deadline_scheduler(dom_chunks, deadline, max_in_flight):
+    """A DeadlineScheduler fed with the live rate-limit headroom and recent latencies"""
+    headroom = await rate_limiter.headroom_async()
+    limits = rate_limiter.effective
+    requests_available = None
+    if limits.rpm:
+        # The burst left now, then the steady rate for the rest of the budget
+        usable = max(0.0, deadline - headroom["next_slot_in"])
+        requests_available = int(usable * limits.rpm / MINUTE) + max(1, limits.rpm // 10)
+    if limits.tpm and dom_chunks:
+        chunk_tokens = sum(token_estimator.estimate(chunk) for chunk in dom_chunks) / len(dom_chunks)
+        by_tokens = int(limits.tpm * max(1.0, deadline / MINUTE) / max(1.0, chunk_tokens))
+        requests_available = by_tokens if requests_available is None else min(requests_available, by_tokens)
+    if headroom["requests_today"] is not None:
+        requests_available = min(requests_available or headroom["requests_today"], headroom["requests_today"])
+    return DeadlineScheduler(deadline, request_latencies.percentile(75), max_in_flight, requests_available)
+
+
+def join_results(results):
+    """Join chunk results (index -> text) in document order, dropping empty ones"""
     sorted_results = [results[i] for i in sorted(results.keys())]
-    non_empty_results = [result for result in sorted_results if result.strip()]
+    return "\n".join(result for result in sorted_results if result.strip())
+
+
+def parse_with_gemini(dom_chunks, parse_description, max_workers=None, progress_callback=None,
+                      adaptive=True, concurrency=None, use_cache=True, stats=None, batch_size=1,
+                      context_cache=False, result_callback=None, partial_callback=None,
+                      limit=None, stop_when=None, order=ORDER_DOCUMENT, hedge=False,
+                      request_timeout=REQUEST_TIMEOUT, cancel_token=None, heartbeat=None, cascade=None,
+                      domain=None, schema=None, deadline=None, tenant=None, job_store=None, job_id=None,
+                      source=None, owner=None):
+    """
+    Synchronous entry point used by the Streamlit UI; runs parse_with_gemini_async
+    on the shared dispatch loop.
     
-    print(f"✅ Completed! Processed {len(non_empty_results)} chunks with content out of {len(dom_chunks)} total")
-    return "\n".join(non_empty_results)
+    With adaptive=True (the default) the number of requests in flight is
+    tuned by an AdaptiveConcurrency controller and max_workers is only its
+    ceiling. With adaptive=False exactly max_workers requests run at once.
+    Pass your own `concurrency` controller to watch its window while the job runs,
+    and a `stats` dict to receive the job's report (cache hit/miss counts).
+    batch_size > 1 packs that many chunks into each request. A list of
+    parse descriptions is answered in one pass and returns a list of results.
+    context_cache=True keeps page content in provider-side cached context.
+    result_callback / partial_callback stream results to the caller as they
+    become available, and limit / stop_when / order end the job early once
+    enough has been found. hedge=True duplicates straggling requests
+    (see parse_with_gemini_async). request_timeout bounds each generate call;
+    cancel_token stops the job and returns partial results, and heartbeat()
+    is called about every 0.1s while waiting, so a UI can interrupt the wait.
+    cascade=True sends chunks to a cheaper model first and escalates only
+    suspicious answers to the stronger one. domain remembers the smaller chunk
+    size a site needed after truncated answers (see chunk_size_for).
+    schema switches to structured output and returns a deduplicated list of
+    record dicts instead of text. deadline is a time budget in seconds: the
+    job is scheduled to cover the most relevant content in time and returns
+    what it has when the budget runs out. tenant is who the job runs for
+    when several sessions share the quota. job_store checkpoints each chunk's
+    result so an interrupted job resumes where it stopped.
+    """
+    # More requests in flight than the quota can feed would only sit waiting for slots
+    rpm = rate_limiter.effective.rpm
+    if max_workers is None:
+        max_workers = min(DEFAULT_MAX_IN_FLIGHT, rpm) if rpm else DEFAULT_MAX_IN_FLIGHT
+    if rpm and max_workers > rpm:
+        print(f"⚠ Limiting in-flight requests to {rpm} to match the rate limit (requested: {max_workers})")
+        max_workers = rpm
+    if concurrency is None and adaptive:
+        concurrency = AdaptiveConcurrency(ceiling=max_workers)
+    relay = CallbackRelay()
+    return run_sync(
+        parse_with_gemini_async(dom_chunks, parse_description, max_workers, relay.wrap(progress_callback),
+                                concurrency=concurrency, use_cache=use_cache, stats=stats,
+                                batch_size=batch_size, context_cache=context_cache,
+                                result_callback=relay.wrap(result_callback),
+                                partial_callback=relay.wrap(partial_callback),
+                                limit=limit, stop_when=stop_when, order=order, hedge=hedge,
+                                request_timeout=request_timeout, cancel_token=cancel_token,
+                                cascade=cascade, domain=domain, schema=schema,
+                                deadline=deadline, tenant=tenant, job_store=job_store,
+                                job_id=job_id, source=source, owner=owner),
+        relay,
+        heartbeat=heartbeat
+    )
 
 
 # Alias for backward compatibility and progress support
-def parse_with_gemini_progress(dom_chunks, parse_description, max_workers=2, progress_callback=None):
+def parse_with_gemini_progress(dom_chunks, parse_description, max_workers=None, progress_callback=None, **kwargs):
     """Progress-enabled version of parse_with_gemini (same function with different name for clarity)"""
-    return parse_with_gemini(dom_chunks, parse_description, max_workers, progress_callback)
\ No newline at end of file
+    return parse_with_gemini(dom_chunks, parse_description, max_workers, progress_callback, **kwargs)
\ No newline at end of file
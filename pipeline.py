@@ -0,0 +1,201 @@
+"""
+Pipelined stage execution with bounded queues.
+
+Running scrape, clean, split and parse one page at a time leaves the
+browser idle while the LLM answers and the LLM idle while the browser
+loads. A Pipeline runs each stage on its own group of worker threads,
+connected by bounded queues: page 2 loads while page 1's chunks are in
+flight, and a stage that gets ahead blocks on the full queue in front of
+the next one instead of piling up pages in memory. The input iterable is
+read only as fast as the first stage takes items.
+
+Each stage keeps a StageStats: how busy its workers were, how long they
+waited for input and how long they were blocked by a full queue
+downstream. The busiest stage is the bottleneck: give it more workers, or
+expect the others to wait on it.
+"""
+import queue
+import threading
+import time
+
+DEFAULT_QUEUE_SIZE = 2
+
+# Marks the end of the items on a queue
+_DONE = object()
+
+
+class Stage:
+    """One step of a pipeline: func(item) -> item, run by `workers` threads"""
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+
+
+class FailedItem:
+    """An item whose stage raised; it skips the remaining stages and comes out of the pipeline as is"""
+
+    def __init__(self, item, stage, error):
+        self.item = item
+        self.stage = stage
+        self.error = error
+
+
+class StageStats:
+    """Where a stage's worker time went"""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.failed = 0
+        self.skipped = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+        self.blocked = 0.0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def add(self, field, seconds):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + seconds)
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def utilization(self):
+        """Share of the workers' time spent working"""
+        capacity = self.workers * self.elapsed
+        return min(1.0, self.busy / capacity) if capacity else 0.0
+
+    def summary(self):
+        per_item = self.busy / self.items if self.items else 0.0
+        text = (f"{self.name}: {self.items} items ({per_item:.2f}s each) on {self.workers} workers, "
+                f"{self.utilization:.0%} busy, {self.waiting:.1f}s waiting for input, "
+                f"{self.blocked:.1f}s blocked by a full queue")
+        if self.failed:
+            text += f", {self.failed} failed"
+        if self.skipped:
+            text += f", {self.skipped} skipped after cancel"
+        return text
+
+
+class Pipeline:
+    """
+    Stages connected by queues of at most queue_size items.
+
+    run(items) starts the workers and returns the pipeline as an iterator
+    over the items leaving the last stage, in completion order. Items whose
+    stage raised come out as FailedItem. Once cancel_token is cancelled,
+    items not yet started are dropped (counted as skipped) and the run
+    drains; the stages' own work should watch the same token. If the input
+    iterable raises, the items read before it still come out and iteration
+    then raises its error. A pipeline runs once.
+    """
+
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE, cancel_token=None):
+        self.stages = list(stages)
+        self.queue_size = queue_size
+        self.cancel_token = cancel_token
+        self.stats = [StageStats(stage.name, stage.workers) for stage in self.stages]
+        # Queue in front of each stage, then the output queue
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in self.stages] + [queue.Queue(maxsize=queue_size)]
+        self._threads = []
+        self._running = [stage.workers for stage in self.stages]
+        self._lock = threading.Lock()
+        # Raised by the input iterable, re-raised to the consumer at the end of the run
+        self._feed_error = None
+
+    @property
+    def cancelled(self):
+        return self.cancel_token is not None and self.cancel_token.cancelled
+
+    def run(self, items):
+        feeder = threading.Thread(target=self._feed, args=(iter(items),), name="pipeline-feed", daemon=True)
+        self._threads.append(feeder)
+        for number, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                self._threads.append(threading.Thread(
+                    target=self._work, args=(number,), name=f"pipeline-{stage.name}-{worker}", daemon=True
+                ))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self._queues[-1].get()
+        if item is _DONE:
+            # Leave the marker for anyone else iterating, and for repeated next() calls
+            self._queues[-1].put(_DONE)
+            if self._feed_error is not None:
+                raise self._feed_error
+            raise StopIteration
+        return item
+
+    def _feed(self, items):
+        try:
+            for item in items:
+                if self.cancelled:
+                    break
+                self._queues[0].put(item)
+        except Exception as e:
+            self._feed_error = e
+        finally:
+            # Always end the run, or every worker would wait on the inbox forever
+            self._queues[0].put(_DONE)
+
+    def _work(self, number):
+        stage = self.stages[number]
+        stats = self.stats[number]
+        inbox, outbox = self._queues[number], self._queues[number + 1]
+        with self._lock:
+            if stats.started is None:
+                stats.started = time.monotonic()
+        while True:
+            waiting_since = time.monotonic()
+            item = inbox.get()
+            stats.add("waiting", time.monotonic() - waiting_since)
+            if item is _DONE:
+                # Put it back for this stage's other workers; the last one passes it on
+                inbox.put(_DONE)
+                break
+            if isinstance(item, FailedItem):
+                result = item
+            elif self.cancelled:
+                stats.add("skipped", 1)
+                continue
+            else:
+                started = time.monotonic()
+                try:
+                    result = stage.func(item)
+                    stats.add("items", 1)
+                except Exception as e:
+                    result = FailedItem(item, stage.name, e)
+                    stats.add("failed", 1)
+                stats.add("busy", time.monotonic() - started)
+            blocked_since = time.monotonic()
+            outbox.put(result)
+            stats.add("blocked", time.monotonic() - blocked_since)
+        with self._lock:
+            self._running[number] -= 1
+            last = self._running[number] == 0
+            if last:
+                stats.finished = time.monotonic()
+        if last:
+            outbox.put(_DONE)
+
+    def bottleneck(self):
+        """The StageStats of the busiest stage"""
+        return max(self.stats, key=lambda stats: stats.utilization) if self.stats else None
+
+    def summary(self):
+        return "\n".join(stats.summary() for stats in self.stats)
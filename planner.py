@@ -0,0 +1,217 @@
+"""
+Dry-run planning for parse jobs.
+
+plan_parse() works out what parse_with_gemini would do with the same
+content, description and settings without sending anything: which chunks
+the response cache already answers, how the rest are packed into requests,
+how many tokens they carry, and when each request could start under the
+configured rate limits and concurrency. The schedule is simulated with a
+RateLimiter on a virtual clock, starting from an idle quota, so limits are
+applied exactly as in a real run. Latency comes from the requests this
+process has already made, or a default model when there is no history yet.
+"""
+import parse
+from parse import (
+    AdaptiveConcurrency,
+    build_batch_prompt,
+    build_prompt,
+    build_records_question,
+    default_route,
+    multi_question_template,
+    pack_batches,
+    prompt_prefix,
+    relevance_score,
+    request_latencies,
+    response_cache_key,
+    token_estimator,
+)
+from dispatch import DEFAULT_MAX_IN_FLIGHT
+from llm_cache import get_response_cache
+from rate_limiter import RateLimiter
+from records import RecordSchema, infer_schema
+
+# Latency model used until this process has observed real requests
+DEFAULT_BASE_LATENCY = 1.5
+DEFAULT_OUTPUT_TOKENS_PER_SECOND = 150.0
+# Output tokens expected per prompt token, and the share of requests expected to be retried
+DEFAULT_OUTPUT_RATIO = 0.15
+DEFAULT_RETRY_RATE = 0.05
+
+
+class Saving:
+    """Requests, tokens and cost a feature saves (or could save) compared with not using it"""
+
+    def __init__(self, requests=0, tokens=0, cost=0.0, applied=True):
+        self.requests = requests
+        self.tokens = tokens
+        self.cost = cost
+        # False for savings the current settings would not realize
+        self.applied = applied
+
+    def summary(self):
+        return f"{self.requests} requests, {self.tokens:,} tokens, ${self.cost:.4f}"
+
+
+class ParsePlan:
+    """The expected shape and price of a parse job"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.requests = 0
+        self.retries = 0
+        self.cached_chunks = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.seconds = 0.0
+        self.cost = 0.0
+        self.max_in_flight = 0
+        # Feature name -> Saving
+        self.savings = {}
+        self.warnings = []
+
+    def summary(self):
+        return (f"{self.requests} requests (+~{self.retries} retries) for {self.chunks} chunks, "
+                f"~{self.input_tokens:,} input / ~{self.output_tokens:,} output tokens, "
+                f"~{self.seconds:.0f}s, ~${self.cost:.4f}")
+
+    def savings_summary(self):
+        return "; ".join(
+            f"{name}: {saving.summary()}" + ("" if saving.applied else " (not enabled)")
+            for name, saving in self.savings.items()
+        )
+
+
+def request_latency(output_tokens):
+    """Expected seconds for one request: observed median if there is history, else the default model"""
+    observed = request_latencies.percentile(50)
+    if observed is not None:
+        return observed
+    return DEFAULT_BASE_LATENCY + output_tokens / DEFAULT_OUTPUT_TOKENS_PER_SECOND
+
+
+def simulate_schedule(requests, limits, max_in_flight, adaptive=True):
+    """
+    Wall-clock seconds to run `requests` [(tokens, latency), ...] in order under `limits`,
+    with at most max_in_flight running (ramping up from AdaptiveConcurrency's slow start
+    when adaptive). Mirrors DispatchEngine: a request starts once it holds a window slot
+    and its rate-limit reservation comes round.
+    """
+    clock = [0.0]
+    limiter = RateLimiter(limits, clock=lambda: clock[0])
+    window = AdaptiveConcurrency(ceiling=max_in_flight).limit if adaptive else max_in_flight
+    finishes = []
+    end = 0.0
+    for tokens, latency in requests:
+        finishes.sort()
+        # Slots free up as running requests finish; each success grows the window in slow start
+        while len(finishes) >= window:
+            clock[0] = max(clock[0], finishes.pop(0))
+            if adaptive:
+                window = min(max_in_flight, window + 1)
+        reservation = limiter.reserve(tokens)
+        finish = max(clock[0], reservation.start_at) + latency
+        finishes.append(finish)
+        end = max(end, finish)
+    return end
+
+
+def plan_parse(dom_chunks, parse_description, max_workers=None, adaptive=True, batch_size=1,
+               use_cache=True, schema=None, limit=None, limits=None, output_ratio=DEFAULT_OUTPUT_RATIO,
+               retry_rate=DEFAULT_RETRY_RATE):
+    """
+    Estimate a parse_with_gemini job with the same arguments, without making any requests.
+
+    limits defaults to the process's rate limits; max_workers to the same cap
+    parse_with_gemini uses. Output tokens are estimated as output_ratio of the
+    prompt tokens and retry_rate of requests are assumed to be retried.
+
+    Returns a ParsePlan. Its savings break down what the response cache and
+    prompt packing save on this job, and what skipping chunks that never
+    mention the description would save when a result limit ends the job early.
+    """
+    limits = limits or parse.rate_limiter.limits
+    if max_workers is None:
+        max_workers = min(DEFAULT_MAX_IN_FLIGHT, limits.rpm) if limits.rpm else DEFAULT_MAX_IN_FLIGHT
+    multi_question = not isinstance(parse_description, str)
+    if schema is True and not multi_question:
+        schema = infer_schema(parse_description)
+    elif isinstance(schema, str):
+        schema = RecordSchema.parse(schema)
+    if multi_question or schema:
+        batch_size = 1
+    route = default_route()
+    cache = get_response_cache() if use_cache else None
+    plan = ParsePlan(len(dom_chunks))
+
+    def single_prompt(chunk):
+        if schema:
+            return prompt_prefix(chunk) + build_records_question(parse_description, schema)
+        return build_prompt(chunk, parse_description)
+
+    def chunk_tokens(chunk):
+        """Prompt tokens for a chunk sent on its own"""
+        if multi_question:
+            return token_estimator.estimate(
+                prompt_prefix(chunk) + multi_question_template + "\n".join(parse_description)
+            )
+        return token_estimator.estimate(single_prompt(chunk))
+
+    def is_cached(chunk):
+        if cache is None:
+            return False
+        if multi_question:
+            return all(cache.contains(response_cache_key(build_prompt(chunk, question), route))
+                       for question in parse_description)
+        return cache.contains(response_cache_key(single_prompt(chunk), route))
+
+    def price(tokens):
+        return route.cost(tokens, 0, int(tokens * output_ratio))
+
+    cached = [is_cached(chunk) for chunk in dom_chunks]
+    plan.cached_chunks = sum(cached)
+    cache_tokens = sum(chunk_tokens(chunk) for chunk, hit in zip(dom_chunks, cached) if hit)
+    plan.savings["response cache"] = Saving(plan.cached_chunks, cache_tokens, price(cache_tokens), use_cache)
+
+    # Requests as parse_with_gemini packs them; cached chunks drop out of their batch
+    chunk_data = [(index, chunk, parse_description) for index, chunk in enumerate(dom_chunks)]
+    batches = pack_batches(chunk_data, batch_size) if batch_size > 1 else [[c] for c in chunk_data]
+    request_tokens = []
+    for batch in batches:
+        pending = [data for data in batch if not cached[data[0]]]
+        if len(pending) > 1:
+            request_tokens.append(token_estimator.estimate(build_batch_prompt(pending)[0]))
+        elif pending:
+            request_tokens.append(chunk_tokens(pending[0][1]))
+    unbatched = [chunk_tokens(chunk) for chunk, hit in zip(dom_chunks, cached) if not hit]
+    if batch_size > 1:
+        saved_tokens = max(0, sum(unbatched) - sum(request_tokens))
+        plan.savings["prompt packing"] = Saving(len(unbatched) - len(request_tokens), saved_tokens, price(saved_tokens))
+
+    if not multi_question:
+        # Chunks that never mention the description rarely hold results; with a limit
+        # and relevance order they are dispatched last and usually skipped
+        unrelated = [chunk_tokens(chunk) for chunk, hit in zip(dom_chunks, cached)
+                     if not hit and relevance_score(chunk, parse_description) == 0]
+        plan.savings["relevance (skipped after limit)"] = Saving(
+            len(unrelated), sum(unrelated), price(sum(unrelated)), applied=bool(limit)
+        )
+
+    plan.requests = len(request_tokens)
+    plan.retries = round(plan.requests * retry_rate)
+    plan.input_tokens = int(sum(request_tokens) * (1 + retry_rate))
+    plan.output_tokens = int(plan.input_tokens * output_ratio)
+    plan.cost = route.cost(plan.input_tokens, 0, plan.output_tokens)
+    plan.max_in_flight = min(max_workers, limits.rpm) if limits.rpm else max_workers
+
+    schedule = [(tokens + int(tokens * output_ratio), request_latency(tokens * output_ratio))
+                for tokens in request_tokens]
+    # Retries go to the back of the queue, as their backoff delays them past the first pass
+    schedule += schedule[:plan.retries]
+    plan.seconds = simulate_schedule(schedule, limits, plan.max_in_flight, adaptive)
+
+    if limits.rpd and plan.requests + plan.retries > limits.rpd:
+        plan.warnings.append(f"{plan.requests + plan.retries} requests exceed the daily quota of {limits.rpd}")
+    if limits.tpd and plan.input_tokens + plan.output_tokens > limits.tpd:
+        plan.warnings.append(f"~{plan.input_tokens + plan.output_tokens:,} tokens exceed the daily quota of "
+                             f"{limits.tpd:,}")
+    return plan
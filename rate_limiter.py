@@ -0,0 +1,361 @@
+"""
+Client-side rate limiting for the Gemini API.
+
+The limiter hands out reservations: under a short lock it works out the
+earliest moment a request may start (GCRA for requests per minute, sliding
+windows for tokens per minute and requests per day) and books that slot.
+The caller then sleeps until its slot *outside* the lock, so workers waiting
+for quota never queue behind each other. To share one quota between
+processes or hosts, see shared_limiter and make_rate_limiter().
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+# Published Gemini API quotas per tier and model.
+# rpm = requests per minute, tpm = tokens per minute, rpd = requests per day,
+# tpd = tokens per day. None (or a missing key) means the quota is not
+# enforced for that tier.
+TIER_PRESETS = {
+    "free": {
+        "gemini-2.5-pro": {"rpm": 5, "tpm": 250_000, "rpd": 100},
+        "gemini-2.5-flash": {"rpm": 10, "tpm": 250_000, "rpd": 250},
+        "gemini-2.5-flash-lite": {"rpm": 15, "tpm": 250_000, "rpd": 1_000},
+    },
+    "tier1": {
+        "gemini-2.5-pro": {"rpm": 150, "tpm": 2_000_000, "rpd": 10_000},
+        "gemini-2.5-flash": {"rpm": 1_000, "tpm": 1_000_000, "rpd": 10_000},
+        "gemini-2.5-flash-lite": {"rpm": 4_000, "tpm": 4_000_000, "rpd": None},
+    },
+    "tier2": {
+        "gemini-2.5-pro": {"rpm": 1_000, "tpm": 5_000_000, "rpd": 50_000},
+        "gemini-2.5-flash": {"rpm": 2_000, "tpm": 3_000_000, "rpd": 100_000},
+        "gemini-2.5-flash-lite": {"rpm": 10_000, "tpm": 10_000_000, "rpd": None},
+    },
+    "tier3": {
+        "gemini-2.5-pro": {"rpm": 2_000, "tpm": 8_000_000, "rpd": None},
+        "gemini-2.5-flash": {"rpm": 10_000, "tpm": 8_000_000, "rpd": None},
+        "gemini-2.5-flash-lite": {"rpm": 30_000, "tpm": 30_000_000, "rpd": None},
+    },
+}
+
+DEFAULT_TIER = os.getenv("GEMINI_TIER", "free")
+
+# Fraction of the published quota we allow ourselves to use, so clock skew
+# and requests made outside this process don't push us over the edge.
+DEFAULT_SAFETY_MARGIN = float(os.getenv("GEMINI_RATE_SAFETY_MARGIN", "0.9"))
+
+MINUTE = 60.0
+DAY = 86_400.0
+
+
+class RateLimits:
+    """Quota for one model: requests/minute, tokens/minute, requests/day, tokens/day"""
+
+    def __init__(self, rpm=None, tpm=None, rpd=None, tpd=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.rpd = rpd
+        self.tpd = tpd
+
+    def scaled(self, factor):
+        """Return a copy with every quota multiplied by factor (rounded down, at least 1)"""
+        def scale(value):
+            return None if value is None else max(1, int(value * factor))
+        return RateLimits(rpm=scale(self.rpm), tpm=scale(self.tpm), rpd=scale(self.rpd), tpd=scale(self.tpd))
+
+    def as_dict(self):
+        return {"rpm": self.rpm, "tpm": self.tpm, "rpd": self.rpd, "tpd": self.tpd}
+
+    def __repr__(self):
+        return f"RateLimits(rpm={self.rpm}, tpm={self.tpm}, rpd={self.rpd}, tpd={self.tpd})"
+
+
+def limits_for(model_name, tier=None):
+    """
+    Look up the quota for a model on a tier.
+
+    Environment overrides (GEMINI_RPM, GEMINI_TPM, GEMINI_RPD, GEMINI_TPD) win over the
+    preset, which lets keys with custom quotas be configured without code.
+    """
+    tier = tier or DEFAULT_TIER
+    if tier not in TIER_PRESETS:
+        raise ValueError(f"Unknown rate limit tier '{tier}'. Choose from: {', '.join(TIER_PRESETS)}")
+
+    short_name = model_name.split("/")[-1]
+    preset = TIER_PRESETS[tier].get(short_name)
+    if preset is None:
+        # Unknown model: fall back to the most conservative preset of the tier
+        preset = min(TIER_PRESETS[tier].values(), key=lambda p: p["rpm"])
+
+    return apply_env_overrides(RateLimits(**preset))
+
+
+def apply_env_overrides(limits):
+    """Apply GEMINI_RPM / GEMINI_TPM / GEMINI_RPD / GEMINI_TPD overrides to limits in place and return them"""
+    for key in ("rpm", "tpm", "rpd", "tpd"):
+        override = os.getenv(f"GEMINI_{key.upper()}")
+        if override:
+            setattr(limits, key, int(override) if override.lower() != "none" else None)
+    return limits
+
+
+class Reservation:
+    """
+    A booked request slot. start_at is the clock time the request may begin;
+    tokens is the estimate booked against the token quotas until the real
+    usage is known (see RateLimiter.reconcile).
+    """
+
+    def __init__(self, start_at, tokens, entry=None):
+        self.start_at = start_at
+        self.tokens = tokens
+        self._entry = entry
+
+    @property
+    def booked_tokens(self):
+        return self._entry[1] if self._entry is not None else self.tokens
+
+    def delay(self, now=None):
+        now = time.time() if now is None else now
+        return max(0.0, self.start_at - now)
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter combining a GCRA for requests per minute with
+    sliding windows for tokens per minute and requests/tokens per day.
+
+    reserve() only books a slot and returns immediately; acquire() books a
+    slot and then sleeps until it comes round, without holding the lock.
+    Token counts booked up front are estimates; reconcile() replaces them
+    with the usage the API reports once the response arrives.
+    """
+
+    def __init__(self, limits, safety_margin=DEFAULT_SAFETY_MARGIN, burst=None, clock=time.time, sleep=time.sleep):
+        self.limits = limits
+        self.effective = limits.scaled(safety_margin)
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+
+        # GCRA state: theoretical arrival time of the next request
+        self._tat = 0.0
+        if self.effective.rpm:
+            self._interval = MINUTE / self.effective.rpm
+            if burst is None:
+                burst = max(1, self.effective.rpm // 10)
+            self._tolerance = self._interval * (burst - 1)
+        else:
+            self._interval = 0.0
+            self._tolerance = 0.0
+
+        # Sliding windows hold [start_at, tokens] entries in start order.
+        # Both windows share the same entry lists so reconcile() updates both.
+        self._minute_window = deque()
+        self._day_window = deque()
+
+    def _expire(self, now):
+        while self._minute_window and self._minute_window[0][0] <= now - MINUTE:
+            self._minute_window.popleft()
+        while self._day_window and self._day_window[0][0] <= now - DAY:
+            self._day_window.popleft()
+
+    @staticmethod
+    def _earliest_in_window(window, span, start, tokens, limit):
+        """Earliest time >= start at which `tokens` more fit under `limit` in a sliding window"""
+        tokens = min(tokens, limit)
+        # Slots are booked in order, so only the window ending at start matters
+        if window:
+            start = max(start, window[-1][0])
+        in_window = [entry for entry in window if entry[0] > start - span]
+        used = sum(entry[1] for entry in in_window)
+        # Walk forward through the window until enough tokens have expired
+        for entry in in_window:
+            if used + tokens <= limit:
+                break
+            used -= entry[1]
+            start = max(start, entry[0] + span)
+        return start
+
+    def _earliest_for_tokens(self, start, tokens):
+        """Earliest time >= start at which `tokens` more fit in the per-minute and per-day token budgets"""
+        if self.effective.tpd:
+            start = self._earliest_in_window(self._day_window, DAY, start, tokens, self.effective.tpd)
+        if self.effective.tpm:
+            start = self._earliest_in_window(self._minute_window, MINUTE, start, tokens, self.effective.tpm)
+        return start
+
+    def _earliest_for_day(self, start):
+        limit = self.effective.rpd
+        if not limit:
+            return start
+        in_window = [entry[0] for entry in self._day_window if entry[0] > start - DAY]
+        if len(in_window) < limit:
+            return start
+        return max(start, in_window[len(in_window) - limit] + DAY)
+
+    def reserve(self, tokens=0):
+        """Book the earliest slot that respects every quota and return its Reservation"""
+        with self._lock:
+            return self._reserve(tokens)
+
+    async def reserve_async(self, tokens=0):
+        """reserve() for the event loop; an in-process limiter books without waiting on anything"""
+        return self.reserve(tokens)
+
+    def _reserve(self, tokens):
+        now = self.clock()
+        self._expire(now)
+
+        start = max(now, self._tat - self._tolerance)
+        start = self._earliest_for_day(start)
+        start = self._earliest_for_tokens(start, tokens)
+
+        if self._interval:
+            self._tat = max(self._tat, start) + self._interval
+        entry = [start, tokens]
+        if self.effective.tpm:
+            self._minute_window.append(entry)
+        if self.effective.rpd or self.effective.tpd:
+            self._day_window.append(entry)
+        return Reservation(start, tokens, entry)
+
+    def reconcile(self, reservation, actual_tokens):
+        """Replace a reservation's estimated tokens with the usage reported by the API"""
+        if reservation is None or reservation._entry is None:
+            return
+        with self._lock:
+            reservation._entry[1] = max(0, int(actual_tokens))
+
+    def acquire(self, tokens=0, cancel_token=None):
+        """
+        Reserve a slot and sleep until it starts. The lock is not held while sleeping.
+        With a cancel_token the wait ends early (raising JobCancelled) when it is cancelled;
+        the slot stays booked, like a request that was sent.
+        """
+        reservation = self.reserve(tokens)
+        delay = reservation.delay(self.clock())
+        if delay > 0:
+            if delay > 1:
+                print(f"⏳ Rate limit protection: waiting {delay:.1f} seconds...")
+            if cancel_token is not None:
+                cancel_token.sleep(delay)
+            else:
+                self.sleep(delay)
+        return reservation
+
+    async def acquire_async(self, tokens=0):
+        """Asyncio counterpart of acquire(): reserve a slot and await it without blocking the loop"""
+        reservation = await self.reserve_async(tokens)
+        delay = reservation.delay(self.clock())
+        if delay > 0:
+            if delay > 1:
+                print(f"⏳ Rate limit protection: waiting {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+        return reservation
+
+    def headroom(self):
+        """
+        Current spare capacity against each quota.
+
+        Returns a dict with the requests and tokens still available in the
+        current minute, requests and tokens left today (None when unlimited)
+        and the seconds until the next request slot opens.
+        """
+        with self._lock:
+            return self._headroom()
+
+    async def headroom_async(self):
+        """headroom() for the event loop"""
+        return self.headroom()
+
+    def _headroom(self):
+        now = self.clock()
+        self._expire(now)
+
+        requests_left = None
+        if self.effective.rpm:
+            backlog = max(0.0, self._tat - now)
+            requests_left = max(0, int((MINUTE - backlog) / self._interval))
+
+        tokens_left = None
+        if self.effective.tpm:
+            used = sum(entry[1] for entry in self._minute_window)
+            tokens_left = max(0, self.effective.tpm - used)
+
+        day_left = None
+        if self.effective.rpd:
+            day_left = max(0, self.effective.rpd - len(self._day_window))
+
+        day_tokens_left = None
+        if self.effective.tpd:
+            used = sum(entry[1] for entry in self._day_window)
+            day_tokens_left = max(0, self.effective.tpd - used)
+
+        next_slot = max(now, self._tat - self._tolerance)
+        next_slot = self._earliest_for_day(next_slot)
+
+        return {
+            "requests_per_minute": requests_left,
+            "tokens_per_minute": tokens_left,
+            "requests_today": day_left,
+            "tokens_today": day_tokens_left,
+            "next_slot_in": max(0.0, next_slot - now),
+        }
+
+
+def make_rate_limiter(limits, name):
+    """
+    A limiter for `limits`. In-process by default; when RATE_LIMIT_STORE names a
+    SQLite file or a redis:// URL, a SharedRateLimiter that books slots under `name`
+    in that store, so every process using it shares one quota.
+    """
+    store_url = os.getenv("RATE_LIMIT_STORE")
+    if not store_url:
+        return RateLimiter(limits)
+    # Imported here: shared_limiter builds on this module
+    from shared_limiter import SharedRateLimiter, open_store
+    return SharedRateLimiter(limits, open_store(store_url), name)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model_name, tier=None):
+    """Return the process-wide limiter for a model on a tier, creating it on first use"""
+    tier = tier or DEFAULT_TIER
+    key = (model_name, tier)
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = make_rate_limiter(limits_for(model_name, tier), f"{model_name}:{tier}")
+        return _limiters[key]
+
+
+class TokenEstimator:
+    """
+    Estimates prompt tokens from text length before a call is made.
+
+    Starts from the usual ~4 characters per token for English text and
+    calibrates itself from the prompt_token_count the API reports, so pages
+    in other languages or with dense markup converge on their real ratio.
+    """
+
+    def __init__(self, chars_per_token=4.0, smoothing=0.2):
+        self.chars_per_token = chars_per_token
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+
+    def estimate(self, text):
+        return max(1, int(len(text) / self.chars_per_token) + 1)
+
+    def observe(self, text, prompt_tokens):
+        """Fold a measured (text, prompt_token_count) pair into the running ratio"""
+        if not text or not prompt_tokens:
+            return
+        ratio = len(text) / prompt_tokens
+        with self._lock:
+            self.chars_per_token += self.smoothing * (ratio - self.chars_per_token)
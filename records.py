@@ -0,0 +1,258 @@
+"""
+Structured extraction: field schemas, validation and record merging.
+
+In structured mode each chunk is answered as JSON records constrained by a
+RecordSchema (a response_schema for the model), and the records from all
+chunks are merged locally: values are normalized per field type, records
+missing every key field are dropped, and duplicates (the same key fields,
+compared case- and whitespace-insensitively) are folded into one record,
+keeping the first value seen for each field. No second LLM pass is needed
+to clean up the output.
+"""
+import csv
+import io
+import re
+
+FIELD_TYPES = ("string", "number", "integer", "boolean")
+
+# Gemini response_schema type names for each field type
+_SCHEMA_TYPES = {"string": "STRING", "number": "NUMBER", "integer": "INTEGER", "boolean": "BOOLEAN"}
+
+# Last words (singular) that make an inferred field numeric; "number of ..." is an integer too
+_NUMERIC_WORDS = ("price", "cost", "amount", "rating", "score", "count", "quantity", "review", "year", "age",
+                  "weight")
+_INTEGER_WORDS = ("count", "quantity", "review", "year", "age")
+_TRUE_WORDS = ("true", "yes", "y", "1", "in stock", "available")
+_FALSE_WORDS = ("false", "no", "n", "0", "out of stock", "unavailable")
+
+# A number whose thousands may be grouped with commas or spaces (the same separator throughout)
+_NUMBER = re.compile(r"-?\d{1,3}([,\s])\d{3}(?!\d)(?:\1\d{3}(?!\d))*(?:\.\d+)?|-?\d+(?:\.\d+)?")
+
+
+class RecordSchema:
+    """
+    Fields to extract, in column order, with their types and the key fields
+    that identify a record for deduplication (all fields when not given).
+    """
+
+    def __init__(self, fields, key_fields=None):
+        if not fields:
+            raise ValueError("A record schema needs at least one field")
+        self.fields = dict(fields)
+        for name, field_type in self.fields.items():
+            if field_type not in FIELD_TYPES:
+                raise ValueError(f"Unknown type '{field_type}' for field '{name}'")
+        self.key_fields = list(key_fields or self.fields)
+        unknown = [name for name in self.key_fields if name not in self.fields]
+        if unknown:
+            raise ValueError(f"Key fields not in the schema: {', '.join(unknown)}")
+
+    @classmethod
+    def parse(cls, spec):
+        """
+        Schema from a spec like "name*, price:number, url": comma-separated field
+        names, an optional :type each, and * marking key fields.
+        """
+        fields = {}
+        key_fields = []
+        for item in spec.split(","):
+            name, _, field_type = item.strip().partition(":")
+            name = name.strip()
+            if not name:
+                continue
+            if name.endswith("*"):
+                name = name[:-1].strip()
+                key_fields.append(field_name(name))
+            fields[field_name(name)] = field_type.strip().lower() or "string"
+        return cls(fields, key_fields)
+
+    def response_schema(self):
+        """
+        Gemini response_schema for {"records": [ {field: value, ...}, ... ]}. Key
+        fields are required; the others may be null when the content doesn't give them.
+        """
+        return {
+            "type": "OBJECT",
+            "properties": {
+                "records": {
+                    "type": "ARRAY",
+                    "items": {
+                        "type": "OBJECT",
+                        "properties": {
+                            name: {"type": _SCHEMA_TYPES[t]} if name in self.key_fields
+                            else {"type": _SCHEMA_TYPES[t], "nullable": True}
+                            for name, t in self.fields.items()
+                        },
+                        "required": list(self.key_fields),
+                    },
+                },
+            },
+            "required": ["records"],
+        }
+
+    def spec(self):
+        """The schema as a spec string that parse() reads back"""
+        return ", ".join(
+            name + ("*" if name in self.key_fields else "") + ("" if field_type == "string" else f":{field_type}")
+            for name, field_type in self.fields.items()
+        )
+
+    def describe(self):
+        return ", ".join(f"{name} ({field_type})" for name, field_type in self.fields.items())
+
+    def __repr__(self):
+        return f"RecordSchema({self.fields!r}, key_fields={self.key_fields!r})"
+
+
+def field_name(text):
+    """A label like "Product Name" as a field name: product_name"""
+    return re.sub(r"[^0-9a-z]+", "_", text.strip().lower()).strip("_") or "value"
+
+
+def singular(word):
+    """A plural word as singular: prices -> price, countries -> country, addresses -> address"""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith(("sses", "xes", "ches", "shes")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def infer_type(words):
+    """Field type for an item's words, from its last word; string when unsure"""
+    if words[:2] == ["number", "of"] or words[-1] in _INTEGER_WORDS:
+        return "integer"
+    if words[-1] in _NUMERIC_WORDS:
+        return "number"
+    return "string"
+
+
+def infer_schema(parse_description):
+    """
+    Guess a schema from a description such as "product names, prices and ratings":
+    one field per listed item (its last word singularized), typed by that word,
+    keyed by the first field. Falls back to a single string field named "value".
+    """
+    text = re.sub(r"^\s*(extract|get|find|list|return|all|the)\b\s*", "", parse_description.strip(), flags=re.I)
+    text = re.sub(r"^\s*(all|the)\b\s*", "", text, flags=re.I)
+    items = [item.strip() for item in re.split(r",|\band\b|\bwith\b|;|/", text.rstrip(".")) if item.strip()]
+    if len(items) < 2:
+        return RecordSchema({"value": "string"})
+    fields = {}
+    for item in items:
+        words = re.findall(r"[0-9a-z]+", item.lower())
+        if not words:
+            continue
+        if words[:2] != ["number", "of"]:
+            words[-1] = singular(words[-1])
+        fields[field_name(" ".join(words))] = infer_type(words)
+    if not fields:
+        return RecordSchema({"value": "string"})
+    return RecordSchema(fields, [next(iter(fields))])
+
+
+def normalize_value(value, field_type):
+    """Coerce a model-produced value to the field type; None when it is empty or unusable"""
+    if value is None:
+        return None
+    if field_type == "string":
+        text = " ".join(str(value).split())
+        return text or None
+    if field_type == "boolean":
+        if isinstance(value, bool):
+            return value
+        text = str(value).strip().lower()
+        if text in _TRUE_WORDS:
+            return True
+        if text in _FALSE_WORDS:
+            return False
+        return None
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        number = value
+    else:
+        # "$1,299.00", "4.5 out of 5", "1 299 reviews"; "12, 5 stars" is 12
+        match = _NUMBER.search(str(value))
+        if not match:
+            return None
+        try:
+            number = float(re.sub(r"[,\s]", "", match.group()))
+        except ValueError:
+            return None
+    if field_type == "integer":
+        return int(number)
+    return float(number)
+
+
+def validate_record(record, schema):
+    """The record normalized to the schema's fields, or None when it has no key field value"""
+    if not isinstance(record, dict):
+        return None
+    fields = {field_name(key): value for key, value in record.items()}
+    normalized = {name: normalize_value(fields.get(name), field_type) for name, field_type in schema.fields.items()}
+    if all(normalized[name] is None for name in schema.key_fields):
+        return None
+    return normalized
+
+
+def record_key(record, schema):
+    return tuple(
+        " ".join(str(record[name]).lower().split()) if record[name] is not None else None
+        for name in schema.key_fields
+    )
+
+
+class RecordMerger:
+    """
+    Merges validated records from many chunks. Records are kept in the order
+    first seen; a duplicate fills in fields the first copy was missing.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.duplicates = 0
+        self.invalid = 0
+        self._records = {}
+
+    def add(self, records):
+        for record in records:
+            record = validate_record(record, self.schema)
+            if record is None:
+                self.invalid += 1
+                continue
+            key = record_key(record, self.schema)
+            existing = self._records.get(key)
+            if existing is None:
+                self._records[key] = record
+                continue
+            self.duplicates += 1
+            for name, value in record.items():
+                if existing[name] is None:
+                    existing[name] = value
+
+    @property
+    def records(self):
+        return list(self._records.values())
+
+    def summary(self):
+        return f"{len(self._records)} records ({self.duplicates} duplicates merged, {self.invalid} invalid dropped)"
+
+
+def merge_records(record_lists, schema):
+    """Merge lists of raw records (in document order) into one deduplicated list"""
+    merger = RecordMerger(schema)
+    for records in record_lists:
+        merger.add(records)
+    return merger.records
+
+
+def records_to_csv(records, schema):
+    """Records as CSV text with the schema's fields as columns"""
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=list(schema.fields), extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(records)
+    return output.getvalue()
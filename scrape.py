@@ -10,14 +10,24 @@ from selenium.webdriver.common.action_chains import ActionChains
 from webdriver_manager.chrome import ChromeDriverManager
 import time
 import os
+from cancellation import JobCancelled
 
 load_dotenv()
 
+# Seconds before a page load is abandoned
+PAGE_LOAD_TIMEOUT = float(os.getenv("SCRAPE_PAGE_LOAD_TIMEOUT", "60"))
 
 
+def scrape_website(website, cancel_token=None, page_load_timeout=PAGE_LOAD_TIMEOUT):
+    """
+    Load a page in headless Chrome and return its HTML.
 
-def scrape_website(website):
+    Cancelling cancel_token quits the browser, which aborts a page load in
+    progress; scrape_website then raises JobCancelled.
+    """
     print("Connecting to Scraping Browser...")
+    if cancel_token is not None:
+        cancel_token.raise_if_cancelled()
     
     # Configure Chrome options
     chrome_options = Options()
@@ -31,9 +41,19 @@ def scrape_website(website):
     # Set up the WebDriver with automatic ChromeDriver management
     service = Service(ChromeDriverManager().install())
     driver = webdriver.Chrome(service=service, options=chrome_options)
+    driver.set_page_load_timeout(page_load_timeout)
+    stop_listening = cancel_token.add_callback(driver.quit) if cancel_token is not None else None
     
     try:
-        driver.get(website)
+        try:
+            driver.get(website)
+        except Exception:
+            # Quitting the driver from another thread makes the pending load fail
+            if cancel_token is not None and cancel_token.cancelled:
+                raise JobCancelled(cancel_token.reason)
+            raise
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
         
         
         # Simulate CAPTCHA waiting if present
@@ -45,7 +65,11 @@ def scrape_website(website):
         return html
 
     finally:
-        driver.quit()
+        if stop_listening:
+            stop_listening()
+        # A cancelled token has already quit the driver
+        if cancel_token is None or not cancel_token.cancelled:
+            driver.quit()
 
 def extract_body_content(html_content):
     soup = BeautifulSoup(html_content, "html.parser")
@@ -0,0 +1,421 @@
+"""
+Rate limiting shared between processes and hosts.
+
+A RateLimiter keeps its GCRA and sliding-window state in memory, which is
+right for one process but lets every Streamlit replica or worker on the
+same API key spend the whole quota. SharedRateLimiter runs the same
+algorithm over state held in a store, and books each reservation
+atomically there, so the whole fleet respects one quota:
+
+- SQLiteLimiterStore: a SQLite file, for processes on one host. Each
+  reservation is a BEGIN IMMEDIATE transaction, so SQLite's file lock
+  serializes them.
+- RedisLimiterStore: Redis or any server speaking its protocol, for many
+  hosts. Each reservation is an optimistic WATCH/MULTI/EXEC transaction,
+  retried when another client booked in between. Needs the optional
+  `redis` package.
+
+Only the last minute of bookings is kept request by request (for the
+tokens-per-minute window); daily quotas are counted in DAY_BUCKET
+aggregates, so a booking reads at most a few hundred rows however busy the
+day was. A request counts against the day until a day after the last
+booking in its bucket, slightly later than it strictly has to.
+
+Set RATE_LIMIT_STORE to a SQLite path (or sqlite:///path) or a redis:// URL
+and rate_limiter.make_rate_limiter() returns shared limiters. Every process
+sharing a limiter name must use the same limits, and hosts need synchronized
+clocks, since slots are booked in wall-clock time.
+"""
+import asyncio
+import concurrent.futures
+import os
+import sqlite3
+import threading
+from collections import deque
+
+from rate_limiter import DAY, MINUTE, RateLimiter, Reservation
+
+DEFAULT_SQLITE_PATH = os.path.join(".cache", "rate_limits.sqlite3")
+# Daily quotas are counted per bucket of this many seconds
+DAY_BUCKET = DAY / 96
+# headroom() answers from the last state seen for this long before reading the store again
+DEFAULT_HEADROOM_TTL = 0.25
+
+
+def day_bucket(start_at):
+    return int(start_at // DAY_BUCKET)
+
+
+class SQLiteLimiterStore:
+    """Limiter state in a SQLite file shared by every process on the host"""
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # A generous busy timeout: other processes hold the write lock only for one booking
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS limiter_state (name TEXT PRIMARY KEY, tat REAL NOT NULL)")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS limiter_entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                start_at REAL NOT NULL,
+                tokens INTEGER NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS limiter_entries_name ON limiter_entries (name, start_at)")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS limiter_day (
+                name TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                requests INTEGER NOT NULL,
+                tokens INTEGER NOT NULL,
+                last_at REAL NOT NULL,
+                PRIMARY KEY (name, bucket)
+            )
+            """
+        )
+
+    def _read(self, name, since, day_since):
+        row = self._conn.execute("SELECT tat FROM limiter_state WHERE name = ?", (name,)).fetchone()
+        entries = []
+        if since is not None:
+            entries = [
+                [start_at, tokens, entry_id]
+                for entry_id, start_at, tokens in self._conn.execute(
+                    "SELECT id, start_at, tokens FROM limiter_entries WHERE name = ? AND start_at > ? "
+                    "ORDER BY start_at, id",
+                    (name, since)
+                )
+            ]
+        buckets = []
+        if day_since is not None:
+            buckets = [
+                [last_at, tokens, requests]
+                for last_at, tokens, requests in self._conn.execute(
+                    "SELECT last_at, tokens, requests FROM limiter_day WHERE name = ? AND last_at > ? ORDER BY bucket",
+                    (name, day_since)
+                )
+            ]
+        return (row[0] if row else 0.0), entries, buckets
+
+    def read(self, name, since, day_since):
+        """
+        The limiter's (tat, entries, buckets): entries are [start_at, tokens, id] after
+        `since`, buckets [last start_at, tokens, requests] per DAY_BUCKET after `day_since`;
+        none of either when its since is None.
+        """
+        with self._lock:
+            return self._read(name, since, day_since)
+
+    def update(self, name, since, day_since, book):
+        """
+        Atomically load the state, call book(tat, entries, buckets) -> (new_tat, entry) and
+        store the result. The new entry gets its id appended and is added to its day
+        bucket; entries up to `since` and buckets up to `day_since` are dropped.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                tat, entries, buckets = self._read(name, since, day_since)
+                tat, entry = book(tat, entries, buckets)
+                self._conn.execute("INSERT OR REPLACE INTO limiter_state (name, tat) VALUES (?, ?)", (name, tat))
+                entry_id = None
+                if since is not None:
+                    cursor = self._conn.execute(
+                        "INSERT INTO limiter_entries (name, start_at, tokens) VALUES (?, ?, ?)",
+                        (name, entry[0], entry[1])
+                    )
+                    entry_id = cursor.lastrowid
+                    self._conn.execute("DELETE FROM limiter_entries WHERE name = ? AND start_at <= ?", (name, since))
+                if day_since is not None:
+                    self._conn.execute(
+                        "INSERT INTO limiter_day (name, bucket, requests, tokens, last_at) VALUES (?, ?, 1, ?, ?) "
+                        "ON CONFLICT (name, bucket) DO UPDATE SET requests = requests + 1, "
+                        "tokens = tokens + excluded.tokens, last_at = MAX(last_at, excluded.last_at)",
+                        (name, day_bucket(entry[0]), entry[1], entry[0])
+                    )
+                    self._conn.execute("DELETE FROM limiter_day WHERE name = ? AND last_at <= ?", (name, day_since))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        entry.append(entry_id)
+        return entry
+
+    def set_tokens(self, name, entry, tokens):
+        """Correct a booked entry [start_at, tokens, id] to `tokens`, in its day bucket too"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if entry[2] is not None:
+                    self._conn.execute("UPDATE limiter_entries SET tokens = ? WHERE id = ?", (tokens, entry[2]))
+                self._conn.execute(
+                    "UPDATE limiter_day SET tokens = MAX(0, tokens + ?) WHERE name = ? AND bucket = ?",
+                    (tokens - entry[1], name, day_bucket(entry[0]))
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+
+class RedisLimiterStore:
+    """Limiter state in Redis (or a Redis-compatible server) shared by every host"""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("The Redis rate limit store needs the redis package: pip install redis") from None
+        self._redis = redis
+        self._client = redis.Redis.from_url(url)
+
+    @staticmethod
+    def _keys(name):
+        prefix = f"ratelimit:{name}"
+        return f"{prefix}:tat", f"{prefix}:entries", f"{prefix}:tokens", f"{prefix}:next_id"
+
+    @staticmethod
+    def _day_keys(name):
+        """Hashes of requests, tokens and last start_at per day bucket"""
+        prefix = f"ratelimit:{name}:day"
+        return f"{prefix}:requests", f"{prefix}:tokens", f"{prefix}:last"
+
+    def _read_day(self, client, name):
+        """{bucket: [last start_at, tokens, requests]} for every stored day bucket"""
+        requests_key, tokens_key, last_key = self._day_keys(name)
+        requests = client.hgetall(requests_key)
+        tokens = client.hgetall(tokens_key)
+        return {
+            int(bucket): [float(last_at), max(0, int(tokens.get(bucket, 0))), int(requests.get(bucket, 0))]
+            for bucket, last_at in client.hgetall(last_key).items()
+        }
+
+    def _read(self, client, name, since, day_since):
+        tat_key, entries_key, tokens_key, _ = self._keys(name)
+        tat = client.get(tat_key)
+        entries = []
+        if since is not None:
+            members = client.zrangebyscore(entries_key, f"({since}", "+inf", withscores=True)
+            tokens = client.hmget(tokens_key, [member for member, _ in members]) if members else []
+            entries = [[score, int(count or 0), member.decode()] for (member, score), count in zip(members, tokens)]
+        buckets = []
+        if day_since is not None:
+            buckets = [bucket for _, bucket in sorted(self._read_day(client, name).items()) if bucket[0] > day_since]
+        return float(tat or 0.0), entries, buckets
+
+    def read(self, name, since, day_since):
+        return self._read(self._client, name, since, day_since)
+
+    def update(self, name, since, day_since, book):
+        tat_key, entries_key, tokens_key, id_key = self._keys(name)
+        day_requests_key, day_tokens_key, day_last_key = self._day_keys(name)
+        with self._client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(tat_key, entries_key, day_last_key)
+                    tat, entries, buckets = self._read(pipe, name, since, day_since)
+                    tat, entry = book(tat, entries, buckets)
+                    entry_id = None
+                    expired = []
+                    if since is not None:
+                        entry_id = str(self._client.incr(id_key))
+                        expired = pipe.zrangebyscore(entries_key, "-inf", since)
+                    day = self._read_day(pipe, name) if day_since is not None else {}
+                    pipe.multi()
+                    pipe.set(tat_key, repr(tat), ex=int(DAY))
+                    if entry_id is not None:
+                        pipe.zadd(entries_key, {entry_id: entry[0]})
+                        pipe.hset(tokens_key, entry_id, entry[1])
+                        if expired:
+                            pipe.zrem(entries_key, *expired)
+                            pipe.hdel(tokens_key, *expired)
+                        pipe.expire(entries_key, int(2 * DAY))
+                        pipe.expire(tokens_key, int(2 * DAY))
+                    if day_since is not None:
+                        bucket = day_bucket(entry[0])
+                        last_at = max(entry[0], day.get(bucket, [entry[0]])[0])
+                        pipe.hincrby(day_requests_key, bucket, 1)
+                        pipe.hincrby(day_tokens_key, bucket, entry[1])
+                        pipe.hset(day_last_key, bucket, repr(last_at))
+                        stale = [old for old, (old_last, _, _) in day.items() if old_last <= day_since]
+                        if stale:
+                            for key in (day_requests_key, day_tokens_key, day_last_key):
+                                pipe.hdel(key, *stale)
+                        for key in (day_requests_key, day_tokens_key, day_last_key):
+                            pipe.expire(key, int(2 * DAY))
+                    pipe.execute()
+                except self._redis.WatchError:
+                    # Another client booked a slot in between: recompute from the new state
+                    continue
+                entry.append(entry_id)
+                return entry
+
+    def set_tokens(self, name, entry, tokens):
+        """Correct a booked entry [start_at, tokens, id] to `tokens`, in its day bucket too"""
+        with self._client.pipeline() as pipe:
+            if entry[2] is not None:
+                pipe.hset(self._keys(name)[2], entry[2], tokens)
+            if self._client.hexists(self._day_keys(name)[2], day_bucket(entry[0])):
+                pipe.hincrby(self._day_keys(name)[1], day_bucket(entry[0]), tokens - entry[1])
+            pipe.execute()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(url):
+    """The process-wide store for a RATE_LIMIT_STORE value: redis://..., sqlite:///path or a plain path"""
+    with _stores_lock:
+        if url not in _stores:
+            if url.startswith(("redis://", "rediss://", "unix://")):
+                _stores[url] = RedisLimiterStore(url)
+            else:
+                path = url[len("sqlite:///"):] if url.startswith("sqlite:///") else url
+                _stores[url] = SQLiteLimiterStore(path)
+        return _stores[url]
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    A RateLimiter whose state lives in a store shared with other processes.
+
+    Same API and algorithm as RateLimiter: every reserve() loads the state
+    named `name` from the store, books the slot and writes it back in one
+    atomic update, and reconcile() corrects the booked tokens in the store.
+    headroom() reuses the state seen within the last headroom_ttl seconds.
+
+    Store round trips can wait on other processes, so on an event loop use
+    reserve_async() and headroom_async(): they run on the limiter's own store
+    thread, which also writes reconcile()'s corrections in the background.
+    """
+
+    def __init__(self, limits, store, name, headroom_ttl=DEFAULT_HEADROOM_TTL, **kwargs):
+        super().__init__(limits, **kwargs)
+        self.store = store
+        self.name = name
+        self.headroom_ttl = headroom_ttl
+        # Day bucket aggregates [last start_at, tokens, requests], in place of the day window
+        self._day_buckets = []
+        # (clock time, headroom dict) of the last state seen
+        self._headroom_cache = None
+        self._store_thread = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix=f"limiter-store-{name}")
+
+    def _since(self):
+        """How far back the minute entries and the day buckets matter; None when they don't"""
+        now = self.clock()
+        return (now - MINUTE if self.effective.tpm else None,
+                now - DAY if self.effective.rpd or self.effective.tpd else None)
+
+    def _load(self, tat, entries, buckets):
+        self._tat = tat
+        self._minute_window = deque(entries) if self.effective.tpm else deque()
+        # The inherited day window is unused: RateLimiter._reserve still appends to it
+        self._day_window = deque()
+        self._day_buckets = buckets
+
+    def _earliest_for_day(self, start):
+        limit = self.effective.rpd
+        if not limit:
+            return start
+        in_window = [bucket for bucket in self._day_buckets if bucket[0] > start - DAY]
+        used = sum(bucket[2] for bucket in in_window)
+        for bucket in in_window:
+            if used < limit:
+                break
+            used -= bucket[2]
+            start = max(start, bucket[0] + DAY)
+        return start
+
+    def _earliest_for_tokens(self, start, tokens):
+        if self.effective.tpd:
+            start = self._earliest_in_window(self._day_buckets, DAY, start, tokens, self.effective.tpd)
+        if self.effective.tpm:
+            start = self._earliest_in_window(self._minute_window, MINUTE, start, tokens, self.effective.tpm)
+        return start
+
+    def _headroom(self):
+        headroom = super()._headroom()
+        in_window = [bucket for bucket in self._day_buckets if bucket[0] > self.clock() - DAY]
+        if self.effective.rpd:
+            headroom["requests_today"] = max(0, self.effective.rpd - sum(bucket[2] for bucket in in_window))
+        if self.effective.tpd:
+            headroom["tokens_today"] = max(0, self.effective.tpd - sum(bucket[1] for bucket in in_window))
+        self._headroom_cache = (self.clock(), headroom)
+        return headroom
+
+    def reserve(self, tokens=0):
+        """Book the earliest slot that respects every quota, fleet-wide, and return its Reservation"""
+        def book(tat, entries, buckets):
+            self._load(tat, entries, buckets)
+            reservation = self._reserve(tokens)
+            start_at = reservation.start_at
+            if buckets and day_bucket(buckets[-1][0]) == day_bucket(start_at):
+                last = buckets[-1]
+                buckets[-1] = [max(last[0], start_at), last[1] + tokens, last[2] + 1]
+            elif self.effective.rpd or self.effective.tpd:
+                buckets.append([start_at, tokens, 1])
+            return self._tat, reservation._entry
+
+        with self._lock:
+            entry = self.store.update(self.name, *self._since(), book)
+            self._headroom()
+        return Reservation(entry[0], tokens, entry)
+
+    async def reserve_async(self, tokens=0):
+        """reserve() on the store thread, so the store round trip doesn't hold up the event loop"""
+        return await asyncio.wrap_future(self._store_thread.submit(self.reserve, tokens))
+
+    def reconcile(self, reservation, actual_tokens):
+        """Replace a reservation's estimated tokens with the reported usage; the store is updated in the background"""
+        if reservation is None or reservation._entry is None:
+            return
+        tokens = max(0, int(actual_tokens))
+        with self._lock:
+            booked = list(reservation._entry)
+            reservation._entry[1] = tokens
+        self._store_thread.submit(self.store.set_tokens, self.name, booked, tokens).add_done_callback(
+            _report_store_error
+        )
+
+    def _cached_headroom(self):
+        """The headroom seen within headroom_ttl, with the wait for the next slot brought up to date"""
+        cached = self._headroom_cache
+        if cached is None:
+            return None
+        seen_at, headroom = cached
+        age = self.clock() - seen_at
+        if age >= self.headroom_ttl:
+            return None
+        return dict(headroom, next_slot_in=max(0.0, headroom["next_slot_in"] - age))
+
+    def headroom(self):
+        cached = self._cached_headroom()
+        if cached is not None:
+            return cached
+        state = self.store.read(self.name, *self._since())
+        with self._lock:
+            self._load(*state)
+            return self._headroom()
+
+    async def headroom_async(self):
+        """headroom(), reading the store on the store thread when the cached headroom is stale"""
+        cached = self._cached_headroom()
+        if cached is not None:
+            return cached
+        return await asyncio.wrap_future(self._store_thread.submit(self.headroom))
+
+
+def _report_store_error(future):
+    if future.exception() is not None:
+        print(f"⚠ Rate limit store update failed: {future.exception()}")
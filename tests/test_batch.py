@@ -0,0 +1,61 @@
+"""
+Batch runs: the URL file is opened up front, and rerunning with the same
+output retries only the pages that did not finish.
+"""
+import json
+import os
+
+os.environ["LLM_BACKEND"] = "local"
+os.environ["LLM_CACHE_PATH"] = ""
+os.environ["JOB_STORE_PATH"] = ""
+
+import pytest
+
+import batch
+import parse
+from llm_backend import LocalBackend
+from rate_limiter import RateLimits
+
+
+def test_read_urls_skips_blank_lines_and_comments(tmp_path):
+    path = tmp_path / "urls.txt"
+    path.write_text("# shop pages\nhttps://a.example\n\n  https://b.example  \n", encoding="utf-8")
+    assert list(batch.read_urls(str(path))) == ["https://a.example", "https://b.example"]
+
+
+def test_missing_url_file_fails_before_the_run(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        batch.read_urls(str(tmp_path / "missing.txt"))
+    with pytest.raises(SystemExit) as exit_info:
+        batch.main([str(tmp_path / "missing.txt"), "prices", "-o", str(tmp_path / "out.jsonl")])
+    assert exit_info.value.code == 2
+
+
+def test_rerun_retries_only_unfinished_pages(tmp_path, monkeypatch):
+    output = str(tmp_path / "out.jsonl")
+    urls = ["https://a.example", "https://b.example", "https://c.example"]
+    scraped = []
+    broken = {"https://b.example"}
+
+    def scrape_website(url, cancel_token=None):
+        scraped.append(url)
+        if url in broken:
+            raise RuntimeError("page load failed")
+        return f"<html><body><p>{url} sells lamps</p></body></html>"
+
+    monkeypatch.setattr(batch, "scrape_website", scrape_website)
+    parse.set_backend(LocalBackend(responder=lambda prompt, config: "lamp"), RateLimits(rpm=6000))
+
+    counts = batch.run_batch(urls, "products", output, use_cache=False, adaptive=False)
+    assert (counts[batch.STATUS_OK], counts[batch.STATUS_FAILED]) == (2, 1)
+    assert batch.finished_urls(output) == {"https://a.example", "https://c.example"}
+
+    broken.clear()
+    scraped.clear()
+    counts = batch.run_batch(urls, "products", output, use_cache=False, adaptive=False)
+    assert scraped == ["https://b.example"]
+    assert (counts[batch.STATUS_OK], counts["skipped"]) == (1, 2)
+    with open(output, encoding="utf-8") as f:
+        statuses = [(record["url"], record["status"]) for record in map(json.loads, f)]
+    assert statuses[-1] == ("https://b.example", batch.STATUS_OK)
+    assert batch.finished_urls(output) == set(urls)
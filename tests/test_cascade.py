@@ -0,0 +1,49 @@
+"""
+A cascade answers from the cheap model unless its answer looks wrong; an
+empty answer for a chunk that mentions what was asked for is escalated.
+"""
+import os
+
+os.environ["LLM_BACKEND"] = "local"
+os.environ["LLM_CACHE_PATH"] = ""
+os.environ["JOB_STORE_PATH"] = ""
+
+import parse
+from cascade import ModelCascade, ModelRoute
+from llm_backend import LocalBackend
+from rate_limiter import RateLimits, make_rate_limiter
+
+
+def route(name, answer, asked):
+    def responder(prompt, generation_config):
+        asked.append(name)
+        return answer
+
+    backend = LocalBackend(responder=responder, model_name=name)
+    return ModelRoute(backend, make_rate_limiter(RateLimits(rpm=6000), name))
+
+
+def run(chunk, cheap_answer):
+    asked = []
+    cascade = ModelCascade([route("cheap", cheap_answer, asked), route("strong", "price: 12 EUR", asked)])
+    result = parse.parse_with_gemini([chunk], "price", cascade=cascade, use_cache=False, max_workers=1,
+                                     adaptive=False)
+    return result, asked
+
+
+def test_empty_answer_on_relevant_chunk_is_escalated():
+    result, asked = run("The price of the lamp is 12 EUR.", "")
+    assert asked == ["cheap", "strong"]
+    assert result == "price: 12 EUR"
+
+
+def test_empty_answer_on_unrelated_chunk_is_accepted():
+    result, asked = run("Opening hours: Monday to Friday.", "")
+    assert asked == ["cheap"]
+    assert result == ""
+
+
+def test_good_cheap_answer_is_kept():
+    result, asked = run("The price of the lamp is 12 EUR.", "price: 12 EUR")
+    assert asked == ["cheap"]
+    assert result == "price: 12 EUR"
@@ -0,0 +1,55 @@
+"""
+ContextCacheRegistry reuses a cached prefix while it is valid and deletes
+the remote cache once it is expired or replaced.
+"""
+import asyncio
+
+from llm_backend import ContextCacheRegistry, LocalBackend
+
+PREFIX = "page content " * 100
+
+
+class RecordingBackend(LocalBackend):
+    def __init__(self):
+        super().__init__(min_cache_tokens=0)
+        self.created = 0
+        self.deleted = []
+
+    async def create_context_cache(self, prefix, ttl_seconds):
+        self.created += 1
+        return await super().create_context_cache(prefix, ttl_seconds)
+
+    async def delete_context_cache(self, handle):
+        self.deleted.append(handle.name)
+        await super().delete_context_cache(handle)
+
+
+def lookups(ttl_seconds, count=2):
+    backend = RecordingBackend()
+    registry = ContextCacheRegistry(ttl_seconds=ttl_seconds)
+
+    async def run():
+        return [await registry.get_or_create(backend, PREFIX) for _ in range(count)]
+
+    return asyncio.run(run()), backend
+
+
+def test_valid_cache_is_reused():
+    handles, backend = lookups(ttl_seconds=3600)
+    assert handles[0] is handles[1]
+    assert (backend.created, backend.deleted) == (1, [])
+
+
+def test_expired_cache_is_deleted_and_recreated():
+    handles, backend = lookups(ttl_seconds=0)
+    assert backend.created == 2
+    assert backend.deleted == [handles[0].name]
+    # Deleted before it was recreated, so the new cache is still there
+    assert handles[1].name in backend._contexts
+
+
+def test_cache_about_to_expire_is_replaced_and_deleted():
+    handles, backend = lookups(ttl_seconds=ContextCacheRegistry.EXPIRY_SLACK // 2)
+    assert backend.created == 2
+    assert backend.deleted == [handles[0].name]
+    assert handles[1].name in backend._contexts
@@ -0,0 +1,57 @@
+"""
+hedged() duplicates a request that runs past the policy's delay: the first
+success wins and the other request is cancelled.
+"""
+import asyncio
+
+import pytest
+
+from dispatch import HedgePolicy, hedged
+
+
+def policy():
+    hedge = HedgePolicy(min_samples=5, min_delay=0.05)
+    for _ in range(5):
+        hedge.latencies.observe(0.01)
+    return hedge
+
+
+def run(primary_seconds, hedge_seconds=0.0, primary_error=None, hedge_error=None, hedge_policy=None):
+    calls = []
+    cancelled = []
+
+    async def call(is_hedge):
+        name = "hedge" if is_hedge else "primary"
+        calls.append(name)
+        try:
+            await asyncio.sleep(hedge_seconds if is_hedge else primary_seconds)
+        except asyncio.CancelledError:
+            cancelled.append(name)
+            raise
+        error = hedge_error if is_hedge else primary_error
+        if error is not None:
+            raise error
+        return name
+
+    result = asyncio.run(hedged(call, hedge_policy or policy()))
+    return result, calls, cancelled
+
+
+def test_fast_request_is_not_hedged():
+    assert run(0.0) == ("primary", ["primary"], [])
+
+
+def test_slow_request_is_won_by_the_hedge():
+    hedge_policy = policy()
+    result, calls, cancelled = run(1.0, hedge_policy=hedge_policy)
+    assert (result, calls, cancelled) == ("hedge", ["primary", "hedge"], ["primary"])
+    assert (hedge_policy.hedges, hedge_policy.hedge_wins) == (1, 1)
+
+
+def test_failed_hedge_leaves_the_primary_running():
+    assert run(0.2, hedge_error=ConnectionError("hedge failed")) == ("primary", ["primary", "hedge"], [])
+
+
+def test_primary_error_is_raised_when_both_fail():
+    with pytest.raises(TimeoutError):
+        run(0.2, primary_error=TimeoutError("primary"), hedge_error=ConnectionError("hedge"))
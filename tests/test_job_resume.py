@@ -0,0 +1,54 @@
+"""
+A parse job checkpointed in a JobStore is resumed chunk by chunk: chunks
+that got an answer are not asked again, chunks whose request failed are.
+"""
+import os
+
+os.environ["LLM_BACKEND"] = "local"
+os.environ["LLM_CACHE_PATH"] = ""
+os.environ["JOB_STORE_PATH"] = ""
+
+import parse
+from job_store import CHUNK_DONE, CHUNK_FAILED, JOB_COMPLETE, JOB_INTERRUPTED, JobStore
+from llm_backend import LocalBackend
+from rate_limiter import RateLimits
+
+
+def run(store, chunks, failing):
+    asked = []
+
+    def responder(prompt, generation_config):
+        name = next(chunk.split()[0] for chunk in chunks if chunk in prompt)
+        asked.append(name)
+        if name in failing:
+            # Not a rate limit: retried with backoff, then the chunk is given up as failed
+            raise ConnectionError(f"{name} unavailable")
+        return f"answer from {name}"
+
+    parse.set_backend(LocalBackend(responder=responder), RateLimits(rpm=6000))
+    result = parse.parse_with_gemini(chunks, "answers", max_workers=2, adaptive=False, job_store=store,
+                                     job_id="resume-test")
+    return result, asked
+
+
+def chunk_statuses(store):
+    return [status for (status,) in store._conn.execute(
+        "SELECT status FROM job_chunks WHERE job_id = ? ORDER BY chunk_index", ("resume-test",)
+    )]
+
+
+def test_failed_chunk_is_retried_on_resume(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    chunks = [f"first {'lorem ' * 20}", f"second {'ipsum ' * 20}", f"third {'dolor ' * 20}"]
+
+    result, asked = run(store, chunks, failing={"second"})
+    assert "answer from first" in result and "answer from third" in result
+    assert "second" in asked
+    assert chunk_statuses(store) == [CHUNK_DONE, CHUNK_FAILED, CHUNK_DONE]
+    assert store.get("resume-test").status == JOB_INTERRUPTED
+
+    result, asked = run(store, chunks, failing=set())
+    assert asked == ["second"]
+    assert result.splitlines() == ["answer from first", "answer from second", "answer from third"]
+    assert chunk_statuses(store) == [CHUNK_DONE] * 3
+    assert store.get("resume-test").status == JOB_COMPLETE
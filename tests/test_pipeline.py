@@ -0,0 +1,51 @@
+"""
+A Pipeline always ends: failing items come out as FailedItem, and an input
+iterable that raises ends the run with its error instead of hanging it.
+"""
+import threading
+
+from pipeline import FailedItem, Pipeline, Stage
+
+
+def consume(pipeline, timeout=5):
+    """The pipeline's items and the error that ended it, failing the test if it hangs"""
+    outcome = {"items": [], "error": None}
+
+    def read():
+        try:
+            for item in pipeline:
+                outcome["items"].append(item)
+        except Exception as e:
+            outcome["error"] = e
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    reader.join(timeout)
+    assert not reader.is_alive(), "pipeline did not finish"
+    return outcome["items"], outcome["error"]
+
+
+def test_failed_item_skips_later_stages():
+    def check(n):
+        if n == 2:
+            raise ValueError("bad item")
+        return n
+
+    stages = [Stage("check", check), Stage("double", lambda n: n * 2, workers=2)]
+    items, error = consume(Pipeline(stages).run(range(4)))
+    assert error is None
+    failed = [item for item in items if isinstance(item, FailedItem)]
+    assert sorted(item for item in items if not isinstance(item, FailedItem)) == [0, 2, 6]
+    assert [(item.item, item.stage) for item in failed] == [(2, "check")]
+
+
+def test_input_error_ends_the_run():
+    def numbers():
+        yield 1
+        yield 2
+        raise OSError("input went away")
+
+    items, error = consume(Pipeline([Stage("double", lambda n: n * 2, workers=2)]).run(numbers()))
+    assert sorted(items) == [2, 4]
+    assert isinstance(error, OSError)
+
@@ -0,0 +1,206 @@
+"""
+Background execution of scrape and parse jobs.
+
+A Streamlit script run ends at the next widget interaction, and a job run
+inside it holds the server thread for minutes and is abandoned by any
+rerun. A JobRunner runs jobs on its own worker threads instead,
+independently of script reruns and sessions. Each job is a BackgroundJob
+that records its status, stage, progress, the results released so far and
+its final result or error, so a page only submits jobs and renders their
+current state, and a reloaded tab can attach to a job still running.
+"""
+import concurrent.futures
+import os
+import threading
+import time
+import uuid
+
+from cancellation import CancelToken, JobCancelled
+from scrape import clean_body_content, extract_body_content, scrape_website
+from parse import parse_with_gemini
+
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "4"))
+# Finished jobs kept so their results can still be shown; the oldest are forgotten first
+MAX_FINISHED_JOBS = 50
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_CANCELLED = "cancelled"
+JOB_FAILED = "failed"
+
+
+class BackgroundJob:
+    """One scrape or parse job: written by its worker thread, read by any page"""
+
+    def __init__(self, kind, label=None, meta=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.label = label
+        # Whatever the submitter needs to render the job again (settings, schema, ...)
+        self.meta = meta or {}
+        self.status = JOB_QUEUED
+        self.stage = "Waiting for a worker"
+        self.completed = 0
+        self.total = 0
+        # (chunk_index, text so far) of the chunk streaming in, if any
+        self.partial = None
+        self.result = None
+        self.error = None
+        self.stats = {}
+        self.cancel_token = CancelToken()
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._released = []
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in (JOB_DONE, JOB_CANCELLED, JOB_FAILED)
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def fraction(self):
+        return self.completed / self.total if self.total else 0.0
+
+    def released(self):
+        """Results released so far, as [(chunk_index, result), ...] in document order"""
+        with self._lock:
+            return list(self._released)
+
+    def cancel(self, reason="Stopped by user"):
+        self.cancel_token.cancel(reason)
+
+    def on_progress(self, completed, total):
+        self.completed = completed
+        self.total = total
+
+    def on_result(self, chunk_index, result):
+        with self._lock:
+            self._released.append((chunk_index, result))
+        self.partial = None
+
+    def on_partial(self, chunk_index, text):
+        self.partial = (chunk_index, text)
+
+    def summary(self):
+        text = f"{self.kind} of {self.label or self.id}: {self.status}"
+        if self.total:
+            text += f", {self.completed}/{self.total} chunks"
+        return f"{text} after {self.elapsed:.0f}s"
+
+
+class JobRunner:
+    """
+    Runs jobs on a pool of worker threads and keeps them by id.
+
+    submit(kind, work) runs work(job) for a new BackgroundJob; its return
+    value becomes job.result. Cancelling the job's token stops the work
+    (a parse returns what it finished, a scrape quits its browser).
+    """
+
+    def __init__(self, max_workers=WORKER_THREADS):
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="job-worker")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, work, label=None, meta=None):
+        job = BackgroundJob(kind, label, meta)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget_finished()
+        self._pool.submit(self._run, job, work)
+        return job
+
+    def submit_scrape(self, url, meta=None):
+        """Scrape, extract and clean a page; the result is its cleaned text"""
+        def work(job):
+            job.stage = "Scraping the website"
+            html = scrape_website(url, cancel_token=job.cancel_token)
+            job.stage = "Extracting content"
+            body = extract_body_content(html)
+            job.stage = "Cleaning content"
+            return clean_body_content(body)
+        return self.submit("scrape", work, label=url, meta=meta)
+
+    def submit_parse(self, dom_chunks, parse_description, label=None, meta=None, stream_partial=True,
+                     **parse_kwargs):
+        """
+        parse_with_gemini() on a worker thread. Progress, released results and
+        (with stream_partial) the streaming chunk are recorded on the job.
+        """
+        def work(job):
+            job.stage = "Parsing"
+            job.total = len(dom_chunks)
+            return parse_with_gemini(
+                dom_chunks,
+                parse_description,
+                progress_callback=job.on_progress,
+                result_callback=job.on_result,
+                partial_callback=job.on_partial if stream_partial else None,
+                cancel_token=job.cancel_token,
+                stats=job.stats,
+                **parse_kwargs
+            )
+        return self.submit("parse", work, label=label, meta=meta)
+
+    def _run(self, job, work):
+        if job.cancel_token.cancelled:
+            job.status = JOB_CANCELLED
+            job.finished_at = time.time()
+            return
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        try:
+            job.result = work(job)
+            job.status = JOB_CANCELLED if job.cancel_token.cancelled else JOB_DONE
+        except JobCancelled:
+            job.status = JOB_CANCELLED
+        except Exception as e:
+            print(f"❌ Background {job.kind} job {job.id} failed: {e}")
+            job.error = e
+            job.status = JOB_FAILED
+        finally:
+            job.stage = job.status.capitalize()
+            job.finished_at = time.time()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self, kind=None, active=None, owner=None):
+        """
+        Jobs in submission order, optionally only of one kind, only running
+        (active=True) ones or only those submitted with meta["owner"] == owner
+        """
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [
+            job for job in jobs
+            if (kind is None or job.kind == kind) and (active is None or active != job.finished)
+            and (owner is None or job.meta.get("owner") == owner)
+        ]
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+
+_default_runner = None
+_default_runner_lock = threading.Lock()
+
+
+def get_job_runner():
+    """Process-wide JobRunner, shared by every Streamlit session and rerun"""
+    global _default_runner
+    with _default_runner_lock:
+        if _default_runner is None:
+            _default_runner = JobRunner()
+        return _default_runner